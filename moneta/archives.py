@@ -1,5 +1,10 @@
+import bz2
+import gzip
 import os
 import re
+import tarfile
+import time
+import zipfile
 from tarfile import InvalidHeaderError
 import struct
 import math
@@ -160,3 +165,92 @@ class ArFile(object):
 
     def close(self):
         pass
+
+
+class StreamBuffer(object):
+    """ Write-only file object that keeps written data until they are collected by :meth:`pop`.
+    Since it is not seekable, zip files are written with data descriptors. """
+
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_archive(members, compression, bufsize=65536):
+    """ Generate the content of an archive, chunk by chunk, while its members are read.
+
+    :param members: iterable of (archive name, size, modification timestamp, readable file object);
+        file objects are closed once read
+    :param compression: 'zip', 'tgz' or 'tbz'
+    :param bufsize: size of read chunks
+    :return: a generator of bytes
+    """
+    buffer = StreamBuffer()
+    if compression == 'zip':
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+            for arcname, size, mtime, fileobj in members:
+                zip_info = zipfile.ZipInfo(arcname, date_time=time.localtime(mtime)[0:6])
+                zip_info.compress_type = zipfile.ZIP_DEFLATED
+                zip_info.file_size = size  # required to know if zip64 extensions must be used
+                with fileobj, zip_file.open(zip_info, 'w') as fd:
+                    data = fileobj.read(bufsize)
+                    while data:
+                        fd.write(data)
+                        yield buffer.pop()
+                        data = fileobj.read(bufsize)
+        yield buffer.pop()
+        return
+    elif compression == 'tgz':
+        # no timestamp in the gzip header: the same members always give the same bytes (strong ETag, byte ranges)
+        comp_file = gzip.GzipFile(filename='', mode='wb', fileobj=buffer, mtime=0)
+    elif compression == 'tbz':
+        comp_file = bz2.BZ2File(buffer, mode='wb')
+    else:
+        raise ValueError('unknown compression: %r' % compression)
+    # tarfile.TarFile.addfile reads each file at once, so tar blocks are directly written
+    written = 0
+    with comp_file:
+        for arcname, size, mtime, fileobj in members:
+            tar_info = tarfile.TarInfo(arcname)
+            tar_info.size = size
+            tar_info.mtime = mtime
+            tar_info.mode = 0o644
+            header = tar_info.tobuf(tarfile.DEFAULT_FORMAT, tarfile.ENCODING, 'surrogateescape')
+            comp_file.write(header)
+            written += len(header)
+            remaining = size
+            with fileobj:
+                while remaining > 0:
+                    data = fileobj.read(min(bufsize, remaining))
+                    if not data:
+                        raise IOError('%s is shorter than expected' % arcname)
+                    comp_file.write(data)
+                    remaining -= len(data)
+                    yield buffer.pop()
+            written += size
+            if size % tarfile.BLOCKSIZE:
+                padding = tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE
+                comp_file.write(tarfile.NUL * padding)
+                written += padding
+        end = tarfile.NUL * (2 * tarfile.BLOCKSIZE)
+        written += len(end)
+        if written % tarfile.RECORDSIZE:
+            end += tarfile.NUL * (tarfile.RECORDSIZE - written % tarfile.RECORDSIZE)
+        comp_file.write(end)
+    yield buffer.pop()
@@ -49,6 +49,19 @@ STORAGES = {
 STORAGE_ARCHIVE = 'archive'
 STORAGE_UNCOMPRESSED = 'uncompressed'
 STORAGE_CACHE = 'cache'
+ARCHIVE_VARIANTS_MAX_SIZE = 10 * 1024 * 1024 * 1024  # cache of zip/tgz/tbz archives generated on demand
+INDEX_COMPRESSION = 'gz:9 bz2:9 xz:6'  # default compression codecs of index files (with their levels)
+INDEX_COMPRESSION_THREADS = 4  # index files are compressed in parallel
+CONTENTS_MERGE_FANOUT = 64  # Contents files are built by merging at most 64 sorted file lists at once
+PDIFF_HISTORY = 14  # number of Packages.diff patches kept for apt clients (0 to disable PDiffs)
+INDEX_TRANSLATIONS = False  # move long descriptions of apt packages to i18n/Translation-en files
+INDEX_GENERATIONS = 2  # previous generations of index files kept for clients that are still downloading them
+INDEX_REBUILD_QUIET_PERIOD = 10  # indexes are rebuilt 10 seconds after the last upload (None to disable)
+INDEX_REBUILD_MAX_DELAY = 60  # ... but at most 60 seconds after the first unpublished upload
+INDEX_PUBLISHING = 'scheduled'  # 'lazy': indexes are only rebuilt when they are read after a change
+INDEX_LAZY_TIMEOUT = 30  # in lazy mode, concurrent requests wait at most 30 seconds for the in-flight build
+INDEX_LOCK_DIR = Directory('{LOCAL_PATH}/locks')  # per-repository build locks, shared by all worker processes
+MAX_BYTE_RANGES = 16  # larger multi-range requests are answered with the whole file
 WEBSOCKET_URL = None
 
 GNUPG_HOME = Directory('{LOCAL_PATH}/gpg')
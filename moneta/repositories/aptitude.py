@@ -1,12 +1,15 @@
-import bz2
 import gzip
 import hashlib
-import io
+import json
 import os.path
+import re
 import tarfile
 import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from django.template.response import TemplateResponse
+from django.utils.cache import patch_cache_control
 
 from moneta.templatetags.moneta import moneta_url
 
@@ -15,6 +18,11 @@ try:
 except ImportError:
     # noinspection PyUnresolvedReferences,PyPackageRequirements
     from backports import lzma
+try:
+    # noinspection PyPackageRequirements
+    import zstandard
+except ImportError:
+    zstandard = None
 import datetime
 
 from django.conf import settings
@@ -29,9 +37,11 @@ from django.utils.translation import gettext as _
 from moneta.archives import ArFile
 from moneta.exceptions import InvalidRepositoryException
 from moneta.repository.signing import GPGSigner
-from moneta.utils import parse_control_data
+from moneta.utils import parse_control_data, DigestWriter, makedir, remove, parse_codecs, compressed_writer, \
+    available_codecs, INDEX_CODECS, merge_sorted, FileDigests, ed_diff
 from moneta.views import get_file, sendpath
 from moneta.repositories.base import RepositoryModel
+from moneta.repositories.scheduler import index_scheduler
 from moneta.repository.models import storage, Repository, Element, ArchiveState
 
 
@@ -40,6 +50,42 @@ __author__ = 'flanker'
 tz = get_current_timezone()
 
 
+def compression_pattern():
+    """ regexp group matching the extensions of all available compression codecs (or no extension) """
+    return '(?P<compression>|%s)' % '|'.join(re.escape(INDEX_CODECS[x][0]) for x in available_codecs())
+
+
+def compress_file(fd: int, filename: str, key: str, codec: str=None, level: int=None):
+    """ Compress the content of a file and store the result in the cache storage.
+
+    The source file is read with `os.pread`, so the same descriptor can be shared by several threads.
+
+    :param fd: file descriptor of the uncompressed content
+    :param filename: name of the stored file
+    :param key: key of the cache storage
+    :param codec: compression codec (see :data:`moneta.utils.INDEX_CODECS`), None to store the original content
+    :param level: compression level
+    :return: (filename, :class:`moneta.utils.FileDigests` of the stored file)
+    """
+    tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False)
+    try:
+        with tmp_file:
+            writer = DigestWriter(tmp_file)
+            comp_file = writer if codec is None else compressed_writer(writer, codec, level)
+            offset = 0
+            data = os.pread(fd, 65536, offset)
+            while data:
+                comp_file.write(data)
+                offset += len(data)
+                data = os.pread(fd, 65536, offset)
+            if comp_file is not writer:
+                comp_file.close()
+        storage(settings.STORAGE_CACHE).import_filename(tmp_file.name, key, filename)
+    finally:
+        remove(tmp_file.name)
+    return filename, writer.digests
+
+
 class Aptitude(RepositoryModel):
     verbose_name = _('APT repository for Linux .deb packages')
     storage_uid = 'a97172de-0000-0000-0000-%012d'
@@ -63,19 +109,18 @@ class Aptitude(RepositoryModel):
         control_file, control_file_name = self.get_subfile(ar_file, 'control.tar.')
         if control_file is None:
             raise InvalidRepositoryException('No control file found in .deb package')
-        mode = 'r:*'
-        if control_file_name.endswith('.xz') or control_file_name.endswith('.lzma'):
-            control_file_content = control_file.read()
-            control_file_content_uncompressed = lzma.decompress(control_file_content)
-            control_file.close()
-            control_file = io.BytesIO(control_file_content_uncompressed)
-            mode = 'r'
-        tar_file = tarfile.open(name='control', mode=mode, fileobj=control_file)
-        control_data = tar_file.extractfile('./control')
-        # poulating different informations on the element
-        control_data_value = control_data.read().decode('utf-8')
-        control_data.close()
+        tar_file = self.open_tar(control_file, control_file_name)
+        control_data_value = None
+        for member in tar_file:
+            if member.name in ('./control', 'control'):
+                # poulating different informations on the element
+                control_data_value = tar_file.extractfile(member).read().decode('utf-8')
+                break
         tar_file.close()
+        if control_data_value is None:
+            raise InvalidRepositoryException('No control file found in .deb package')
+        # the list of files is required by Contents-(architecture) files
+        self.store_file_list(element, ar_file)
         ar_file.close()
         archive_file.close()
         element.extra_data = control_data_value
@@ -105,39 +150,78 @@ class Aptitude(RepositoryModel):
                 return ar_file.extractfile(name), name
         return None, None
 
-    def file_list(self, element, uid):
-        cache_filename = 'filelist_%s' % element.sha256
+    @staticmethod
+    def open_tar(fileobj, name):
+        """ Open a (compressed) tar member of a .deb package as a stream, so it is never fully loaded in memory.
+
+        :param fileobj: readable file object
+        :param name: name of the member (data.tar.gz, control.tar.xz, …)
+        :return: :class:`tarfile.TarFile` that can only be iterated once
+        """
+        if name.endswith('.xz') or name.endswith('.lzma'):
+            return tarfile.open(name=name, mode='r|', fileobj=lzma.LZMAFile(fileobj))
+        elif name.endswith('.zst') and zstandard is not None:
+            return tarfile.open(name=name, mode='r|', fileobj=zstandard.ZstdDecompressor().stream_reader(fileobj))
+        return tarfile.open(name=name, mode='r|*', fileobj=fileobj)
+
+    @staticmethod
+    def file_list_filename(sha256):
+        return 'filelist_%s.gz' % sha256
+
+    def store_file_list(self, element, ar_file):
+        """ Store the sorted list of files provided by a .deb package in the cache storage, one name per line,
+        gzip-compressed.
+
+        :param element: the Element
+        :param ar_file: :class:`moneta.archives.ArFile` of the package
+        :return: the sorted list of file names
+        """
+        data_file, data_file_name = self.get_subfile(ar_file, 'data.tar.')
+        if data_file is None:
+            raise InvalidRepositoryException('No data file found in .deb package')
+        tar_file = self.open_tar(data_file, data_file_name)
+        names = sorted(member.path[2:] for member in tar_file if member.isfile())
+        tar_file.close()
+        tmpfile = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
+        with gzip.GzipFile(fileobj=tmpfile, mode='wb', mtime=0) as gz_file:
+            for name in names:
+                gz_file.write(('%s\n' % name).encode('utf-8'))
+        tmpfile.flush()
+        tmpfile.seek(0)
+        uid = self.storage_uid % element.repository_id
+        storage(settings.STORAGE_CACHE).store_descriptor(uid, self.file_list_filename(element.sha256), tmpfile)
+        tmpfile.close()
+        return names
+
+    def open_file_list(self, element, uid):
+        """ Return the gzip-compressed list of files provided by a .deb package, as an open file. This list is
+        extracted when the package is uploaded, or from the original package if this list is missing.
+        """
         key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
-        fileobj = storage(settings.STORAGE_CACHE).get_file(key, cache_filename)
+        fileobj = storage(settings.STORAGE_CACHE).get_file(key, self.file_list_filename(element.sha256))
         if fileobj is None:
-            tmpfile = tempfile.NamedTemporaryFile(dir=settings.FILE_UPLOAD_TEMP_DIR)
             archive_file = storage(settings.STORAGE_ARCHIVE).get_file(element.archive_key, sub_path='')
             ar_file = ArFile(element.filename, mode='r', fileobj=archive_file)
-            data_file, data_file_name = self.get_subfile(ar_file, 'data.tar.')
-            mode = 'r:*'
-            if data_file_name.endswith('.xz') or data_file_name.endswith('.lzma'):
-                data_file_content = data_file.read()
-                data_file_content_uncompressed = lzma.decompress(data_file_content)
-                data_file.close()
-                data_file = io.BytesIO(data_file_content_uncompressed)
-                mode = 'r'
-            tar_file = tarfile.open(name='data', mode=mode, fileobj=data_file)
-            members = tar_file.getmembers()
-            members = filter(lambda x: x.isfile(), members)
-            names = [x.path[2:] for x in members]
-            tar_file.close()
+            self.store_file_list(element, ar_file)
             ar_file.close()
             archive_file.close()
-            for name in names:
-                tmpfile.write(('%s\n' % name).encode('utf-8'))
-            tmpfile.flush()
-            tmpfile.seek(0)
-            storage(settings.STORAGE_CACHE).store_descriptor(uid, cache_filename, tmpfile)
-            tmpfile.close()
-        else:
-            names = [line.strip().decode() for line in fileobj]
-            fileobj.close()
-        return names
+            fileobj = storage(settings.STORAGE_CACHE).get_file(key, self.file_list_filename(element.sha256))
+        return fileobj
+
+    def file_list(self, element, uid):
+        """ Return the sorted list of files provided by a .deb package. """
+        return [line.rstrip(b'\n').decode('utf-8') for line in self.iter_file_list(element, uid)]
+
+    def iter_file_list(self, element, uid):
+        fileobj = self.open_file_list(element, uid)
+        with gzip.GzipFile(fileobj=fileobj, mode='rb') as gz_file:
+            yield from gz_file
+        fileobj.close()
+
+    def iter_contents(self, element, section, uid):
+        """ Yield the sorted lines of a Contents-(architecture) file (as `bytes`) for a .deb package. """
+        for line in self.iter_file_list(element, uid):
+            yield ("%- 100s%s\n" % (line.rstrip(b'\n').decode('utf-8'), section)).encode('utf-8')
 
     def url_list(self):
         """
@@ -170,20 +254,23 @@ class Aptitude(RepositoryModel):
             * /1/dists/repo_apt/stable/Release.xz
             * /1/dists/repo_apt/stable/binary-amd64/Packages.gz
             * /1/dists/repo_apt/stable/binary-amd64/Release.bz2
+            * /1/dists/repo_apt/stable/binary-amd64/Packages.diff/Index
+            * /1/dists/repo_apt/stable/i18n/Translation-en.xz
+            * /1/dists/repo_apt/stable/binary-amd64/by-hash/SHA256/[sha256]
             * /1/keys/repo_apt/key.asc
 
         :return: a patterns as expected by django
 
         """
-        compression = '(?P<compression>|.bz2|.gz|.xz)'
-        if lzma is None:
-            compression = '(?P<compression>|.bz2|.gz)'
+        compression = compression_pattern()
         pattern_list = [
             url(r"^(?P<rid>\d+)/pool/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/(?P<folder>[\w\-\.~_]+)/$",
                 self.wrap_view('folder_index'), name="folder_index"),
             url(r"^(?P<rid>\d+)/pool/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/(?P<folder>[\w\-\.~_]+)/"
                 r"(?P<filename>[\w\-\.~_ ]+)$",
                 self.wrap_view('get_file'), name="get_file"),
+            url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/(?P<path>(?:[\w\-\._]+/){0,3})by-hash/SHA256/"
+                r"(?P<digest>[0-9a-f]{64})$", self.wrap_view('by_hash'), name="by_hash"),
             url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/(?P<filename>InRelease|Release|Release.gpg)$",
                 self.wrap_view('repo_release'), name="repo_release"),
             url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/Contents-(?P<arch>[\w]+)"
@@ -194,6 +281,12 @@ class Aptitude(RepositoryModel):
             url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/binary-(?P<arch>[\w\-\.]+)/"
                 r"(?P<filename>Packages|Release)%s$" % compression,
                 self.wrap_view('state_files'), name="state_files"),
+            url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/binary-(?P<arch>[\w\-\.]+)/"
+                r"Packages.diff/(?P<filename>Index|[\w\-\.]+\.gz)$",
+                self.wrap_view('pdiff_files'), name="pdiff_files"),
+            url(r"^(?P<rid>\d+)/dists/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/i18n/"
+                r"Translation-(?P<lang>[\w]+)%s$" % compression,
+                self.wrap_view('translation_files'), name="translation_files"),
             url(r"^(?P<rid>\d+)/(?P<slug2>[\w\-\._]+)/(?P<repo_slug>[\w\-\._]+).asc$", self.wrap_view('gpg_key'),
                 name="gpg_key"),
             url(r"^(?P<rid>\d+)/$", self.wrap_view('index'), name="index"),
@@ -224,6 +317,16 @@ class Aptitude(RepositoryModel):
             'repo': repo_slug, 'state': state_slug, 'arch': arch, 'filename': filename, 'comp': compression}
         return self.index_file(request, rid, filename, 'text/plain')
 
+    def pdiff_files(self, request, rid, repo_slug, state_slug, arch, filename):
+        filename = 'dists/%(repo)s/%(state)s/binary-%(arch)s/Packages.diff/%(filename)s' % {
+            'repo': repo_slug, 'state': state_slug, 'arch': arch, 'filename': filename}
+        return self.index_file(request, rid, filename, 'text/plain')
+
+    def translation_files(self, request, rid, repo_slug, state_slug, lang, compression):
+        filename = 'dists/%(repo)s/%(state)s/i18n/Translation-%(lang)s%(comp)s' % {
+            'repo': repo_slug, 'state': state_slug, 'lang': lang, 'comp': compression}
+        return self.index_file(request, rid, filename, 'text/plain')
+
     def arch_contents(self, request, rid, repo_slug, arch, compression):
         filename = 'dists/%(repo)s/Contents-%(arch)s%(comp)s' % {'repo': repo_slug, 'arch': arch, 'comp': compression, }
         return self.index_file(request, rid, filename, 'text/plain')
@@ -233,11 +336,33 @@ class Aptitude(RepositoryModel):
                    {'repo': repo_slug, 'arch': arch, 'comp': compression, 'state': state_slug, }
         return self.index_file(request, rid, filename, 'text/plain')
 
-    def index_file(self, request, rid, filename, mimetype):
+    def by_hash(self, request, rid, repo_slug, path, digest):
+        filename = 'dists/%(repo)s/%(path)sby-hash/SHA256/%(digest)s' % {'repo': repo_slug, 'path': path,
+                                                                        'digest': digest}
+        return self.index_file(request, rid, filename, 'application/octet-stream', etag=digest, immutable=True)
+
+    def index_file(self, request, rid, filename, mimetype, etag=None, immutable=False):
         repo = get_object_or_404(Repository.reader_queryset(request), id=rid, archive_type=self.archive_type)
+        index_scheduler.ensure_fresh(repo)
         uid = self.storage_uid % repo.id
-        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
-        return sendpath(settings.STORAGE_CACHE, key, filename, mimetype)
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
+        generations = self.generations(uid)
+        prefix = 'generations/%s/' % generations[0] if generations else ''
+        if immutable and len(generations) > 1 and not self.index_exists(key, prefix + filename):
+            # by-hash files of the kept generations are still valid for clients that read a previous Release file
+            for generation in generations[1:]:
+                if self.index_exists(key, 'generations/%s/%s' % (generation, filename)):
+                    prefix = 'generations/%s/' % generation
+                    break
+        response = sendpath(settings.STORAGE_CACHE, key, prefix + filename, mimetype, request=request, etag=etag)
+        if immutable and response.status_code in (200, 206, 304):
+            # the content of by-hash files never changes, but shared caches must not serve private repositories
+            if repo.is_private:
+                patch_cache_control(response, private=True, max_age=365 * 86400, immutable=True)
+            else:
+                patch_cache_control(response, public=True, max_age=365 * 86400, immutable=True)
+        return response
 
     # noinspection PyUnusedLocal
     def folder_index(self, request, rid, repo_slug, state_slug, folder):
@@ -294,156 +419,590 @@ class Aptitude(RepositoryModel):
     # noinspection PyUnusedLocal
     def force_index(self, request, rid, repo_slug):
         repo = get_object_or_404(Repository.upload_queryset(request), id=rid, archive_type=self.archive_type)
-        self.generate_indexes(repo)
-        return HttpResponse(_('Indexes have been successfully rebuilt.'))
+        if index_scheduler.build_indexes(repo):
+            return HttpResponse(_('Indexes have been successfully rebuilt.'))
+        return HttpResponse(_('Indexes are being rebuilt and will be rebuilt again to include recent changes.'))
 
     @staticmethod
-    def compress_files(open_files: dict, root: str, uid: str) -> list:
+    def compress_files(open_files: dict, root: str, uid: str, codecs: list=None) -> list:
         """ Return a list of tuples ((os.path.relpath(filename, root), md5, sha1, sha256, actual_size).
         Also stores the generated files (and original ones)
 
+        All files are compressed in parallel, each compressed file being hashed while it is written.
+
         :param open_files: dict[filename] = open file descriptor in mode w+b
         :param root:
         :param uid:
+        :param codecs: list of (codec, extension, level), as returned by `Repository.get_index_codecs`
         :return:
         """
+        if codecs is None:
+            codecs = parse_codecs(settings.INDEX_COMPRESSION)
+        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
+        makedir(settings.FILE_UPLOAD_TEMP_DIR)
+        futures = []
+        with ThreadPoolExecutor(max_workers=settings.INDEX_COMPRESSION_THREADS) as executor:
+            for filename, package_file in open_files.items():
+                package_file.flush()
+                futures.append(executor.submit(compress_file, package_file.fileno(), filename, key))
+                futures += [executor.submit(compress_file, package_file.fileno(), filename + extension, key,
+                                            codec, level)
+                            for (codec, extension, level) in codecs]
+        for package_file in open_files.values():
+            package_file.close()
+        # remove files compressed by codecs that are not used anymore
+        unused_extensions = {x[0] for x in INDEX_CODECS.values()} - {x[1] for x in codecs}
+        cache_storage = storage(settings.STORAGE_CACHE)
+        for filename in open_files:
+            for extension in unused_extensions:
+                cache_storage.delete(os.path.join(key, filename + extension))
         hash_controls = []
-        for filename, package_file in open_files.items():
-            package_file.seek(0)
-            gz_filename = filename + '.gz'
-            bz2_filename = filename + '.bz2'
-            xz_filename = filename + '.xz'
-            gz_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-            bz2_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-            xz_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-            bz2_compressor = bz2.BZ2Compressor(9)
-            if lzma is not None:
-                xz_compressor = lzma.LZMACompressor()
-            else:
-                xz_compressor = bz2_compressor
-            with gzip.GzipFile(gz_filename, mode='wb', compresslevel=9, fileobj=gz_file) as fd_gz:
-                data = package_file.read(10240)
-                while data:
-                    fd_gz.write(data)
-                    bz2_file.write(bz2_compressor.compress(data))
-                    xz_file.write(xz_compressor.compress(data))
-                    data = package_file.read(10240)
-            bz2_file.write(bz2_compressor.flush())
-            xz_file.write(xz_compressor.flush())
-            all_files = [(package_file, filename), (gz_file, gz_filename), (bz2_file, bz2_filename), ]
-            if lzma is not None:
-                all_files.append((xz_file, xz_filename))
-            for obj, filename_ in all_files:
-                obj.flush()
-                obj.seek(0)
-                data = obj.read(32768)
-                md5, sha1, sha256, size = hashlib.md5(), hashlib.sha1(), hashlib.sha256(), 0
-                while data:
-                    md5.update(data)
-                    sha1.update(data)
-                    sha256.update(data)
-                    size += len(data)
-                    data = obj.read(32768)
-                hash_controls.append((os.path.relpath(filename_, root), md5.hexdigest(), sha1.hexdigest(),
-                                      sha256.hexdigest(), size))
-                obj.seek(0)
-                storage(settings.STORAGE_CACHE).store_descriptor(uid, filename_, obj)
-                obj.close()
-                # build the following files:
+        for future in futures:
+            filename_, digests = future.result()
+            hash_controls.append((os.path.relpath(filename_, root), digests.md5, digests.sha1, digests.sha256,
+                                  digests.size))
         return hash_controls
 
+    index_manifest = 'index_manifest.json'
+    index_state = 'index_state.json'
+    generation_pointer = 'CURRENT'
+
+    def read_index_manifest(self, uid, prefix=''):
+        """ Return the manifest of a generation of index files (stored in `prefix`):
+
+          * `targets`: dict[index filename] = fingerprint of its content,
+          * `hashes`: dict[path relative to dists/(group)/] = [md5, sha1, sha256, size],
+          * `elements`: dict["(element id)-(sha256)"] = [architecture, section]
+          * `pdiff`: dict[Packages filename] = list of [sha256, size, patch name, patch sha256, patch size,
+            compressed patch sha256, compressed patch size], the oldest first
+        """
+        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
+        fileobj = storage(settings.STORAGE_CACHE).get_file(key, prefix + self.index_manifest)
+        manifest = {}
+        if fileobj is not None:
+            try:
+                manifest = json.loads(fileobj.read().decode('utf-8'))
+            except ValueError:
+                manifest = {}
+            fileobj.close()
+        for name in ('targets', 'hashes', 'elements', 'pdiff'):
+            manifest.setdefault(name, {})
+        return manifest
+
+    def write_index_manifest(self, uid, manifest, prefix=''):
+        self.store_index_data(uid, prefix + self.index_manifest, json.dumps(manifest, sort_keys=True).encode('utf-8'))
+
+    def content_fingerprint(self, repository, *args) -> dict:
+        """ Return fingerprints of the content of the repository: one per state, computed over
+        (element id, sha256, filename) of its elements, and a global one that also depends on the repository itself
+        and on any extra argument (like settings that change the index files).
+
+        :return: {'repository': fingerprint, 'states': {state id: fingerprint}}
+        """
+        members = {}
+        for element_id, sha256, filename, state_id in Element.objects.filter(repository=repository) \
+                .values_list('id', 'sha256', 'filename', 'states__id'):
+            members.setdefault(state_id, []).append([element_id, sha256, filename])
+        states = {str(state.id): self.index_fingerprint(state.name, state.slug, sorted(members.get(state.id, [])))
+                  for state in ArchiveState.objects.filter(repository=repository)}
+        return {'repository': self.repository_fingerprint(repository, states, sorted(members.get(None, [])), *args),
+                'states': states}
+
+    def repository_fingerprint(self, repository, states: dict, *args) -> str:
+        return self.index_fingerprint(repository.name, repository.slug, repository.is_private,
+                                      repository.get_index_codecs(), states, *args)
+
+    def read_index_state(self, uid, prefix) -> dict:
+        """ Return the fingerprints and the date of a generation of index files (stored in `prefix`) """
+        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
+        fileobj = storage(settings.STORAGE_CACHE).get_file(key, prefix + self.index_state)
+        if fileobj is None:
+            return {}
+        try:
+            return json.loads(fileobj.read().decode('utf-8'))
+        except ValueError:
+            return {}
+        finally:
+            fileobj.close()
+
+    def is_index_up_to_date(self, uid, fingerprint: dict, validity=365) -> bool:
+        """ Return True if the current generation of index files has been built from the same content, and is
+        not too close to its expiration date """
+        index_state = self.read_index_state(uid, self.generation_prefix(uid))
+        return fingerprint['repository'] is not None and index_state.get('fingerprint') == fingerprint['repository'] \
+            and time.time() < index_state.get('date', 0) + validity * 86400 / 2
+
+    def write_index_state(self, uid, prefix, fingerprint: dict):
+        content = {'fingerprint': fingerprint['repository'], 'states': fingerprint['states'], 'date': time.time()}
+        self.store_index_data(uid, prefix + self.index_state, json.dumps(content, sort_keys=True).encode('utf-8'))
+
+    @staticmethod
+    def store_index_data(uid, filename, data: bytes):
+        """ Store a file in the cache storage. The file is replaced (not overwritten), so files shared with
+        previous generations are left untouched. """
+        makedir(settings.FILE_UPLOAD_TEMP_DIR)
+        tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False)
+        try:
+            with tmp_file:
+                tmp_file.write(data)
+            cache_storage = storage(settings.STORAGE_CACHE)
+            cache_storage.import_filename(tmp_file.name, cache_storage.uid_to_key(uid), filename)
+        finally:
+            remove(tmp_file.name)
+
+    @staticmethod
+    def copy_index_file(uid, src, dst) -> bool:
+        """ Copy a file of the cache storage (as a hard link when possible). Return False if `src` is missing. """
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
+        path = cache_storage.get_path(key, src)
+        if path and os.path.isfile(path):
+            cache_storage.store_filename(uid, dst, path)
+            return True
+        fileobj = cache_storage.get_file(key, src)
+        if fileobj is None:
+            return False
+        cache_storage.store_descriptor(uid, dst, fileobj)
+        fileobj.close()
+        return True
+
+    def generations(self, uid) -> list:
+        """ Return the names of the published generations of index files, the current one first """
+        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
+        fileobj = storage(settings.STORAGE_CACHE).get_file(key, self.generation_pointer)
+        if fileobj is None:
+            return []
+        generations = fileobj.read().decode('utf-8').split()
+        fileobj.close()
+        return generations
+
+    @staticmethod
+    def index_exists(key, path) -> bool:
+        """ Return True if the index file exists in the cache storage, without reading it """
+        try:
+            storage(settings.STORAGE_CACHE).get_size(key, path)
+        except OSError:
+            return False
+        return True
+
+    def generation_prefix(self, uid) -> str:
+        """ Return the prefix of the current generation of index files in the cache storage """
+        generations = self.generations(uid)
+        return 'generations/%s/' % generations[0] if generations else ''
+
+    @staticmethod
+    def new_generation() -> str:
+        return datetime.datetime.now(utc).strftime('%Y%m%d%H%M%S%f')
+
+    def publish_generation(self, uid, generation):
+        """ Make `generation` the current generation of index files, by atomically replacing the pointer file.
+        Only the `settings.INDEX_GENERATIONS` previous generations are kept for in-flight clients.
+        """
+        generations = [generation] + [x for x in self.generations(uid) if x != generation]
+        kept, removed = generations[:settings.INDEX_GENERATIONS + 1], generations[settings.INDEX_GENERATIONS + 1:]
+        self.store_index_data(uid, self.generation_pointer, ''.join('%s\n' % x for x in kept).encode('utf-8'))
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
+        for name in removed:
+            cache_storage.delete(os.path.join(key, 'generations', name))
+
+    def update_pdiff(self, uid, root, filename, previous_file, manifest, now, prefix=''):
+        """ Add a patch from the previous version of a Packages file to its new version, and write the
+        corresponding Packages.diff/Index file. Only the last `settings.PDIFF_HISTORY` patches are kept.
+
+        :param uid: uid of the index files in the cache storage
+        :param root: dists/(group)/
+        :param filename: name of the Packages file
+        :param previous_file: open file with the previous content
+        :param manifest: the index manifest (see :meth:`read_index_manifest`), updated in place
+        :param now: date of the new version
+        :param prefix: prefix of the generation of index files
+        """
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
+        with previous_file:
+            previous_lines = previous_file.readlines()
+        with cache_storage.get_file(key, prefix + filename) as fd:
+            current_lines = fd.readlines()
+        current_digests = FileDigests()
+        for line in current_lines:
+            current_digests.update(line)
+        previous_digests = FileDigests()
+        for line in previous_lines:
+            previous_digests.update(line)
+        history = manifest['pdiff'].setdefault(filename, [])
+        if previous_digests.sha256 != current_digests.sha256:
+            patch = ed_diff(previous_lines, current_lines)
+            compressed_patch = gzip.compress(patch, mtime=0)
+            patch_name = now.strftime('%Y-%m-%d-%H%M.%S')
+            names = {x[2] for x in history}
+            index = 1
+            while patch_name in names:
+                patch_name = '%s-%d' % (now.strftime('%Y-%m-%d-%H%M.%S'), index)
+                index += 1
+            self.store_index_data(uid, '%s%s.diff/%s.gz' % (prefix, filename, patch_name), compressed_patch)
+            history.append([previous_digests.sha256, previous_digests.size, patch_name,
+                            hashlib.sha256(patch).hexdigest(), len(patch),
+                            hashlib.sha256(compressed_patch).hexdigest(), len(compressed_patch)])
+        while len(history) > settings.PDIFF_HISTORY:
+            patch = history.pop(0)
+            cache_storage.delete(os.path.join(key, '%s%s.diff/%s.gz' % (prefix, filename, patch[2])))
+        content = 'SHA256-Current: %s % 8d\n' % (current_digests.sha256, current_digests.size)
+        content += 'SHA256-History:\n'
+        content += ''.join(' %s % 8d %s\n' % (x[0], x[1], x[2]) for x in history)
+        content += 'SHA256-Patches:\n'
+        content += ''.join(' %s % 8d %s\n' % (x[3], x[4], x[2]) for x in history)
+        content += 'SHA256-Download:\n'
+        content += ''.join(' %s % 8d %s.gz\n' % (x[5], x[6], x[2]) for x in history)
+        content = content.encode('utf-8')
+        self.store_index_data(uid, '%s%s.diff/Index' % (prefix, filename), content)
+        digests = FileDigests()
+        digests.update(content)
+        manifest['hashes'][os.path.relpath('%s.diff/Index' % filename, root)] = [
+            digests.md5, digests.sha1, digests.sha256, digests.size]
+
+    @staticmethod
+    def by_hash_path(relpath, sha256):
+        """ by-hash path of an index file, relative to dists/(group)/ (like `relpath`) """
+        return os.path.join(os.path.dirname(relpath), 'by-hash', 'SHA256', sha256)
+
+    def publish_by_hash(self, uid, root, manifest, hash_controls, prefix=''):
+        """ Store a by-hash copy of each file listed in the Release file.
+
+        Copies that are referenced by the previous Release file are kept, so clients that are fetching index files
+        during a rebuild still find them; older ones are removed.
+
+        :param uid: uid of the index files in the cache storage
+        :param root: dists/(group)/
+        :param manifest: the index manifest (see :meth:`read_index_manifest`), updated in place
+        :param hash_controls: list of [relpath, md5, sha1, sha256, size]
+        :param prefix: prefix of the generation of index files
+        """
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
+        published = set(manifest.get('by_hash', [])) | set(manifest.get('by_hash_previous', []))
+        current = set()
+        for line in hash_controls:
+            path = root + self.by_hash_path(line[0], line[3])
+            current.add(path)
+            if path in published:
+                continue
+            self.copy_index_file(uid, prefix + root + line[0], prefix + path)
+        previous = set(manifest.get('by_hash', [])) - current
+        if not previous:  # nothing has changed since the previous Release file
+            previous = set(manifest.get('by_hash_previous', [])) - current
+        for path in published - current - previous:
+            cache_storage.delete(os.path.join(key, prefix + path))
+        manifest['by_hash'] = sorted(current)
+        manifest['by_hash_previous'] = sorted(previous)
+
+    @staticmethod
+    def split_description(control_data: str):
+        """ Split the control data of a package like Debian does when translations are published:
+
+          * control data with only the short description and a `Description-md5` field,
+          * the `Translation-en` stanza with the full description.
+
+        :param control_data: content of the control file of a package
+        :return: (control data, translation stanza)
+        """
+        package, description, fields = '', [], []
+        in_description = False
+        for line in control_data.splitlines(keepends=True):
+            if in_description and line[:1] in (' ', '\t'):
+                description.append(line)
+                continue
+            in_description = line.startswith('Description:')
+            if in_description:
+                description.append(line[len('Description:'):].lstrip(' '))
+                fields.append(None)  # placeholder for the short description
+            else:
+                fields.append(line)
+            if line.startswith('Package:'):
+                package = line[len('Package:'):].strip()
+        if not description:
+            return control_data, ''
+        full_description = ''.join(description)
+        if not full_description.endswith('\n'):
+            full_description += '\n'
+        md5 = hashlib.md5(full_description.encode('utf-8')).hexdigest()
+        short_description = 'Description: %sDescription-md5: %s\n' % (full_description.splitlines(keepends=True)[0],
+                                                                      md5)
+        control_data = ''.join(short_description if x is None else x for x in fields)
+        translation = 'Package: %s\nDescription-md5: %s\nDescription-en: %s' % (package, md5, full_description)
+        return control_data, translation
+
+    @staticmethod
+    def stanza_filename(element_id, sha256, short_description=False):
+        return 'stanza_%s-%s%s' % (element_id, sha256, '.short' if short_description else '')
+
+    @staticmethod
+    def translation_filename(element_id, sha256):
+        return 'translation_%s-%s' % (element_id, sha256)
+
+    @staticmethod
+    def cached_index_data(uid, cache_filename, build):
+        """ Return the content of a file of the cache storage, or store the result of `build()` if it is missing.
+        """
+        key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
+        fileobj = storage(settings.STORAGE_CACHE).get_file(key, cache_filename)
+        if fileobj is not None:
+            data = fileobj.read()
+            fileobj.close()
+            return data
+        data = build().encode('utf-8')
+        tmpfile = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
+        tmpfile.write(data)
+        tmpfile.flush()
+        tmpfile.seek(0)
+        storage(settings.STORAGE_CACHE).store_descriptor(uid, cache_filename, tmpfile)
+        tmpfile.close()
+        return data
+
+    def element_stanza(self, element_id, sha256, uid, short_description=False):
+        """ Return the Packages stanza of an element, without its `Filename` field (that depends on the state).
+        Stanzas are cached in the cache storage, so unchanged elements are not read from the database.
+
+        :param short_description: only keep the short description (with a `Description-md5` field)
+        """
+        def build():
+            element = Element.objects.get(id=element_id)
+            stanza = element.extra_data
+            if short_description:
+                stanza = self.split_description(stanza)[0]
+            control_data = parse_control_data(element.extra_data)
+            for field, attr in (('MD5sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'), ('Size', 'filesize')):
+                if field not in control_data:
+                    stanza += "{0}: {1}\n".format(field, getattr(element, attr))
+            return stanza
+        return self.cached_index_data(uid, self.stanza_filename(element_id, sha256, short_description), build)
+
+    def element_translation(self, element_id, sha256, uid):
+        """ Return the Translation-en stanza of an element (cached like :meth:`element_stanza`) """
+        def build():
+            return self.split_description(Element.objects.get(id=element_id).extra_data)[1]
+        return self.cached_index_data(uid, self.translation_filename(element_id, sha256), build)
+
+    @staticmethod
+    def index_fingerprint(*args) -> str:
+        return hashlib.sha256(json.dumps(args, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def generate_indexes(self, repository, states=None, validity=365):
+        """ (Re)build the index files of the repository.
+
+        Each generation of index files is written in a new directory of the cache storage and published at once
+        by :meth:`publish_generation`, so clients never see a partial set of files.
+        Only index files whose content has changed since the previous generation are rebuilt and compressed
+        (other ones are shared with the previous generation): a manifest keeps the fingerprint of each file and the
+        hashes of its compressed variants (reused in the Release file). Packages stanzas are also cached per element.
+
+        :param repository: the repository to index
+        :param states: only rebuild the files of these states (all states if None)
+        :param validity: number of days before the Release file expires
+        """
         default_architectures = {'amd64', }
         uid = self.storage_uid % repository.id
         repo_slug = repository.slug
         root_url = reverse('repository:%s:index' % self.archive_type, kwargs={'rid': repository.id, })
         if repository.is_private:
             root_url = 'authb-%s' % root_url
-        if states is None:
-            states = list(ArchiveState.objects.filter(repository=repository).order_by('name'))
-        states = [state for state in states if
-                  Element.objects.filter(repository=repository, states=state).count() > 0]
-
-        all_states_architectures = set()
-        all_states = set()
-        open_files = {}
-        complete_file_list = {}
+        codecs = repository.get_index_codecs()
+        codec_spec = [[codec, level] for (codec, extension, level) in codecs]
+        # nothing to do if the repository has not been modified since the last generation
+        repository_fingerprint = self.content_fingerprint(repository, settings.INDEX_TRANSLATIONS,
+                                                          settings.PDIFF_HISTORY > 0)
+        if self.is_index_up_to_date(uid, repository_fingerprint, validity=validity):
+            return
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = cache_storage.uid_to_key(uid)
         root = 'dists/%(repo)s/' % {'repo': repo_slug}
+        previous_prefix = self.generation_prefix(uid)
+        manifest = self.read_index_manifest(uid, previous_prefix)
+        if states is not None:
+            states = {state.id for state in states}
+            previous_states = self.read_index_state(uid, previous_prefix).get('states', {})
+            if any(previous_states.get(x) != y for (x, y) in repository_fingerprint['states'].items()
+                   if int(x) not in states):
+                # modified states are not rebuilt, so the next run must not be skipped
+                repository_fingerprint['repository'] = None
+        generation = self.new_generation()
+        prefix = 'generations/%s/' % generation
+        # files that are still valid are shared with the previous generation
+        for relpath in list(manifest['hashes']):
+            if not self.copy_index_file(uid, previous_prefix + root + relpath, prefix + root + relpath):
+                del manifest['hashes'][relpath]
+        for name in ('by_hash', 'by_hash_previous'):
+            manifest[name] = [x for x in manifest.get(name, [])
+                              if self.copy_index_file(uid, previous_prefix + x, prefix + x)]
+        for filename, history in manifest['pdiff'].items():
+            manifest['pdiff'][filename] = [x for x in history if self.copy_index_file(
+                uid, '%s%s.diff/%s.gz' % (previous_prefix, filename, x[2]), '%s%s.diff/%s.gz' % (prefix, filename, x[2]))]
+
+        # (element id, sha256, filename) of all elements, and architecture/section of each element
+        elements = {}
+        for element_id, sha256, filename in Element.objects.filter(repository=repository) \
+                .values_list('id', 'sha256', 'filename'):
+            elements[element_id] = (sha256, filename)
+        known_elements = {}
+        missing_ids = []
+        for element_id, (sha256, filename) in elements.items():
+            element_key = '%s-%s' % (element_id, sha256)
+            if element_key in manifest['elements']:
+                known_elements[element_key] = manifest['elements'][element_key]
+            else:
+                missing_ids.append(element_id)
+        for element_id, sha256, extra_data in Element.objects.filter(id__in=missing_ids) \
+                .values_list('id', 'sha256', 'extra_data'):
+            control_data = parse_control_data(extra_data)
+            known_elements['%s-%s' % (element_id, sha256)] = [control_data.get('Architecture', 'all'),
+                                                              control_data.get('Section', 'contrib')]
+        for element_key in set(manifest['elements']) - set(known_elements):
+            element_id, __, sha256 = element_key.partition('-')
+            for cache_filename in (self.stanza_filename(element_id, sha256),
+                                   self.stanza_filename(element_id, sha256, short_description=True),
+                                   self.translation_filename(element_id, sha256)):
+                cache_storage.delete(os.path.join(key, cache_filename))
+        manifest['elements'] = known_elements
+
         # list all available architectures (required to add architecture-independent packages to all archs)
-        for element in Element.objects.filter(repository=repository):
-            control_data = parse_control_data(element.extra_data)
-            architecture = control_data.get('Architecture', 'all')
-            all_states_architectures.add(architecture)
-            # build the following files:
+        all_states_architectures = {known_elements['%s-%s' % (element_id, sha256)][0]
+                                    for element_id, (sha256, filename) in elements.items()}
+        if not all_states_architectures or all_states_architectures == {'all'}:
+            all_states_architectures = default_architectures
+        state_members = {}
+        # noinspection PyUnresolvedReferences
+        for element_id, state_id in Element.states.through.objects.filter(element__repository=repository) \
+                .values_list('element_id', 'archivestate_id'):
+            state_members.setdefault(state_id, []).append(element_id)
+
+        # compute the content of the following files:
         #   * dists/(group)/(state)/binary-(architecture)/Packages
         #   * dists/(group)/(state)/binary-(architecture)/Release
-        # prepare data for:
         #   * dists/(group)/Contents-(architecture)
-        if not all_states_architectures or all_states_architectures == {'all'}:
-            all_states_architectures = default_architectures
-        for state in states:
-            state_architectures = set()
+        targets = {}  # targets[filename] = (state or None, list of element ids or release content)
+        all_states = set()
+        complete_file_list = {}
+        for state in ArchiveState.objects.filter(repository=repository).order_by('name'):
+            members = sorted(state_members.get(state.id, []), key=lambda x: (elements[x][1], x))
+            if not members:
+                continue
             all_states.add(state.name)
-            for element in Element.objects.filter(repository=repository, states=state).order_by('filename'):
-                control_data = parse_control_data(element.extra_data)
-                architecture = control_data.get('Architecture', 'all')
-                section = control_data.get('Section', 'contrib')
-                package_file_list = ["%- 100s%s\n" % (x, section) for x in self.file_list(element, uid)]
-                if architecture == 'all':
-                    elt_architectures = default_architectures
-                else:
-                    elt_architectures = {architecture, }
+            state_architectures = set()
+            for element_id in members:
+                sha256, filename = elements[element_id]
+                architecture, section = known_elements['%s-%s' % (element_id, sha256)]
+                elt_architectures = default_architectures if architecture == 'all' else {architecture, }
                 state_architectures |= elt_architectures
                 for architecture in elt_architectures:
-                    complete_file_list.setdefault(architecture, [])
-                    complete_file_list[architecture] += package_file_list
-
+                    complete_file_list.setdefault(architecture, []).append(element_id)
                     filename = 'dists/%(repo)s/%(state)s/binary-%(architecture)s/Packages' % {
                         'repo': repo_slug, 'state': state.name, 'architecture': architecture, }
-                    if filename not in open_files:
-                        open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-                    package_file = open_files[filename]
-                    package_file.write(element.extra_data.encode('utf-8'))
-                    for key, attr in (('MD5sum', 'md5'), ('SHA1', 'sha1'), ('SHA256', 'sha256'),
-                                      ('Size', 'filesize')):
-                        if key not in control_data:
-                            package_file.write("{0}: {1}\n".format(key, getattr(element, attr)).encode('utf-8'))
-                    package_url = reverse('repository:%s:get_file' % self.archive_type,
-                                          kwargs={'rid': repository.id, 'repo_slug': repo_slug,
-                                                  'filename': element.filename, 'state_slug': state.slug,
-                                                  'folder': element.filename[0:1], })
-                    package_url = os.path.relpath(package_url, root_url)
-                    package_file.write("Filename: {0}\n".format(package_url).encode('utf-8'))
-                    package_file.write("\n".encode('utf-8'))
-            if len(state_architectures) == 0:
-                state_architectures = default_architectures
-                # we process elements
+                    targets.setdefault(filename, (state, []))[1].append(element_id)
+            if settings.INDEX_TRANSLATIONS:
+                filename = 'dists/%(repo)s/%(state)s/i18n/Translation-en' % {'repo': repo_slug, 'state': state.name}
+                targets[filename] = (state, members)
             for architecture in state_architectures:
                 filename = 'dists/%(repo)s/%(state)s/binary-%(architecture)s/Release' % {
                     'repo': repo_slug, 'state': state.slug, 'architecture': architecture,
                 }
-                open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
                 content = render_to_string('repositories/aptitude/architecture_release.txt',
                                            {'architecture': architecture, 'repository': repository, 'state': state, })
-                open_files[filename].write(content.encode('utf-8'))
-            # build the following files:
-        #   * dists/(group)/Contents-(architecture)
-        for architecture, file_list in complete_file_list.items():
-            file_list.sort()
+                targets[filename] = (state, content)
+        for architecture, element_ids in complete_file_list.items():
             filename = 'dists/%(repo)s/Contents-%(architecture)s' % {'repo': repo_slug,
                                                                      'architecture': architecture, }
+            targets[filename] = (None, element_ids)
+
+        # only build files whose fingerprint has changed (or whose hashes are unknown)
+        open_files = {}
+        fingerprints = {}
+        for filename, (state, data) in targets.items():
+            if isinstance(data, str):
+                fingerprint = self.index_fingerprint(codec_spec, data)
+            elif state is None:
+                fingerprint = self.index_fingerprint(codec_spec, [[elements[x][0], known_elements[
+                    '%s-%s' % (x, elements[x][0])][1]] for x in data])
+            elif filename.endswith('/Translation-en'):
+                fingerprint = self.index_fingerprint(codec_spec, [[x, elements[x][0]] for x in data])
+            else:
+                fingerprint = self.index_fingerprint(codec_spec, root_url, repo_slug, state.slug,
+                                                     settings.INDEX_TRANSLATIONS,
+                                                     [[x, elements[x][0], elements[x][1]] for x in data])
+            relpaths = [os.path.relpath(filename + extension, root) for extension in [''] + [x[1] for x in codecs]]
+            if manifest['targets'].get(filename) == fingerprint and all(x in manifest['hashes'] for x in relpaths):
+                continue
+            elif state is not None and states is not None and state.id not in states:
+                continue
+            fingerprints[filename] = fingerprint
             open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-            for info in file_list:
-                open_files[filename].write(info.encode('utf-8'))
-            # build the following files:
+            if isinstance(data, str):
+                open_files[filename].write(data.encode('utf-8'))
+            elif state is None:
+                # streaming k-way merge of the sorted file lists of all packages
+                data_elements = {element.id: element for element in Element.objects.filter(id__in=set(data))
+                                 .only('id', 'sha256', 'filename', 'repository', 'archive_key')}
+                file_lists = (self.iter_contents(data_elements[x], known_elements['%s-%s' % (
+                    x, elements[x][0])][1], uid) for x in data)
+                for info in merge_sorted(file_lists, fanout=settings.CONTENTS_MERGE_FANOUT):
+                    open_files[filename].write(info)
+            elif filename.endswith('/Translation-en'):
+                translations = set()
+                for element_id in data:
+                    translation = self.element_translation(element_id, elements[element_id][0], uid)
+                    if translation and translation not in translations:
+                        translations.add(translation)
+                        open_files[filename].write(translation + b'\n')
+            else:
+                for element_id in data:
+                    sha256, element_filename = elements[element_id]
+                    open_files[filename].write(self.element_stanza(element_id, sha256, uid,
+                                                                   short_description=settings.INDEX_TRANSLATIONS))
+                    package_url = reverse('repository:%s:get_file' % self.archive_type,
+                                          kwargs={'rid': repository.id, 'repo_slug': repo_slug,
+                                                  'filename': element_filename, 'state_slug': state.slug,
+                                                  'folder': element_filename[0:1], })
+                    package_url = os.path.relpath(package_url, root_url)
+                    open_files[filename].write("Filename: {0}\n\n".format(package_url).encode('utf-8'))
+        # build the following files:
         #   * dists/(group)/Contents-(architecture).gz/.bz2/.xz
         #   * dists/(group)/(state)/binary-(architecture)/Packages.gz/.bz2/.xz
         #   * dists/(group)/(state)/binary-(architecture)/Release.gz/.bz2/.xz
+        #   * dists/(group)/(state)/i18n/Translation-en.gz/.bz2/.xz
         # store all files in the cache
-        hash_controls = self.compress_files(open_files, root, uid)
+        previous_files = {}
+        for filename in open_files:
+            relpath = os.path.relpath(filename, root)
+            if settings.PDIFF_HISTORY and filename.endswith('/Packages') and relpath in manifest['hashes']:
+                previous_files[filename] = cache_storage.get_file(key, prefix + filename)
+        open_files = {prefix + filename: package_file for (filename, package_file) in open_files.items()}
+        for line in self.compress_files(open_files, prefix + root, uid, codecs=codecs):
+            manifest['hashes'][line[0]] = list(line[1:])
+        manifest['targets'].update(fingerprints)
+        #   * dists/(group)/(state)/binary-(architecture)/Packages.diff/Index
+        now = datetime.datetime.now(utc)
+        for filename, previous_file in previous_files.items():
+            if previous_file is not None:
+                self.update_pdiff(uid, root, filename, previous_file, manifest, now, prefix=prefix)
+        # forget files that are not generated anymore
+        hash_controls = []
+        for filename in sorted(targets):
+            for extension in [''] + [x[1] for x in codecs] + ['.diff/Index']:
+                relpath = os.path.relpath(filename + extension, root)
+                if relpath in manifest['hashes']:
+                    hash_controls.append([relpath] + manifest['hashes'][relpath])
+        manifest['targets'] = {x: y for (x, y) in manifest['targets'].items() if x in targets}
+        for filename in set(manifest['pdiff']) - set(targets):
+            for patch in manifest['pdiff'].pop(filename):
+                cache_storage.delete(os.path.join(key, '%s%s.diff/%s.gz' % (prefix, filename, patch[2])))
+        manifest['hashes'] = {x[0]: x[1:] for x in hash_controls}
+        #   * dists/(group)/by-hash/SHA256/(sha256)
+        #   * dists/(group)/(state)/binary-(architecture)/by-hash/SHA256/(sha256)
+        self.publish_by_hash(uid, root, manifest, hash_controls, prefix=prefix)
+        self.write_index_manifest(uid, manifest, prefix=prefix)
+        self.write_index_state(uid, prefix, repository_fingerprint)
         #   * dists/(group)/Release
         # store all files in the cache
         release_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-        now = datetime.datetime.now(utc)
         now_str = now.strftime('%a, %d %b %Y %H:%M:%S UTC')  # 'Mon, 29 Nov 2010 08:12:51 UTC'
         until = (now + datetime.timedelta(validity)).strftime('%a, %d %b %Y %H:%M:%S UTC')
         content = render_to_string('repositories/aptitude/state_release.txt',
@@ -456,7 +1015,7 @@ class Aptitude(RepositoryModel):
                 release_file.write((" %s % 8d %s\n" % (line[index], line[4], line[0])).encode('utf-8'))
         release_file.flush()
         release_file.seek(0)
-        filename = 'dists/%(repo)s/Release' % {'repo': repo_slug, }
+        filename = '%(prefix)sdists/%(repo)s/Release' % {'prefix': prefix, 'repo': repo_slug, }
         storage(settings.STORAGE_CACHE).store_descriptor(uid, filename, release_file)
         # build the following files:
         #   * dists/(group)/Release.gpg
@@ -471,7 +1030,7 @@ class Aptitude(RepositoryModel):
         signature_file.write(signature_content.encode('utf-8'))
         signature_file.flush()
         signature_file.seek(0)
-        filename = 'dists/%(repo)s/Release.gpg' % {'repo': repo_slug, }
+        filename = '%(prefix)sdists/%(repo)s/Release.gpg' % {'prefix': prefix, 'repo': repo_slug, }
         storage(settings.STORAGE_CACHE).store_descriptor(uid, filename, signature_file)
         signature_file.close()
 
@@ -479,6 +1038,7 @@ class Aptitude(RepositoryModel):
         inrelease_file.write(inrelease_content.encode('utf-8'))
         inrelease_file.flush()
         inrelease_file.seek(0)
-        filename = 'dists/%(repo)s/InRelease' % {'repo': repo_slug, }
+        filename = '%(prefix)sdists/%(repo)s/InRelease' % {'prefix': prefix, 'repo': repo_slug, }
         storage(settings.STORAGE_CACHE).store_descriptor(uid, filename, inrelease_file)
         inrelease_file.close()
+        self.publish_generation(uid, generation)
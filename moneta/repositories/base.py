@@ -3,6 +3,7 @@ from django.http import HttpResponseBadRequest
 from django.utils.translation import gettext_lazy as _
 
 from moneta.repository.models import Element
+from moneta.repositories.scheduler import index_scheduler
 from moneta.utils import import_path
 
 __author__ = 'flanker'
@@ -67,11 +68,21 @@ class RepositoryModel(object):
     def finish_element(self, element: Element, states: list):
         """
         Called after the .save() operations, with all states associated to this new element.
-        Currently, only add all states to this element.
+        Add all states to this element and schedule a rebuild of the indexes.
         :param element: Element
         :param states: list of ArchiveState
         """
         element.states.add(*states)
+        index_scheduler.mark_dirty(element.repository)
+
+    def generate_indexes(self, repository, states=None, validity=365):
+        """
+        (Re)build the index files of the repository, if any.
+        :param repository: Repository
+        :param states: list of ArchiveState (all states if None)
+        :param validity: number of days before index files expire
+        """
+        pass
 
     def url_list(self):
         """
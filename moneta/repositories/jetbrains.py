@@ -11,6 +11,7 @@ from django.utils.translation import gettext as _
 from moneta.repositories.base import RepositoryModel
 from moneta.repository.models import Repository, ArchiveState, Element
 from moneta.templatetags.moneta import moneta_url
+from moneta.views import conditional_response, queryset_validators, set_validators
 
 __author__ = 'Matthieu Gallet'
 
@@ -38,8 +39,13 @@ class Jetbrains(RepositoryModel):
         if state_slug:
             state = get_object_or_404(ArchiveState, repository=repo, name=state_slug)
             base_query = base_query.filter(states=state)
-        return TemplateResponse(request, 'repositories/jetbrains/updatePlugins.xml', {'elements': base_query},
-                                content_type='application/xml')
+        etag, last_modified = queryset_validators(base_query)
+        response = conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+        response = TemplateResponse(request, 'repositories/jetbrains/updatePlugins.xml', {'elements': base_query},
+                                    content_type='application/xml')
+        return set_validators(response, etag=etag, last_modified=last_modified)
 
     def index(self, request, rid):
         repo = get_object_or_404(Repository.reader_queryset(request), id=rid, archive_type=self.archive_type)
@@ -21,6 +21,7 @@ from moneta.repositories.xmlrpc import XMLRPCSite, register_rpc_method
 from moneta.repository.models import storage, Repository, Element, ArchiveState
 from moneta.templatetags.moneta import moneta_url
 from moneta.utils import parse_control_data
+from moneta.views import conditional_response, queryset_validators, set_validators
 
 __author__ = 'flanker'
 
@@ -197,10 +198,15 @@ class Pypi(Aptitude):
             base_query = base_query.filter(states=state)
         if search_pattern:
             base_query = base_query.filter(archive__iexact=search_pattern)
+        etag, last_modified = queryset_validators(base_query)
+        response = conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
         view_name = moneta_url(repo, 'get_file')
         elements = [(x.filename, x.md5, reverse(view_name, kwargs={'eid': x.id, })) for x in base_query[0:1000]]
         template_values = {'elements': elements, 'rid': rid, }
-        return TemplateResponse(request, 'repositories/pypi/simple.html', template_values)
+        response = TemplateResponse(request, 'repositories/pypi/simple.html', template_values)
+        return set_validators(response, etag=etag, last_modified=last_modified)
 
     def xmlrpc(self, request, rid, repo_slug, state_slug):
         return XML_RPC_SITE.dispatch(request, self, rid, repo_slug, state_slug)
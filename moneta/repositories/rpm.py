@@ -7,53 +7,20 @@ PyRPM is a pure python, simple to use, module to read information from a RPM fil
 
 from collections import namedtuple
 import hashlib
-import re
+import io
+import mmap
 import stat
 import struct
-import sys
-
-if sys.version < '3':
-    try:
-        from io import StringIO as BytesIO
-    except ImportError:
-        from io import StringIO as BytesIO
-else:
-    from io import BytesIO
 
 
 class Entry(object):
     """ RPM Header Entry """
 
     # noinspection PyShadowingBuiltins
-    def __init__(self, entry=None, store=None, tag=None, type=None, value=None):
-        # noinspection PyPep8Naming
-        DECODING_MAP = {
-            0: self._read_null,
-            1: self._read_char,
-            2: self._read_int8,
-            3: self._read_int16,
-            4: self._read_int32,
-            5: self._read_int64,
-            6: self._read_string,
-            7: self._read_binary,
-            8: self._read_string_array,
-            9: self._read_string,
-        }
-
-        # read from file if possible
-        if entry is not None and store is not None:
-            # seek to position in store
-            store.seek(entry[2])
-
-            # decode information
-            self.entry = entry
-            self.tag = entry[0]
-            self.type = entry[1]
-            self.value = DECODING_MAP[entry[1]](store, entry[3])
-        else:
-            self.tag = tag
-            self.type = type
-            self.value = value
+    def __init__(self, tag=None, type=None, value=None):
+        self.tag = tag
+        self.type = type
+        self.value = value
 
     def __str__(self):
         return "(%s, %s)" % (self.tag, self.value, )
@@ -61,64 +28,22 @@ class Entry(object):
     def __repr__(self):
         return "(%s, %s)" % (self.tag, self.value, )
 
-    @staticmethod
-    def _read_format(fmt, store):
-        size = struct.calcsize(fmt)
-        data = store.read(size)
-        unpacked_data = struct.unpack(fmt, data)
-        return unpacked_data[0] if len(unpacked_data) == 1 else unpacked_data
-
-    # noinspection PyUnusedLocal
-    @staticmethod
-    def _read_null(store, data_count):
-        return None
-
-    def _read_char(self, store, data_count):
-        """ store is a pointer to the store offset
-        where the char should be read
-        """
-        return self._read_format('!{0:d}s'.format(data_count), store)
-
-    def _read_int8(self, store, data_count):
-        """ int8 = 1byte
-        """
-        return int(self._read_char(store, data_count))
-
-    def _read_int16(self, store, data_count):
-        """ int16 = 2bytes
-        """
-        return self._read_format('!{0:d}h'.format(data_count), store)
 
-    def _read_int32(self, store, data_count):
-        """ int32 = 4bytes
-        """
-        return self._read_format('!{0:d}i'.format(data_count), store)
+def _read_strings(data, offset: int, count: int) -> list:
+    """ read `count` consecutive NUL-terminated strings from `data` (bytes or mmap) """
+    end = offset
+    for i in range(count):
+        end = data.find(b'\x00', end) + 1
+        if end == 0:
+            raise RPMError('unterminated string in RPM header')
+    return str(memoryview(data)[offset:end - 1], 'utf-8', 'replace').split('\x00')
 
-    def _read_int64(self, store, data_count):
-        """ int64 = 8bytes
-        """
-        return self._read_format('!{0:d}q'.format(data_count), store)
 
-    def _read_string(self, store, data_count):
-        """ read a string entry
-        """
-        string = b''
-        while True:
-            char = self._read_char(store, 1)
-            if char == b'\x00':  # read until '\0'
-                break
-            string += char
-        return string.decode('utf-8')
-
-    def _read_string_array(self, store, data_count):
-        """ read a array of string entries
-        """
-        return [self._read_string(store, 1) for i in range(data_count)]
+# the memory-mapped pages of a RPM are released by windows of this size once they are hashed
+MAPPED_WINDOW = 4 * 1024 * 1024
 
-    def _read_binary(self, store, data_count):
-        """ read a binary entry
-        """
-        return self._read_format('!{0:d}s'.format(data_count), store)
+# entry type -> struct format of a single value
+ENTRY_FORMATS = {2: 'B', 3: 'h', 4: 'i', 5: 'q', }
 
 
 # noinspection PyBroadException
@@ -126,12 +51,11 @@ class HeaderBase(object):
 
     """ RPM Header Structure """
     MAGIC_NUMBER = b'\x8e\xad\xe8'
-    MAGIC_NUMBER_MATCHER = re.compile(b'(\x8e\xad\xe8)')
 
     TAGS = {}
 
-    def __init__(self, file):
-        """ read a RPM header structure with all its entries
+    def __init__(self, data, offset: int=0):
+        """ index a RPM header structure found in `data` (bytes or mmap) at `offset`
 
             Header format:
             [3bytes][1byte][4bytes][4bytes][4bytes]
@@ -140,30 +64,40 @@ class HeaderBase(object):
             Entry format:
             [4bytes][4bytes][4bytes][4bytes]
                TAG    TYPE   OFFSET  COUNT
+
+        Entries are only decoded when they are read.
         """
-        self.entries = []
-
-        # read from file if possible
-        if file:
-            # read and check header
-            start = file.tell()
-            header = struct.unpack('!3sc4sll', file.read(16))
-            if header[0] != self.MAGIC_NUMBER:
-                raise RPMError('invalid RPM header')
-
-            # read entries and store
-            entries = [file.read(16) for i in range(header[3])]
-            store = BytesIO(file.read(header[4]))
-
-            # parse entries
-            for entry in entries:
-                parsed_entry = struct.unpack("!4l", entry)
-                object_entry = Entry(parsed_entry, store)
-
-                if object_entry:
-                    self.entries.append(object_entry)
-            end = file.tell()
-            self.header_range = (start, end)
+        self.data = data
+        self.index = {}  # index[tag] = (type, offset in data, count)
+        self._values = {}  # decoded values
+        self.header_range = (offset, offset)
+        if data is None:
+            return
+        magic, _, _, index_count, store_size = struct.unpack_from('!3sc4sll', data, offset)
+        if magic != self.MAGIC_NUMBER:
+            raise RPMError('invalid RPM header')
+        store = offset + 16 + 16 * index_count
+        end = store + store_size
+        if index_count < 0 or store_size < 0 or end > len(data):
+            raise RPMError('truncated RPM header')
+        for tag, type_, entry_offset, count in struct.iter_unpack('!4l', memoryview(data)[offset + 16:store]):
+            self.index.setdefault(tag, (type_, store + entry_offset, count))
+        self.header_range = (offset, end)
+
+    def _decode(self, type_, offset, count):
+        data = self.data
+        if type_ == 0:
+            return None
+        elif type_ in (1, 7):  # char, binary
+            return bytes(memoryview(data)[offset:offset + count])
+        elif type_ in ENTRY_FORMATS:
+            value = struct.unpack_from('!%d%s' % (count, ENTRY_FORMATS[type_]), data, offset)
+            return value[0] if count == 1 else value
+        elif type_ in (6, 9):  # string, i18n string (only the first translation)
+            return _read_strings(data, offset, 1)[0]
+        elif type_ == 8:  # string array
+            return _read_strings(data, offset, count)
+        raise RPMError('unknown RPM header entry type %d' % type_)
 
     def __getattr__(self, name):
         if name in self.TAGS:
@@ -176,14 +110,25 @@ class HeaderBase(object):
         raise AttributeError(name)
 
     def __iter__(self):
-        for entry in self.entries:
-            yield entry
+        for tag, (type_, offset, count) in self.index.items():
+            yield Entry(tag=tag, type=type_, value=self[tag])
+
+    @property
+    def entries(self):
+        return list(self)
+
+    def __contains__(self, item):
+        return item in self.index
 
     def __getitem__(self, item):
-        for entry in self:
-            if entry.tag == item:
-                return entry.value
-        raise KeyError()
+        if item not in self._values:
+            self._values[item] = self._decode(*self.index[item])
+        return self._values[item]
+
+    def get_array(self, item) -> tuple:
+        """ return the value of an array entry, even if it has a single value """
+        value = self[item]
+        return value if isinstance(value, (tuple, list)) else (value, )
 
 
 # signature header section
@@ -240,8 +185,15 @@ class RPM(object):
     RPM_LEAD_MAGIC_NUMBER = b'\xed\xab\xee\xdb'
     RPM_PRCO_FLAGS_MAP = {0: None, 2: 'LT', 4: 'GT', 8: 'EQ', 10: 'LE', 12: 'GE'}
 
-    def __init__(self, rpm):
-        """ rpm - StringIO.StringIO/io.BytesIO | file
+    def __init__(self, rpm, headers_only: bool=False, checksum: str=None):
+        """ rpm - io.BytesIO | file
+
+        Real files are memory-mapped and parsed without copy; other objects are read up to the end of the header.
+        The memory map is kept for reading header values: use :meth:`close` (or a `with` statement) when done.
+        The given file is never closed.
+
+        :param headers_only: only check and index both headers (no file list, dependencies or checksum), for validation
+        :param checksum: SHA256 of the whole file when it is already known (it is otherwise computed)
         """
         if hasattr(rpm, 'read'):  # if it walk like a duck..
             self.rpmfile = rpm
@@ -259,12 +211,39 @@ class RPM(object):
         self.requires = []
         self.obsoletes = []
         self.conflicts = []
+        self.checksum = None
+        self.filesize = None
 
-        self._read_lead()
-        self._read_signature()
-        self._read_header()
-        self._match_composite()
-        self._compute_checksum()
+        self.data = self._map_file()
+        self._buffer = None if self.data is not None else bytearray()
+
+        try:
+            self._read_lead()
+            signature_offset = self._read_signature()
+            header_offset = self._read_header(signature_offset)
+            if self._buffer is not None:
+                self.data = bytes(self._buffer)
+                self._buffer = None
+            self.signature = Signature(self.data, signature_offset)
+            self.header = Header(self.data, header_offset)
+            if headers_only:
+                return
+            self._match_composite()
+            self._compute_checksum(checksum=checksum)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        """ release the memory map of the file; header values that are not decoded yet cannot be read anymore """
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
     @property
     def canonical_filename(self):
@@ -273,6 +252,30 @@ class RPM(object):
         else:
             return "%s-%s-%s-%d.%s.rpm" % (self.header.name, self.header.version, self.header.release, self.header.epoch, self.header.architecture if self.binary else "src")
 
+    def _map_file(self):
+        """ memory-map the whole RPM file, if it is a real (non-empty) file """
+        try:
+            return mmap.mmap(self.rpmfile.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, OSError, ValueError):
+            return None
+
+    def _ensure(self, size: int) -> bool:
+        """ make sure that the first `size` bytes of the file are available; return False at the end of the file """
+        if self._buffer is None:
+            return size <= len(self.data)
+        if len(self._buffer) == 0 and self.rpmfile.seekable():
+            self.rpmfile.seek(0)
+        while len(self._buffer) < size:
+            data = self.rpmfile.read(max(size - len(self._buffer), 65536))
+            if not data:
+                return False
+            self._buffer += data
+        return True
+
+    @property
+    def _available(self):
+        return self.data if self._buffer is None else self._buffer
+
     def _read_lead(self):
         """ reads the rpm lead section
 
@@ -288,8 +291,9 @@ class RPM(object):
                } ;
         """
         lead_fmt = '!4sBBhh66shh16s'
-        data = self.rpmfile.read(96)
-        value = struct.unpack(lead_fmt, data)
+        if not self._ensure(96):
+            raise RPMError('wrong magic number this is not a RPM file')
+        value = struct.unpack_from(lead_fmt, self._available, 0)
 
         magic_num = value[0]
         ptype = value[3]
@@ -306,122 +310,129 @@ class RPM(object):
         else:
             raise RPMError('wrong package type this is not a RPM file')
 
-    def _read_signature(self):
-        """ read signature header """
+    def _read_signature(self) -> int:
+        """ locate the signature header, return its offset """
 
         # find the start of the header
-        if not self._find_magic_number():
+        offset = self._find_magic_number(96)
+        if offset is None:
             raise RPMError('invalid RPM file, signature area not found')
+        return offset
 
-        # consume signature area
-        self.signature = Signature(self.rpmfile)
-
-    def _read_header(self):
-        """ read information header """
-
-        # find the start of the header
-        if not self._find_magic_number():
+    def _read_header(self, signature_offset: int) -> int:
+        """ locate the information header (after the signature header), return its offset """
+        offset = self._find_magic_number(self._header_end(signature_offset))
+        if offset is None:
             raise RPMError('invalid RPM file, header not found')
-
-        # consume header area
-        self.header = Header(self.rpmfile)
-
-    def _find_magic_number(self):
-        """ find a magic number in a buffer
+        # the whole header must be available
+        self._header_end(offset)
+        return offset
+
+    def _header_end(self, offset: int) -> int:
+        if not self._ensure(offset + 16):
+            raise RPMError('truncated RPM header')
+        index_count, store_size = struct.unpack_from('!ll', self._available, offset + 8)
+        end = offset + 16 + 16 * index_count + store_size
+        if index_count < 0 or store_size < 0 or not self._ensure(end):
+            raise RPMError('truncated RPM header')
+        return end
+
+    def _find_magic_number(self, offset: int):
+        """ find the offset of the next header magic number, starting at `offset`
         """
-        string = self.rpmfile.read(1)
         while True:
-            match = HeaderBase.MAGIC_NUMBER_MATCHER.search(string)
-            if match:
-                self.rpmfile.seek(-3, 1)
-                return True
-            byte = self.rpmfile.read(1)
-            if not byte:
-                return False
-            else:
-                string += byte
-        return False
+            position = self._available.find(HeaderBase.MAGIC_NUMBER, offset)
+            if position >= 0:
+                return position
+            elif not self._ensure(len(self._available) + 1):
+                return None
 
     def _match_composite(self):
+        header = self.header
         # files
         try:
-            for idx, name in enumerate(self.header[1117]):
-                dirname = self.header[1118][self.header[1116][idx]]
+            dirnames, dirindexes = header[1118], header.get_array(1116)
+            sizes, modes, rdevices, times = (header.get_array(x) for x in (1028, 1030, 1033, 1034))
+            digests, links, flags, usernames, groups = (header.get_array(x) for x in (1035, 1036, 1037, 1039, 1040))
+            verify_flags, devices, inodes, languages = (header.get_array(x) for x in (1045, 1095, 1096, 1097))
+            colors = header.get_array(1140) if 1140 in header else None
+            classes = header.get_array(1141) if 1142 in header and 1141 in header else None
+            class_dict = header[1142] if classes is not None else None
+            for idx, name in enumerate(header[1117]):
+                dirname = dirnames[dirindexes[idx]]
                 self.filelist.append(RPMFile(
                     name=dirname + name,
-                    size=self.header[1028][idx],
-                    mode=self.header[1030][idx],
-                    rdevice=self.header[1033][idx],
-                    time=self.header[1034][idx],
-                    digest=self.header[1035][idx],
-                    link_to=self.header[1036][idx],
-                    flags=self.header[1037][idx],
-                    username=self.header[1039][idx],
-                    group=self.header[1040][idx],
-                    verify_flags=self.header[1045][idx],
-                    device=self.header[1095][idx],
-                    inode=self.header[1096][idx],
-                    language=self.header[1097][idx],
-                    color=self.header[1140][idx] if 1140 in self.header else None,
-                    content_class=self.header[1142][self.header[1141][idx]] if 1142 in self.header and 1141 in self.header else None,
-                    type='dir' if stat.S_ISDIR(self.header[1030][idx] & 65535) else ('ghost' if (self.header[1037][idx] & 64) else 'file'),
+                    size=sizes[idx],
+                    mode=modes[idx],
+                    rdevice=rdevices[idx],
+                    time=times[idx],
+                    digest=digests[idx],
+                    link_to=links[idx],
+                    flags=flags[idx],
+                    username=usernames[idx],
+                    group=groups[idx],
+                    verify_flags=verify_flags[idx],
+                    device=devices[idx],
+                    inode=inodes[idx],
+                    language=languages[idx],
+                    color=colors[idx] if colors is not None else None,
+                    content_class=class_dict[classes[idx]] if classes is not None else None,
+                    type='dir' if stat.S_ISDIR(modes[idx] & 65535) else ('ghost' if (flags[idx] & 64) else 'file'),
                     primary=('bin/' in dirname or dirname.startswith('/etc/'))))
         except:
             pass
 
         # change log
         try:
-            if self.header[1081]:
-                for name, time, text in zip(self.header[1081], self.header[1080], self.header[1082]):
+            if header[1081]:
+                for name, time, text in zip(header[1081], header.get_array(1080), header[1082]):
                     self.changelog.append(RPMChangeLog(name=name, time=time, text=text))
         except:
             pass
 
-        # provides
-        try:
-            if self.header[1047]:
-                for name, flags, version in zip(self.header[1047], self.header[1112], self.header[1113]):
-                    self.provides.append(
-                        RPMprco(name=name, flags=flags, str_flags=self.RPM_PRCO_FLAGS_MAP[flags & 0xf], version=self._stringToVersion(version)))
-        except:
-            pass
-
-        # requires
-        try:
-            if self.header[1049]:
-                for name, flags, version in zip(self.header[1049], self.header[1048], self.header[1050]):
-                    self.requires.append(
-                        RPMprco(name=name, flags=flags, str_flags=self.RPM_PRCO_FLAGS_MAP[flags & 0xf], version=self._stringToVersion(version)))
-        except:
-            pass
-
-        # obsoletes
-        try:
-            if self.header[1090]:
-                for name, flags, version in zip(self.header[1090], self.header[1114], self.header[1115]):
-                    self.obsoletes.append(
-                        RPMprco(name=name, flags=flags, str_flags=self.RPM_PRCO_FLAGS_MAP[flags & 0xf], version=self._stringToVersion(version)))
-        except:
-            pass
-
-        # conflicts
-        try:
-            if self.header[1054]:
-                for name, flags, version in zip(self.header[1054], self.header[1053], self.header[1055]):
-                    self.conflicts.append(
-                        RPMprco(name=name, flags=flags, str_flags=self.RPM_PRCO_FLAGS_MAP[flags & 0xf], version=self._stringToVersion(version)))
-        except:
-            pass
-
-    def _compute_checksum(self):
+        # provides, requires, obsoletes, conflicts: (attribute, name tag, flags tag, version tag)
+        for attr_name, names, flags, versions in (('provides', 1047, 1112, 1113), ('requires', 1049, 1048, 1050),
+                                                  ('obsoletes', 1090, 1114, 1115), ('conflicts', 1054, 1053, 1055)):
+            try:
+                if header[names]:
+                    getattr(self, attr_name).extend(
+                        RPMprco(name=name, flags=flag, str_flags=self.RPM_PRCO_FLAGS_MAP[flag & 0xf],
+                                version=self._stringToVersion(version))
+                        for name, flag, version in zip(header[names], header.get_array(flags), header[versions]))
+            except:
+                pass
+
+    def _compute_checksum(self, checksum: str=None):
+        if isinstance(self.data, mmap.mmap):
+            self.filesize = len(self.data)
+            if checksum is None:
+                # hashed by bounded slices, to avoid keeping the whole file in the resident memory
+                m = hashlib.sha256()
+                view = memoryview(self.data)
+                try:
+                    for offset in range(65536, self.filesize + 65536, 65536):
+                        m.update(view[offset - 65536:offset])
+                        if offset % MAPPED_WINDOW == 0 and hasattr(mmap, 'MADV_DONTNEED'):
+                            # hashed pages are released (they are read again from the file if needed)
+                            self.data.madvise(mmap.MADV_DONTNEED, offset - MAPPED_WINDOW, MAPPED_WINDOW)
+                finally:
+                    view.release()
+                checksum = m.hexdigest()
+            self.checksum = checksum
+            return
+        elif checksum:
+            self.filesize = self.rpmfile.seek(0, io.SEEK_END)
+            self.checksum = checksum
+            return
+        # the file is read by bounded chunks
         self.rpmfile.seek(0)
         m = hashlib.sha256()
         size = 0
-        data = self.rpmfile.read()
+        data = self.rpmfile.read(65536)
         while data:
             size += len(data)
             m.update(data)
-            data = self.rpmfile.read()
+            data = self.rpmfile.read(65536)
         self.filesize = size
         self.checksum = m.hexdigest()
 
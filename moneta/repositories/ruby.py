@@ -37,6 +37,7 @@ from yaml.scanner import Scanner
 
 from moneta.repositories.aptitude import Aptitude
 from moneta.repositories.base import RepositoryModel
+from moneta.repositories.scheduler import index_scheduler
 from moneta.repository.models import ArchiveState, Element, Repository, storage
 from moneta.templatetags.moneta import moneta_url
 from moneta.views import sendpath
@@ -159,7 +160,6 @@ class RubyGem(Aptitude):
         :param states: list of ArchiveState
         """
         RepositoryModel.finish_element(self, element, states)
-        # self.generate_indexes(element.repository)
 
     def is_file_valid(self, uploaded_file: UploadedFile):
         if not uploaded_file.name.endswith('.gem'):
@@ -251,13 +251,14 @@ class RubyGem(Aptitude):
         # noinspection PyUnusedLocal
         repo_slug = repo_slug
         repo = get_object_or_404(Repository.reader_queryset(request), id=rid, archive_type=self.archive_type)
+        index_scheduler.ensure_fresh(repo)
         if state_slug:
             filename = 'specs/%(slug)s/%(filename)s' % {'slug': state_slug, 'filename': filename, }
         else:
             filename = 'specs/%(filename)s' % {'filename': filename, }
         uid = self.storage_uid % repo.pk
         key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
-        return sendpath(settings.STORAGE_CACHE, key, filename, 'application/gzip')
+        return sendpath(settings.STORAGE_CACHE, key, filename, 'application/gzip', request=request)
 
     def quick_gem_specs(self, request, rid, repo_slug, state_slug=None, filename=None, compression=''):
         name, sep, version = filename.rpartition('-')
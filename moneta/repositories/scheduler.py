@@ -0,0 +1,266 @@
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.utils.translation import gettext as _
+
+from moneta.repository.models import Repository, storage
+from moneta.utils import makedir
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+__author__ = 'flanker'
+
+logger = logging.getLogger('moneta.files')
+
+
+class IndexScheduler(object):
+    """ Coalesce the index rebuilds of modified repositories.
+
+    A repository marked as dirty is rebuilt once no change happened during `settings.INDEX_REBUILD_QUIET_PERIOD`
+    seconds, or at most `settings.INDEX_REBUILD_MAX_DELAY` seconds after its first unpublished change.
+    If `settings.INDEX_REBUILD_QUIET_PERIOD` is None, indexes are only rebuilt by :meth:`run_pending`.
+
+    When `settings.INDEX_PUBLISHING` is `'lazy'`, a modified repository is only marked as stale (in the cache storage,
+    so all processes share this information) and its indexes are rebuilt by the first request that reads them
+    (see :meth:`ensure_fresh`).
+
+    Builds of a given repository never run in parallel, even across worker processes (see :meth:`build_indexes`).
+    """
+    stale_marker = 'STALE'
+    dirty_marker = 'DIRTY'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # _dirty[repository id] = (timestamp of the first change, timestamp of the last change)
+        # only a local copy of the DIRTY markers (shared by all processes) written by this process, to start the timer
+        self._dirty = {}
+        self._timer = None
+        self._flights = {}  # _flights[repository id] = threading.Event set when the in-flight build is done
+        self._build_locks = {}  # _build_locks[repository id] = threading.Lock, only used when fcntl is unavailable
+
+    def mark_dirty(self, repository: Repository, now: float=None):
+        """ Record a change of the repository.
+
+        The dates of its first and last unpublished changes are stored in the cache storage, so pending rebuilds
+        survive the end of this process and are visible to all processes (and to the `rebuild_indexes` command).
+        """
+        if now is None:
+            now = time.time()
+        if settings.INDEX_PUBLISHING == 'lazy':
+            self.mark_stale(repository, now=now)
+            return
+        with self._lock:
+            first_change = (self.dirty_dates(repository) or (now, now))[0]
+            if not self._write_marker(repository, self.dirty_marker, json.dumps([first_change, now])):
+                return
+            self._dirty[repository.id] = (first_change, now)
+            self._schedule(now)
+
+    def dirty_dates(self, repository: Repository):
+        """ Return (timestamp of the first change, timestamp of the last change) if the repository is dirty """
+        content = self._read_marker(repository, self.dirty_marker)
+        try:
+            first_change, last_change = json.loads(content)
+            return first_change, last_change
+        except (TypeError, ValueError):
+            return None
+
+    def is_dirty(self, repository: Repository) -> bool:
+        return self.dirty_dates(repository) is not None
+
+    @staticmethod
+    def _due_date(dates):
+        first_change, last_change = dates
+        return min(last_change + (settings.INDEX_REBUILD_QUIET_PERIOD or 0),
+                   first_change + settings.INDEX_REBUILD_MAX_DELAY)
+
+    def _schedule(self, now):
+        """ (re)start the timer for the next due rebuild; must be called with the lock """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if settings.INDEX_REBUILD_QUIET_PERIOD is None or not self._dirty:
+            return
+        delay = max(0., min(self._due_date(x) for x in self._dirty.values()) - now)
+        self._timer = threading.Timer(delay, self._run_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run_timer(self):
+        try:
+            self.run_pending()
+        finally:
+            connection.close()  # this thread has its own database connection
+
+    def run_pending(self, now: float=None, force: bool=False) -> list:
+        """ Rebuild the indexes of all dirty repositories whose delay has expired (all dirty repositories if `force`),
+        including the ones marked by other processes.
+
+        :return: the list of rebuilt repository ids
+        """
+        if now is None:
+            now = time.time()
+        repositories = []
+        with self._lock:
+            for repository in Repository.objects.all():
+                dates = self.dirty_dates(repository)
+                if dates is None:
+                    self._dirty.pop(repository.id, None)  # already rebuilt by another process
+                    continue
+                if repository.id in self._dirty:
+                    self._dirty[repository.id] = dates
+                if force or self._due_date(dates) <= now:
+                    # changes that happen during the build will mark the repository as dirty again
+                    self._delete_marker(repository, self.dirty_marker)
+                    self._dirty.pop(repository.id, None)
+                    repositories.append(repository)
+        for repository in repositories:
+            self.rebuild(repository)
+        with self._lock:
+            self._schedule(time.time())
+        return [x.id for x in repositories]
+
+    @staticmethod
+    def _index_uid(repository: Repository):
+        storage_uid = getattr(repository.get_model(), 'storage_uid', None)
+        if storage_uid is None:  # this kind of repository has no index
+            return None
+        return storage_uid % repository.id
+
+    def _write_marker(self, repository: Repository, name: str, content: str) -> bool:
+        uid = self._index_uid(repository)
+        if uid is None:
+            return False
+        storage(settings.STORAGE_CACHE).store_descriptor(uid, name, io.BytesIO(content.encode('utf-8')))
+        return True
+
+    def _read_marker(self, repository: Repository, name: str):
+        uid = self._index_uid(repository)
+        if uid is None:
+            return None
+        cache_storage = storage(settings.STORAGE_CACHE)
+        fileobj = cache_storage.get_file(cache_storage.uid_to_key(uid), name)
+        if fileobj is None:
+            return None
+        try:
+            return fileobj.read().decode('utf-8')
+        finally:
+            fileobj.close()
+
+    def _delete_marker(self, repository: Repository, name: str):
+        uid = self._index_uid(repository)
+        if uid is not None:
+            cache_storage = storage(settings.STORAGE_CACHE)
+            cache_storage.delete(os.path.join(cache_storage.uid_to_key(uid), name))
+
+    def mark_stale(self, repository: Repository, now: float=None):
+        self._write_marker(repository, self.stale_marker, str(now or time.time()))
+
+    def is_stale(self, repository: Repository) -> bool:
+        return self._read_marker(repository, self.stale_marker) is not None
+
+    def ensure_fresh(self, repository: Repository):
+        """ In lazy mode, rebuild the indexes of a stale repository before they are read.
+
+        Only one build runs at a time for a given repository (single-flight): concurrent requests wait for it (at
+        most `settings.INDEX_LAZY_TIMEOUT` seconds) and are then served the current generation of index files.
+        """
+        if settings.INDEX_PUBLISHING != 'lazy' or not self.is_stale(repository):
+            return
+        with self._lock:
+            flight = self._flights.get(repository.id)
+            leader = flight is None
+            if leader:
+                flight = self._flights[repository.id] = threading.Event()
+        if not leader:
+            flight.wait(settings.INDEX_LAZY_TIMEOUT)
+            return
+        # noinspection PyBroadException
+        try:
+            # changes that happen during the build will mark the repository as stale again
+            self._delete_marker(repository, self.stale_marker)
+            self.build_indexes(repository)
+        except Exception:
+            self.mark_stale(repository)  # the next request will try again
+            logger.error(_('Unable to rebuild the indexes of %(repo)s') % {'repo': repository.name}, exc_info=True)
+        finally:
+            with self._lock:
+                del self._flights[repository.id]
+            flight.set()
+
+    def rebuild(self, repository: Repository):
+        # noinspection PyBroadException
+        try:
+            self.build_indexes(repository)
+        except Exception:
+            self.mark_dirty(repository)  # will be tried again
+            logger.error(_('Unable to rebuild the indexes of %(repo)s') % {'repo': repository.name}, exc_info=True)
+
+    @staticmethod
+    def _lock_path(repository_id):
+        return os.path.join(settings.INDEX_LOCK_DIR, 'repository-%s.lock' % repository_id)
+
+    def _try_lock(self, repository_id):
+        """ return a handle on the build lock of the repository, or None if another build holds it """
+        if fcntl is None:
+            with self._lock:
+                lock = self._build_locks.setdefault(repository_id, threading.Lock())
+            return lock if lock.acquire(blocking=False) else None
+        fd = open(self._lock_path(repository_id), 'ab')
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fd.close()
+            return None
+        return fd
+
+    @staticmethod
+    def _unlock(handle):
+        if fcntl is None:
+            handle.release()
+        else:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+            handle.close()
+
+    def build_indexes(self, repository: Repository) -> bool:
+        """ Rebuild the indexes of the repository, unless another thread or process is already building them.
+
+        In this case, the running build is asked to start again once it is done (so the published indexes include
+        all changes), and this call returns immediately. Many requests made during a build only lead to a single
+        extra build.
+
+        :return: `True` if the indexes have been rebuilt by this call
+        """
+        makedir(settings.INDEX_LOCK_DIR)
+        pending_path = self._lock_path(repository.id) + '.pending'
+        open(pending_path, 'ab').close()
+        result = False
+        # the build lock is released before the last check of the pending flag, so a request made between these two
+        # operations can take the lock itself
+        while os.path.isfile(pending_path):
+            handle = self._try_lock(repository.id)
+            if handle is None:  # the current owner of the lock will see the pending flag
+                break
+            try:
+                while os.path.isfile(pending_path):
+                    try:
+                        os.remove(pending_path)
+                    except FileNotFoundError:
+                        pass
+                    repository.get_model().generate_indexes(repository)
+                    result = True
+            finally:
+                self._unlock(handle)
+        return result
+
+
+index_scheduler = IndexScheduler()
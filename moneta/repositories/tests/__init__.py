@@ -1,15 +1,17 @@
 import os
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import UploadedFile
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from moneta.repositories.base import RepositoryModel
-from moneta.repository.models import Repository, ArchiveState
+from moneta.repository.models import Repository, ArchiveState, storage
 from moneta.views import generic_add_element
 
 __author__ = 'flanker'
 
 
+@override_settings(INDEX_REBUILD_QUIET_PERIOD=None)  # indexes are not rebuilt in background threads
 class RepositoryTestCase(TestCase):
 
     def get_request(self):
@@ -24,6 +26,10 @@ class RepositoryTestCase(TestCase):
             author = User.objects.get_or_create(username='test_user')[0]
         repo = Repository(author=author, name=name, on_index=True, archive_type=repo_cls.archive_type, is_private=False)
         repo.save()
+        storage_uid = getattr(repo_cls, 'storage_uid', None)
+        if storage_uid:  # remove index files left by previous tests (ids are reused)
+            cache_storage = storage(settings.STORAGE_CACHE)
+            cache_storage.delete(cache_storage.uid_to_key(storage_uid % repo.id))
         for state in states.split():
             ArchiveState(repository=repo, name=state, author=author).save()
         return repo
@@ -35,3 +41,9 @@ class RepositoryTestCase(TestCase):
         request = self.get_request()
         element = generic_add_element(request, repo, uploaded_file, states, name=name, archive=archive, version=version, )
         return element
+
+    @staticmethod
+    def index_key(model, repo):
+        """ key of the current generation of index files in the cache storage """
+        uid = model.storage_uid % repo.id
+        return os.path.join(storage(settings.STORAGE_CACHE).uid_to_key(uid), model.generation_prefix(uid))
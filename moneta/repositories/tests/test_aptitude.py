@@ -1,6 +1,16 @@
+import bz2
+import gzip
+import hashlib
+import lzma
+import os
+
 import pkg_resources
+from django.conf import settings
+from django.test import override_settings
+
 from moneta.repositories.aptitude import Aptitude
 from moneta.repositories.tests import RepositoryTestCase
+from moneta.repository.models import storage, Element, ArchiveState
 
 __author__ = 'flanker'
 
@@ -18,3 +28,235 @@ class TestYumRpm(RepositoryTestCase):
         self.add_file_to_repository(repo, filename)
         aptitude = Aptitude()
         aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        filename = 'dists/%s/qualif/binary-mips/Packages' % repo.slug
+        with storage(settings.STORAGE_CACHE).get_file(key, filename) as fd:
+            content = fd.read()
+        self.assertIn(b'Package: lib3ds-dev', content)
+        for extension, decompress in (('.gz', gzip.decompress), ('.bz2', bz2.decompress), ('.xz', lzma.decompress)):
+            with storage(settings.STORAGE_CACHE).get_file(key, filename + extension) as fd:
+                self.assertEqual(content, decompress(fd.read()))
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            self.assertIn(hashlib.sha256(content).hexdigest().encode(), fd.read())
+
+    def test_incremental_index(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = self.index_key(aptitude, repo)
+        filename = 'dists/%s/qualif/binary-mips/Packages' % repo.slug
+        with cache_storage.get_file(key, filename) as fd:
+            content = fd.read()
+        # unchanged files are not rewritten
+        mtime = cache_storage.get_mtime(key, filename)
+        os.utime(cache_storage.get_path(key, filename), (mtime - 100, mtime - 100))
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        self.assertEqual(mtime - 100, cache_storage.get_mtime(key, filename))
+        with cache_storage.get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            release = fd.read()
+        self.assertIn(hashlib.sha256(content).hexdigest().encode(), release)
+        self.assertIn(b'Contents-mips.gz', release)
+        # files are rebuilt when codecs change
+        repo.index_compression = 'gz:6'
+        repo.save()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        self.assertNotEqual(mtime - 100, cache_storage.get_mtime(key, filename))
+        with cache_storage.get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            release = fd.read()
+        self.assertIn(b'Packages.gz', release)
+        self.assertNotIn(b'Packages.xz', release)
+
+    def test_file_list(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        element = self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        key = storage(settings.STORAGE_CACHE).uid_to_key(aptitude.storage_uid % repo.id)
+        # the file list is extracted at upload time
+        with storage(settings.STORAGE_CACHE).get_file(key, aptitude.file_list_filename(element.sha256)) as fd:
+            names = gzip.decompress(fd.read()).decode('utf-8').splitlines()
+        self.assertIn('usr/include/lib3ds/types.h', names)
+        self.assertEqual(sorted(names), names)
+        self.assertEqual(names, aptitude.file_list(element, aptitude.storage_uid % repo.id))
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/Contents-mips' % repo.slug) as fd:
+            lines = fd.read().decode('utf-8').splitlines()
+        # the package belongs to two states
+        self.assertEqual(2 * len(names), len(lines))
+        self.assertEqual(sorted(lines), lines)
+        self.assertIn('%- 100s%s' % ('usr/include/lib3ds/types.h', 'libdevel'), lines)
+
+    def test_by_hash(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/qualif/binary-mips/Packages.xz' % repo.slug) as fd:
+            content = fd.read()
+        digest = hashlib.sha256(content).hexdigest()
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            self.assertIn(b'Acquire-By-Hash: yes', fd.read())
+        request = self.get_request()
+        request.method = 'GET'
+        response = aptitude.by_hash(request, repo.id, repo.slug, 'qualif/binary-mips/', digest)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('public', response['Cache-Control'])
+        self.assertEqual(content, b''.join(response.streaming_content))
+        # previous copies are kept for one generation
+        repo.index_compression = 'gz:9'
+        repo.save()
+        aptitude.generate_indexes(repo)
+        by_hash = 'dists/%s/qualif/binary-mips/by-hash/SHA256/%s' % (repo.slug, digest)
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        self.assertTrue(os.path.isfile(storage(settings.STORAGE_CACHE).get_path(key, by_hash)))
+        repo.index_compression = 'gz:6'
+        repo.save()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        self.assertFalse(os.path.isfile(storage(settings.STORAGE_CACHE).get_path(key, by_hash)))
+
+    def test_by_hash_generations(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/qualif/binary-mips/Packages.xz' % repo.slug) as fd:
+            digest = hashlib.sha256(fd.read()).hexdigest()
+        repo.index_compression = 'gz:9'
+        repo.save()
+        aptitude.generate_indexes(repo)
+        # the file is only available in the previous generation
+        by_hash = 'dists/%s/qualif/binary-mips/by-hash/SHA256/%s' % (repo.slug, digest)
+        storage(settings.STORAGE_CACHE).delete(os.path.join(self.index_key(aptitude, repo), by_hash))
+        request = self.get_request()
+        request.method = 'GET'
+        response = aptitude.by_hash(request, repo.id, repo.slug, 'qualif/binary-mips/', digest)
+        self.assertEqual(200, response.status_code)
+
+    def test_by_hash_private(self):
+        repo = self.create_repository(Aptitude)
+        repo.is_private = True
+        repo.save()
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/qualif/binary-mips/Packages.xz' % repo.slug) as fd:
+            digest = hashlib.sha256(fd.read()).hexdigest()
+        request = self.get_request()
+        request.method = 'GET'
+        response = aptitude.by_hash(request, repo.id, repo.slug, 'qualif/binary-mips/', digest)
+        self.assertEqual(200, response.status_code)
+        self.assertIn('private', response['Cache-Control'])
+        self.assertNotIn('public', response['Cache-Control'])
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_pdiff(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        element = self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        filename = 'dists/%s/qualif/binary-mips/Packages' % repo.slug
+        with storage(settings.STORAGE_CACHE).get_file(key, filename) as fd:
+            previous_content = fd.read()
+        # the Filename field of the package changes
+        Element.objects.filter(id=element.id).update(filename='lib3ds-dev_1.3.0-9_mips.deb')
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, filename) as fd:
+            content = fd.read()
+        self.assertNotEqual(previous_content, content)
+        with storage(settings.STORAGE_CACHE).get_file(key, filename + '.diff/Index') as fd:
+            index = fd.read().decode()
+        self.assertIn('SHA256-Current: %s' % hashlib.sha256(content).hexdigest(), index)
+        self.assertIn(' %s ' % hashlib.sha256(previous_content).hexdigest(), index)
+        patch_name = index.splitlines()[-1].split()[-1]
+        with storage(settings.STORAGE_CACHE).get_file(key, filename + '.diff/' + patch_name) as fd:
+            patch = gzip.decompress(fd.read())
+        self.assertEqual(b'25c\nFilename: pool/test_repo/qualif/l/lib3ds-dev_1.3.0-9_mips.deb\n.\n', patch)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            self.assertIn(b'qualif/binary-mips/Packages.diff/Index\n', fd.read())
+
+    @override_settings(INDEX_TRANSLATIONS=True)
+    def test_translations(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        element = self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        aptitude.generate_indexes(repo)
+        key = self.index_key(aptitude, repo)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/qualif/binary-mips/Packages' % repo.slug) as fd:
+            packages = fd.read().decode()
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/qualif/i18n/Translation-en' % repo.slug) as fd:
+            translation = fd.read().decode()
+        description = element.extra_data.partition('Description: ')[2]
+        md5 = hashlib.md5(description.encode()).hexdigest()
+        self.assertIn('Description: %s\nDescription-md5: %s\n' % (description.splitlines()[0], md5), packages)
+        self.assertNotIn(description.splitlines()[1], packages)
+        self.assertEqual('Package: lib3ds-dev\nDescription-md5: %s\nDescription-en: %s\n' % (md5, description),
+                         translation)
+        with storage(settings.STORAGE_CACHE).get_file(key, 'dists/%s/Release' % repo.slug) as fd:
+            self.assertIn(b' qualif/i18n/Translation-en.xz\n', fd.read())
+
+    @override_settings(INDEX_GENERATIONS=1)
+    def test_generations(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        uid = aptitude.storage_uid % repo.id
+        cache_storage = storage(settings.STORAGE_CACHE)
+        filename = 'dists/%s/qualif/binary-mips/Packages' % repo.slug
+        for index in range(3):
+            repo.index_compression = 'gz:%d' % (index + 1)
+            repo.save()
+            aptitude.generate_indexes(repo)
+        generations = aptitude.generations(uid)
+        self.assertEqual(2, len(generations))
+        self.assertEqual(sorted(generations),
+                         sorted(os.listdir(cache_storage.get_path(cache_storage.uid_to_key(uid), 'generations'))))
+        # files of the previous generation are still available
+        for generation in generations:
+            with cache_storage.get_file(cache_storage.uid_to_key(uid), 'generations/%s/%s' % (generation, filename)) \
+                    as fd:
+                self.assertIn(b'Package: lib3ds-dev', fd.read())
+        request = self.get_request()
+        request.method = 'GET'
+        response = aptitude.repo_release(request, repo.id, repo.slug, 'Release')
+        with cache_storage.get_file(self.index_key(aptitude, repo), 'dists/%s/Release' % repo.slug) as fd:
+            self.assertEqual(fd.read(), b''.join(response.streaming_content))
+
+    def test_skip_unchanged(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        element = self.add_file_to_repository(repo, filename)
+        aptitude = Aptitude()
+        uid = aptitude.storage_uid % repo.id
+        aptitude.generate_indexes(repo)
+        generations = aptitude.generations(uid)
+        aptitude.generate_indexes(repo)
+        self.assertEqual(generations, aptitude.generations(uid))
+        # a state is modified
+        element.states.remove(ArchiveState.objects.get(repository=repo, name='prod'))
+        aptitude.generate_indexes(repo)
+        self.assertEqual(2, len(aptitude.generations(uid)))
+        # Release files must be signed again before their expiration
+        generations = aptitude.generations(uid)
+        aptitude.generate_indexes(repo, validity=0)
+        self.assertNotEqual(generations, aptitude.generations(uid))
+
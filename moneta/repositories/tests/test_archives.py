@@ -0,0 +1,37 @@
+import io
+import tarfile
+import time
+import zipfile
+
+from django.test import TestCase
+
+from moneta.archives import stream_archive
+
+__author__ = 'flanker'
+
+
+class TestStreamArchive(TestCase):
+    contents = {'a.txt': b'', 'dir/b.bin': bytes(range(256)) * 1000, 'dir/c.txt': b'c' * 513}
+
+    def members(self):
+        for name, content in sorted(self.contents.items()):
+            yield name, len(content), 1500000000, io.BytesIO(content)
+
+    def test_zip(self):
+        data = b''.join(stream_archive(self.members(), 'zip', bufsize=1000))
+        with zipfile.ZipFile(io.BytesIO(data)) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(self.contents, {x: zip_file.read(x) for x in zip_file.namelist()})
+
+    def test_tar(self):
+        for compression in ('tgz', 'tbz'):
+            chunks = list(stream_archive(self.members(), compression, bufsize=1000))
+            self.assertGreater(len(chunks), 100)
+            with tarfile.open(fileobj=io.BytesIO(b''.join(chunks)), mode='r:*') as tar_file:
+                self.assertEqual(self.contents, {x.name: tar_file.extractfile(x).read() for x in tar_file})
+
+    def test_deterministic(self):
+        first = {x: b''.join(stream_archive(self.members(), x)) for x in ('zip', 'tgz', 'tbz')}
+        time.sleep(1.1)  # the gzip header would record a different timestamp
+        for compression, data in first.items():
+            self.assertEqual(data, b''.join(stream_archive(self.members(), compression)))
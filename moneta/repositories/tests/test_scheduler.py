@@ -0,0 +1,131 @@
+import os
+import tempfile
+import threading
+
+import pkg_resources
+from django.test import override_settings
+
+from moneta.repositories.aptitude import Aptitude
+from moneta.repositories.scheduler import IndexScheduler, index_scheduler, fcntl
+from moneta.repositories.tests import RepositoryTestCase
+
+__author__ = 'flanker'
+
+
+class ManualScheduler(IndexScheduler):
+    """ scheduler without background thread """
+    def _schedule(self, now):
+        pass
+
+
+class TestIndexScheduler(RepositoryTestCase):
+
+    @override_settings(INDEX_REBUILD_QUIET_PERIOD=10, INDEX_REBUILD_MAX_DELAY=60)
+    def test_debounce(self):
+        repo = self.create_repository(Aptitude)
+        scheduler = ManualScheduler()
+        scheduler.mark_dirty(repo, now=1000.)
+        scheduler.mark_dirty(repo, now=1005.)
+        # the quiet period is not over
+        self.assertEqual([], scheduler.run_pending(now=1014.))
+        # successive changes cannot delay the rebuild for more than INDEX_REBUILD_MAX_DELAY
+        for now in range(1010, 1060, 5):
+            scheduler.mark_dirty(repo, now=now)
+        self.assertEqual([], scheduler.run_pending(now=1059.))
+        self.assertEqual([repo.id], scheduler.run_pending(now=1060.))
+        self.assertFalse(scheduler.is_dirty(repo))
+        scheduler.mark_dirty(repo, now=2000.)
+        self.assertEqual([repo.id], scheduler.run_pending(now=2010.))
+
+    @override_settings(INDEX_REBUILD_QUIET_PERIOD=10, INDEX_REBUILD_MAX_DELAY=60)
+    def test_shared_marks(self):
+        repo = self.create_repository(Aptitude)
+        ManualScheduler().mark_dirty(repo, now=1000.)
+        # the process that recorded the change is gone: any other process (or the rebuild_indexes command) rebuilds
+        scheduler = ManualScheduler()
+        self.assertTrue(scheduler.is_dirty(repo))
+        self.assertEqual([], scheduler.run_pending(now=1005.))
+        self.assertEqual([repo.id], scheduler.run_pending(now=1010.))
+        self.assertFalse(scheduler.is_dirty(repo))
+        self.assertEqual(1, len(Aptitude().generations(Aptitude.storage_uid % repo.id)))
+
+    def test_upload(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        self.assertTrue(index_scheduler.is_dirty(repo))
+        self.assertIn(repo.id, index_scheduler.run_pending(force=True))
+        self.assertEqual(1, len(Aptitude().generations(Aptitude.storage_uid % repo.id)))
+
+    @override_settings(INDEX_PUBLISHING='lazy')
+    def test_lazy(self):
+        repo = self.create_repository(Aptitude)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', 'lib3ds-dev_1.3.0-8_mips.deb')
+        self.add_file_to_repository(repo, filename)
+        self.assertTrue(index_scheduler.is_stale(repo))
+        # the first read rebuilds the indexes
+        request = self.get_request()
+        request.method = 'GET'
+        response = Aptitude().repo_release(request, repo.id, repo.slug, 'Release')
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(index_scheduler.is_stale(repo))
+
+    @override_settings(INDEX_PUBLISHING='lazy', INDEX_LAZY_TIMEOUT=10)
+    def test_single_flight(self):
+        repo = self.create_repository(Aptitude)
+        started, finished = threading.Event(), threading.Event()
+        builds = []
+
+        class BlockingScheduler(ManualScheduler):
+            def build_indexes(self, repository):
+                builds.append(repository.id)
+                started.set()
+                finished.wait(10)
+
+        scheduler = BlockingScheduler()
+        scheduler.mark_dirty(repo)
+        leader = threading.Thread(target=scheduler.ensure_fresh, args=(repo,))
+        leader.start()
+        started.wait(10)
+        # the marker is removed as soon as the build starts, a new change would mark it again
+        scheduler.mark_stale(repo)
+        follower = threading.Thread(target=scheduler.ensure_fresh, args=(repo,))
+        follower.start()
+        follower.join(0.2)
+        self.assertTrue(follower.is_alive())  # waits for the in-flight build
+        finished.set()
+        leader.join(10)
+        follower.join(10)
+        self.assertEqual([repo.id], builds)
+
+    def test_build_lock(self):
+        repo = self.create_repository(Aptitude)
+        scheduler = ManualScheduler()
+        with tempfile.TemporaryDirectory() as lock_dir, self.settings(INDEX_LOCK_DIR=lock_dir):
+            lock_path = os.path.join(lock_dir, 'repository-%s.lock' % repo.id)
+            handle = scheduler._try_lock(repo.id)  # another worker is building the indexes
+            self.assertIsNotNone(handle)
+            self.assertFalse(scheduler.build_indexes(repo))
+            self.assertFalse(scheduler.build_indexes(repo))
+            # both requests are recorded as a single pending rebuild
+            self.assertTrue(os.path.isfile(lock_path + '.pending'))
+            scheduler._unlock(handle)
+            self.assertTrue(scheduler.build_indexes(repo))
+            self.assertFalse(os.path.isfile(lock_path + '.pending'))
+            if fcntl is not None:
+                self.assertTrue(os.path.isfile(lock_path))
+        self.assertEqual(1, len(Aptitude().generations(Aptitude.storage_uid % repo.id)))
+
+    @override_settings(INDEX_PUBLISHING='lazy')
+    def test_lazy_failure(self):
+        repo = self.create_repository(Aptitude)
+
+        class FailingScheduler(ManualScheduler):
+            def build_indexes(self, repository):
+                raise ValueError
+
+        scheduler = FailingScheduler()
+        scheduler.mark_dirty(repo)
+        scheduler.ensure_fresh(repo)
+        # the build failed: the next request will try again
+        self.assertTrue(scheduler.is_stale(repo))
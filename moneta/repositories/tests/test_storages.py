@@ -0,0 +1,179 @@
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+
+from unittest import skipIf
+
+from django.test import TestCase
+
+from moneta.repository.storages import ContentAddressedStorage, S3Storage, CachedStorage, boto3
+
+__author__ = 'flanker'
+
+
+class TestContentAddressedStorage(TestCase):
+    content = b'0123456789' * 1000
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = ContentAddressedStorage(ROOT=self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_deduplication(self):
+        key1 = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(self.content))
+        key2 = self.storage.store_descriptor('uid2', 'other.bin', io.BytesIO(self.content))
+        path1, path2 = self.storage.get_path(key1, ''), self.storage.get_path(key2, '')
+        self.assertTrue(os.path.samefile(path1, path2))
+        self.assertEqual(3, os.stat(path1).st_nlink)
+        with self.storage.get_file(key2) as fd:
+            self.assertEqual(self.content, fd.read())
+        self.storage.delete(key1)
+        self.assertFalse(os.path.exists(path1))
+        self.assertEqual(2, os.stat(path2).st_nlink)
+        self.storage.delete(key2)
+        self.assertEqual([], os.listdir(os.path.join(self.root, ContentAddressedStorage.BLOB_DIR, '4c')))
+
+    def test_overwrite(self):
+        key = self.storage.uid_to_key('uid1')
+        blob_dir = os.path.join(self.root, ContentAddressedStorage.BLOB_DIR)
+        for content in (self.content, b'new content', b'new content'):
+            with tempfile.NamedTemporaryFile(mode='wb', dir=self.root, delete=False) as fd:
+                fd.write(content)
+            self.storage.import_filename(fd.name, key, 'Packages')
+        # the blob of the previous content is released
+        self.assertEqual([hashlib.sha256(b'new content').hexdigest()],
+                         [name for root, dirs, files in os.walk(blob_dir) for name in files])
+        self.assertEqual(2, os.stat(self.storage.get_path(key, 'Packages')).st_nlink)
+
+    def test_write_mode(self):
+        key1 = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(self.content))
+        key2 = self.storage.store_descriptor('uid2', 'file.bin', io.BytesIO(self.content))
+        with self.storage.get_file(key1, mode='wb') as fd:
+            fd.write(b'new content')
+        with self.storage.get_file(key2) as fd:
+            self.assertEqual(self.content, fd.read())
+
+
+try:
+    # noinspection PyPackageRequirements
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+
+@skipIf(mock_aws is None or boto3 is None, 'moto and boto3 are required')
+class TestS3Storage(TestCase):
+    content = b'0123456789' * 600000
+
+    def setUp(self):
+        self.mock = mock_aws()
+        self.mock.start()
+        self.storage = S3Storage(BUCKET='moneta', PREFIX='files', REGION_NAME='us-east-1', ACCESS_KEY_ID='key',
+                                 SECRET_ACCESS_KEY='secret', PART_SIZE=0)
+        self.storage.client.create_bucket(Bucket='moneta')
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_multipart(self):
+        key = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(self.content))
+        self.assertEqual('u/uid1/file.bin', key)
+        self.assertEqual(len(self.content), self.storage.get_size(key, ''))
+        self.assertEqual((len(self.content), self.storage.get_mtime(key, '')), self.storage.get_stat(key, ''))
+        stat = self.storage.get_stat(key, '')
+        self.storage.touch(key, '')  # objects are not rewritten
+        self.assertEqual(stat, self.storage.get_stat(key, ''))
+        with self.storage.get_file(key) as fd:
+            self.assertEqual(self.content, fd.read())
+        self.assertIsNone(self.storage.get_path(key, ''))
+        self.assertIn('files/u/uid1/file.bin', self.storage.get_url(key, ''))
+        self.storage.delete(key)
+        self.assertIsNone(self.storage.get_file(key))
+
+    def test_walk(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, 'data', 'a', 'b'))
+            for name in ('data/file1', 'data/a/file2', 'data/a/b/file3'):
+                with open(os.path.join(root, name), 'wb') as fd:
+                    fd.write(b'content')
+            key = self.storage.store('uid2', os.path.join(root, 'data'))
+        finally:
+            shutil.rmtree(root)
+        self.assertEqual([('data', ['a'], ['file1']), ('data/a', ['b'], ['file2']), ('data/a/b', [], ['file3'])],
+                         list(self.storage.walk(key, 'data')))
+        self.assertEqual([('data/a', [], ['file2'])], list(self.storage.walk(key, 'data/a/file2')))
+        self.storage.delete(key)
+        self.assertEqual([], list(self.storage.walk(key, '')))
+
+
+class TestCachedStorage(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = CachedStorage(BACKEND={'ENGINE': 'moneta.repository.storages.FlatStorage',
+                                              'ROOT': os.path.join(self.root, 'backend')},
+                                     CACHE_ROOT=os.path.join(self.root, 'cache'), MAX_SIZE=2500)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_read_through(self):
+        key = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(b'1' * 1000))
+        path = self.storage.get_path(key, '')
+        self.assertTrue(path.startswith(os.path.join(self.root, 'cache')))
+        with open(path, 'rb') as fd:
+            self.assertEqual(b'1' * 1000, fd.read())
+        with self.storage.get_file(key, mode='wb') as fd:
+            fd.write(b'2' * 1000)
+        with self.storage.get_file(key) as fd:
+            self.assertEqual(b'2' * 1000, fd.read())
+        self.assertIsNone(self.storage.get_path('m/missing', 'file.bin'))
+
+    def test_cached_validators(self):
+        key = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(b'1' * 1000))
+        backend_stat = self.storage.backend.get_stat(key, '')
+        self.storage.get_path(key, '')
+        self.storage.backend = None  # the backend is no longer required by cached files
+        self.assertEqual(backend_stat, self.storage.get_stat(key, ''))
+        self.assertEqual(backend_stat[1], self.storage.get_mtime(key, ''))
+        self.assertIsNotNone(self.storage.get_path(key, ''))
+
+    def test_other_server(self):
+        other = CachedStorage(BACKEND={'ENGINE': 'moneta.repository.storages.FlatStorage',
+                                       'ROOT': os.path.join(self.root, 'backend')},
+                              CACHE_ROOT=os.path.join(self.root, 'other'), MAX_AGE=0)
+        key = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(b'1' * 1000))
+        with other.get_file(key) as fd:
+            self.assertEqual(b'1' * 1000, fd.read())
+        with self.storage.get_file(key, mode='wb') as fd:
+            fd.write(b'2' * 500)
+        self.assertEqual(500, other.get_size(key, ''))
+        with other.get_file(key) as fd:
+            self.assertEqual(b'2' * 500, fd.read())
+        self.storage.delete(key)
+        self.assertIsNone(other.get_file(key))
+        self.assertFalse(os.path.isfile(other.cache_path(key)))
+
+    def test_eviction(self):
+        keys = [self.storage.store_descriptor('uid%d' % i, 'file.bin', io.BytesIO(b'1' * 1000)) for i in range(3)]
+        self.storage.get_path(keys[0], '')
+        os.utime(self.storage.get_path(keys[1], ''), (0, 0))
+        self.storage.get_path(keys[2], '')
+        self.assertTrue(os.path.isfile(self.storage.cache_path(keys[0])))
+        self.assertFalse(os.path.isfile(self.storage.cache_path(keys[1])))
+        self.assertTrue(os.path.isfile(self.storage.cache_path(keys[2])))
+
+    def test_directory_and_partial_copies(self):
+        key = self.storage.store_descriptor('uid1', 'file.bin', io.BytesIO(b'1' * 1000))
+        self.assertIsNone(self.storage.get_path(os.path.dirname(key), ''))
+        tmp_path = os.path.join(os.path.dirname(self.storage.cache_path(key)), '.tmpcopy')
+        os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+        with open(tmp_path, 'wb') as fd:
+            fd.write(b'3' * 2000)
+        for i in range(2):
+            self.storage.get_path(self.storage.store_descriptor('uid%d' % i, 'file.bin', io.BytesIO(b'1' * 1000)), '')
+        self.assertTrue(os.path.isfile(tmp_path))
@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+
+from unittest import skipIf
+
+from django.test import TestCase
+
+from moneta.utils import DigestReader, FileDigests, parse_codecs, merge_sorted, ed_diff
+
+__author__ = 'flanker'
+
+
+class TestDigests(TestCase):
+    content = b'0123456789' * 10000
+
+    def test_from_file(self):
+        digests = FileDigests.from_file(io.BytesIO(self.content), chunk_size=1000)
+        self.assertEqual(len(self.content), digests.size)
+        self.assertEqual(hashlib.md5(self.content).hexdigest(), digests.md5)
+        self.assertEqual(hashlib.sha1(self.content).hexdigest(), digests.sha1)
+        self.assertEqual(hashlib.sha256(self.content).hexdigest(), digests.sha256)
+
+    def test_reader(self):
+        reader = DigestReader(io.BytesIO(self.content))
+        self.assertEqual(b'0123', reader.read(4))
+        reader.seek(50)
+        reader.read(10)
+        self.assertIsNone(reader.digests)
+        reader.seek(4)
+        while reader.read(3000):
+            pass
+        self.assertEqual(hashlib.sha256(self.content).hexdigest(), reader.digests.sha256)
+        self.assertEqual(len(self.content), reader.digests.size)
+
+    def test_partial_reader(self):
+        reader = DigestReader(io.BytesIO(self.content))
+        reader.seek(10)
+        reader.read()
+        self.assertIsNone(reader.digests)
+
+
+class TestCodecs(TestCase):
+    def test_parse_codecs(self):
+        self.assertEqual([('gz', '.gz', 6), ('xz', '.xz', 6)], parse_codecs(' gz:6  xz '))
+        self.assertEqual([], parse_codecs(''))
+        self.assertRaises(ValueError, parse_codecs, 'gz:10')
+        self.assertRaises(ValueError, parse_codecs, 'rar')
+
+
+class TestMergeSorted(TestCase):
+    def test_merge(self):
+        lists = [sorted(('%04d\n' % ((i * 37 + j * 11) % 1000)).encode() for j in range(20)) for i in range(30)]
+        expected = sorted(x for lines in lists for x in lines)
+        self.assertEqual(expected, list(merge_sorted(lists)))
+        # several levels of sorted runs
+        self.assertEqual(expected, list(merge_sorted(lists, fanout=2)))
+        self.assertEqual(expected, list(merge_sorted(iter(lists), fanout=3)))
+        self.assertEqual([], list(merge_sorted([])))
+
+    @skipIf(not os.path.isdir('/proc/self/fd'), 'requires /proc')
+    def test_open_files(self):
+        lists = [[('%04d\n' % (i + j * 100)).encode() for j in range(5)] for i in range(100)]
+        open_files = []
+
+        def watch(lines):
+            for line in lines:
+                open_files.append(len(os.listdir('/proc/self/fd')))
+                yield line
+
+        before = len(os.listdir('/proc/self/fd'))
+        self.assertEqual(sorted(x for lines in lists for x in lines),
+                         list(watch(merge_sorted((watch(x) for x in lists), fanout=3))))
+        # more than `fanout` runs are created, but at most `fanout` inputs and one output are open at once
+        self.assertLessEqual(max(open_files), before + 3 + 1)
+
+
+class TestEdDiff(TestCase):
+    @staticmethod
+    def apply(lines, script):
+        lines = list(lines)
+        script = script.splitlines(keepends=True)
+        index = 0
+        while index < len(script):
+            command = script[index].decode().strip()
+            index += 1
+            start, __, end = command[:-1].partition(',')
+            start = int(start)
+            end = int(end) if end else start
+            new_lines = []
+            if command[-1] in 'ac':
+                while script[index] != b'.\n':
+                    new_lines.append(script[index])
+                    index += 1
+                index += 1
+            if command[-1] == 'a':
+                lines[start:start] = new_lines
+            else:
+                lines[start - 1:end] = new_lines
+        return lines
+
+    def test_ed_diff(self):
+        old = [('line %d\n' % x).encode() for x in range(100)]
+        new = [x for x in old if not x.endswith(b'7\n')] + [b'new line\n']
+        new[0:3] = [b'first\n']
+        new.insert(50, b'inserted\n')
+        for a, b in ((old, new), (new, old), ([], new), (old, []), (old, old)):
+            self.assertEqual(b, self.apply(a, ed_diff(a, b)))
+        self.assertEqual(b'', ed_diff(old, old))
+
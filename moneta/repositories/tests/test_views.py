@@ -0,0 +1,120 @@
+import io
+import os
+import tempfile
+
+from django.conf import settings
+from django.http import HttpRequest
+from django.test import override_settings
+
+from moneta.repositories.jetbrains import Jetbrains
+from moneta.repository.models import storage, Element, ARCHIVE_VARIANTS_UID
+from moneta.repositories.tests import RepositoryTestCase
+from moneta import views
+from moneta.views import sendpath, get_file, evict_archives
+
+__author__ = 'flanker'
+
+
+class TestSendPath(RepositoryTestCase):
+    content = bytes(range(256)) * 40
+
+    def setUp(self):
+        self.key = storage(settings.STORAGE_ARCHIVE).store_descriptor('range-test', 'file.bin',
+                                                                     io.BytesIO(self.content))
+
+    def tearDown(self):
+        storage(settings.STORAGE_ARCHIVE).delete(self.key)
+
+    def send(self, **headers):
+        request = HttpRequest()
+        request.method = 'GET'
+        request.META.update(headers)
+        return sendpath(settings.STORAGE_ARCHIVE, self.key, '', 'application/octet-stream', request=request,
+                        etag='abcd')
+
+    def test_whole_file(self):
+        response = self.send()
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(self.content, b''.join(response.streaming_content))
+        self.assertEqual('bytes', response['Accept-Ranges'])
+
+    def test_single_range(self):
+        response = self.send(HTTP_RANGE='bytes=100-199')
+        self.assertEqual(206, response.status_code)
+        self.assertEqual('bytes 100-199/10240', response['Content-Range'])
+        self.assertEqual(self.content[100:200], b''.join(response.streaming_content))
+        response = self.send(HTTP_RANGE='bytes=-10')
+        self.assertEqual(self.content[-10:], b''.join(response.streaming_content))
+        response = self.send(HTTP_RANGE='bytes=20000-')
+        self.assertEqual(416, response.status_code)
+
+    def test_multiple_ranges(self):
+        response = self.send(HTTP_RANGE='bytes=0-9,1000-')
+        self.assertEqual(206, response.status_code)
+        body = b''.join(response.streaming_content)
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b'Content-Range: bytes 0-9/10240\r\n\r\n' + self.content[0:10] + b'\r\n', body)
+        self.assertIn(b'Content-Range: bytes 1000-10239/10240\r\n\r\n' + self.content[1000:] + b'\r\n', body)
+
+    def test_if_range(self):
+        response = self.send(HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"abcd"')
+        self.assertEqual(206, response.status_code)
+        response = self.send(HTTP_RANGE='bytes=100-199', HTTP_IF_RANGE='"other"')
+        self.assertEqual(200, response.status_code)
+
+    def test_not_modified(self):
+        response = self.send()
+        self.assertEqual('"abcd"', response['ETag'])
+        response = self.send(HTTP_IF_NONE_MATCH='"abcd"')
+        self.assertEqual(304, response.status_code)
+        self.assertEqual('"abcd"', response['ETag'])
+        response = self.send(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(304, response.status_code)
+        response = self.send(HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(200, response.status_code)
+
+
+class TestArchiveCache(RepositoryTestCase):
+    content = b'0123456789' * 1000
+
+    def test_cache(self):
+        repo = self.create_repository(Jetbrains)
+        element = Element(repository=repo, name='file', filename='file.txt', sha256='c' * 64)
+        element.save()
+        element.archive_key = storage(settings.STORAGE_ARCHIVE).store_descriptor(element.uuid, 'file.txt',
+                                                                                  io.BytesIO(self.content))
+        cache_storage = storage(settings.STORAGE_CACHE)
+        cache_key = cache_storage.uid_to_key(ARCHIVE_VARIANTS_UID)
+        request = self.get_request()
+        request.method = 'GET'
+        response = get_file(request, element.id, compression='tgz', element=element)
+        self.assertFalse(response.has_header('Content-Length'))
+        data = b''.join(response.streaming_content)
+        self.assertEqual(len(data), cache_storage.get_size(cache_key, 'c' * 64 + '/file.txt.tgz'))
+        response = get_file(request, element.id, compression='tgz', element=element)
+        self.assertEqual(data, b''.join(response.streaming_content))
+        self.assertEqual(str(len(data)), response['Content-Length'])
+        element.remove_file()
+        self.assertRaises(OSError, cache_storage.get_size, cache_key, 'c' * 64 + '/file.txt.tgz')
+
+    @override_settings(ARCHIVE_VARIANTS_MAX_SIZE=25)
+    def test_eviction(self):
+        cache_storage = storage(settings.STORAGE_CACHE)
+        cache_key = cache_storage.uid_to_key(ARCHIVE_VARIANTS_UID)
+        cache_storage.delete(cache_key)
+        for index, name in enumerate(('a', 'b', 'c')):
+            with tempfile.NamedTemporaryFile(mode='wb', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False) as fd:
+                fd.write(b'0' * 10)
+            cache_storage.import_filename(fd.name, cache_key, name + '/file.tgz')
+            os.utime(cache_storage.get_path(cache_key, name + '/file.tgz'), (1000 + index, 1000 + index))
+        cache_storage.touch(cache_key, 'a/file.tgz')  # the oldest archive has just been sent
+        self.assertEqual(1000, cache_storage.get_mtime(cache_key, 'a/file.tgz'))  # validators are kept
+        views.archive_cache_size = None
+        evict_archives(cache_storage, cache_key)
+        remaining = [x for x in 'abc' if os.path.isfile(cache_storage.get_path(cache_key, x + '/file.tgz'))]
+        self.assertEqual(['a', 'c'], remaining)
+        self.assertEqual(20, views.archive_cache_size)
+        # the cache is not scanned again while its estimated size is below the limit
+        cache_storage.delete(cache_key)
+        evict_archives(cache_storage, cache_key, added_size=5)
+        self.assertEqual(25, views.archive_cache_size)
@@ -1,7 +1,22 @@
+import bz2
+import hashlib
+import io
+import json
+import lzma
+import os
+import sqlite3
+import tempfile
+from unittest import skipIf
+from xml.etree import ElementTree
+
 import pkg_resources
+from django.conf import settings
 
+from moneta.repositories import rpm
 from moneta.repositories.tests import RepositoryTestCase
-from moneta.repositories.yum import Yum
+from moneta.repositories.yum import Yum, xml_escape, repomd_codecs
+from moneta.repository.models import storage, ArchiveState
+from moneta.utils import parse_codecs, available_codecs
 
 __author__ = 'flanker'
 
@@ -13,9 +28,182 @@ class TestYumRpm(RepositoryTestCase):
         filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
         self.add_file_to_repository(repo, filename)
 
+    def test_checksum(self):
+        repo = self.create_repository(Yum)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        with open(filename, 'rb') as fd:
+            sha256 = hashlib.sha256(fd.read()).hexdigest()
+        element = self.add_file_to_repository(repo, filename)
+        self.assertEqual(sha256, json.loads(element.extra_data)['rpm']['checksum'])
+        # the digest stored on the row is never trusted
+        element.sha256 = '0' * 64
+        element.upload_digests = None
+        Yum().update_element(element)
+        self.assertEqual(sha256, json.loads(element.extra_data)['rpm']['checksum'])
+
     def test_generate_index(self):
         repo = self.create_repository(Yum)
         filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
         self.add_file_to_repository(repo, filename)
         yum = Yum()
         yum.generate_indexes(repo)
+
+    def test_skip_unchanged(self):
+        repo = self.create_repository(Yum)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        element = self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        uid = yum.storage_uid % repo.id
+        yum.generate_indexes(repo)
+        generations = yum.generations(uid)
+        self.assertIsNotNone(yum.read_index_state(uid, yum.generation_prefix(uid)).get('fingerprint'))
+        yum.generate_indexes(repo)
+        self.assertEqual(generations, yum.generations(uid))
+        # a state is modified
+        element.states.remove(ArchiveState.objects.get(repository=repo, name='prod'))
+        yum.generate_indexes(repo)
+        self.assertEqual(2, len(yum.generations(uid)))
+
+    def test_index_compression(self):
+        repo = self.create_repository(Yum)
+        repo.index_compression = 'xz:1'
+        repo.save()
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        yum.generate_indexes(repo)
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = self.index_key(yum, repo)
+        with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'repomd.xml')) as fd:
+            repomd = fd.read().decode()
+        self.assertIn('/primary.xml.xz"', repomd)
+        self.assertNotIn('.gz', repomd)
+        with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'primary.xml.xz')) as fd:
+            self.assertIn(b'389-ds-base-libs', lzma.decompress(fd.read()))
+        self.assertIsNone(cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'primary.xml.gz')))
+
+    def test_repomd_codecs(self):
+        self.assertEqual([('gz', '.gz', 9), ('lz4', '.lz4', 9)], repomd_codecs([('lz4', '.lz4', 9), ('gz', '.gz', 9)]))
+        self.assertEqual([('gz', '.gz', 9), ('lz4', '.lz4', 9)], repomd_codecs([('lz4', '.lz4', 9)]))
+        self.assertEqual([('xz', '.xz', 6)], repomd_codecs([('xz', '.xz', 6)]))
+
+    @skipIf('lz4' not in available_codecs(), 'lz4 is required')
+    def test_index_compression_lz4(self):
+        repo = self.create_repository(Yum)
+        repo.index_compression = 'lz4 gz'
+        repo.save()
+        self.assertEqual(parse_codecs('lz4 gz'), repo.get_index_codecs())
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        yum.generate_indexes(repo)
+        with storage(settings.STORAGE_CACHE).get_file(self.index_key(yum, repo),
+                                                      yum.index_filename('qualif', 'x86_64', 'repomd.xml')) as fd:
+            repomd = fd.read().decode()
+        self.assertIn('/primary.xml.gz"', repomd)
+        self.assertNotIn('lz4', repomd)
+
+    def test_metadata_xml(self):
+        self.assertEqual('a &lt;b&gt; &amp; &quot;c&quot;', xml_escape('a <b> & "c"\x01'))
+        self.assertEqual('', xml_escape(None))
+        repo = self.create_repository(Yum)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        yum.generate_indexes(repo)
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = self.index_key(yum, repo)
+        namespaces = {'common': 'http://linux.duke.edu/metadata/common', 'rpm': 'http://linux.duke.edu/metadata/rpm',
+                      'filelists': 'http://linux.duke.edu/metadata/filelists'}
+        with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'primary.xml')) as fd:
+            primary = ElementTree.parse(fd).getroot()
+        self.assertEqual('1', primary.get('packages'))
+        package = primary.find('common:package', namespaces)
+        self.assertEqual('Core libraries for 389 Directory Server', package.find('common:summary', namespaces).text)
+        self.assertEqual('1425592782', package.find('common:time', namespaces).get('build'))
+        self.assertEqual('EQ', package.find('common:format/rpm:provides/rpm:entry', namespaces).get('flags'))
+        with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'filelists.xml')) as fd:
+            filelists = ElementTree.parse(fd).getroot()
+        self.assertIn('/usr/lib64/dirsrv/libslapd.so.0',
+                      [x.text for x in filelists.findall('filelists:package/filelists:file', namespaces)])
+
+    def test_sqlite_databases(self):
+        repo = self.create_repository(Yum)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        yum.generate_indexes(repo)
+        cache_storage = storage(settings.STORAGE_CACHE)
+        key = self.index_key(yum, repo)
+        with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', 'repomd.xml')) as fd:
+            repomd = fd.read().decode()
+        self.assertIn('<data type="primary_db">', repomd)
+        self.assertIn('/filelists.sqlite.bz2"', repomd)
+        with tempfile.TemporaryDirectory() as dirname:
+            for name in ('primary', 'filelists'):
+                path = os.path.join(dirname, '%s.sqlite' % name)
+                with cache_storage.get_file(key, yum.index_filename('qualif', 'x86_64', '%s.sqlite.bz2' % name)) as fd:
+                    with open(path, 'wb') as db_fd:
+                        db_fd.write(bz2.decompress(fd.read()))
+            connection = sqlite3.connect(os.path.join(dirname, 'primary.sqlite'))
+            self.assertEqual([('389-ds-base-libs', 'x86_64', '1.3.3.1', 'Core libraries for 389 Directory Server')],
+                             connection.execute('SELECT name, arch, version, summary FROM packages').fetchall())
+            self.assertEqual(10, connection.execute('SELECT dbversion FROM db_info').fetchone()[0])
+            connection.close()
+            connection = sqlite3.connect(os.path.join(dirname, 'filelists.sqlite'))
+            filenames = connection.execute("SELECT filenames FROM filelist WHERE dirname = '/usr/lib64/dirsrv'")
+            self.assertIn('libslapd.so.0', filenames.fetchone()[0].split('/'))
+            connection.close()
+
+    def test_rpm_parser(self):
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        with open(filename, 'rb') as fd:
+            mapped_rpm = rpm.RPM(fd)  # memory-mapped file
+            fd.seek(0)
+            content = fd.read()
+        buffered_rpm = rpm.RPM(io.BytesIO(content))
+        for rpm_obj in (mapped_rpm, buffered_rpm):
+            self.assertEqual('389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm', rpm_obj.canonical_filename)
+            self.assertEqual(len(content), rpm_obj.filesize)
+            self.assertEqual((1384, 102580), rpm_obj.header.header_range)
+            self.assertIn('/usr/lib64/dirsrv/libslapd.so.0', [x.name for x in rpm_obj.filelist])
+        self.assertEqual(mapped_rpm.checksum, buffered_rpm.checksum)
+        self.assertEqual(mapped_rpm.requires, buffered_rpm.requires)
+        self.assertRaises(rpm.RPMError, rpm.RPM, io.BytesIO(content[:5000]))
+        headers_rpm = rpm.RPM(io.BytesIO(content), headers_only=True)
+        self.assertEqual('389-ds-base-libs', headers_rpm.header.name)
+        self.assertEqual([], headers_rpm.filelist)
+        self.assertIsNone(headers_rpm.checksum)
+        known_rpm = rpm.RPM(io.BytesIO(content), checksum=mapped_rpm.checksum)
+        self.assertEqual((mapped_rpm.checksum, len(content)), (known_rpm.checksum, known_rpm.filesize))
+        mapped_rpm.close()
+        self.assertTrue(mapped_rpm.data.closed)
+        with open(filename, 'rb') as fd, rpm.RPM(fd, headers_only=True) as rpm_obj:
+            self.assertEqual('389-ds-base-libs', rpm_obj.header.name)
+        self.assertTrue(rpm_obj.data.closed)
+        buffered_rpm.close()  # nothing to release
+
+    def test_previous_generation(self):
+        repo = self.create_repository(Yum)
+        filename = pkg_resources.resource_filename('moneta.repositories.tests', '389-ds-base-libs-1.3.3.1-13.el7.x86_64.rpm')
+        element = self.add_file_to_repository(repo, filename)
+        yum = Yum()
+        yum.generate_indexes(repo)
+        uid = yum.storage_uid % repo.id
+        generation = yum.generations(uid)[0]
+        with storage(settings.STORAGE_CACHE).get_file(self.index_key(yum, repo),
+                                                      yum.index_filename('qualif', 'x86_64', 'repomd.xml')) as fd:
+            self.assertIn('repodata/%s/primary.xml' % generation, fd.read().decode())
+        # a new generation is published while a client reads the previous repomd.xml
+        element.states.remove(ArchiveState.objects.get(repository=repo, name='prod'))
+        yum.generate_indexes(repo)
+        self.assertNotEqual(generation, yum.generations(uid)[0])
+        request = self.get_request()
+        request.method = 'GET'
+        response = yum.repodata_file(request, repo.id, repo.slug, 'qualif', 'x86_64', 'primary.xml', '',
+                                     generation=generation)
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'389-ds-base-libs', b''.join(response.streaming_content))
+        response = yum.repodata_file(request, repo.id, repo.slug, 'qualif', 'x86_64', 'primary.xml', '',
+                                     generation='1')
+        self.assertEqual(404, response.status_code)
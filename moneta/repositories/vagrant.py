@@ -16,7 +16,7 @@ from moneta.repositories.base import RepositoryModel
 from moneta.repository.models import ArchiveState, Element, storage
 from moneta.repository.models import Repository
 from moneta.templatetags.moneta import moneta_url
-from moneta.views import get_file
+from moneta.views import get_file, conditional_response, queryset_validators, set_validators
 
 __author__ = 'Matthieu Gallet'
 
@@ -102,8 +102,13 @@ class Vagrant(RepositoryModel):
     def archive_json(self, request: HttpRequest, rid, repo_slug, state_slug=None, archive=None):
         # noinspection PyUnusedLocal
         repo_slug = repo_slug
-        result = self.get_providers_by_version(request, rid, state_slug, archive)
-        return JsonResponse(result)
+        base_query = self.get_archive_queryset(request, rid, state_slug, archive)
+        etag, last_modified = queryset_validators(base_query)
+        response = conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+        result = self.get_providers_by_version(request, rid, state_slug, archive, base_query=base_query)
+        return set_validators(JsonResponse(result), etag=etag, last_modified=last_modified)
 
     # noinspection PyUnusedLocal
     def index(self, request, rid, repo_slug=None, state_slug=''):
@@ -141,12 +146,17 @@ class Vagrant(RepositoryModel):
                            'tab_infos': tab_infos, 'admin_allowed': repo.admin_allowed(request), }
         return TemplateResponse(request, self.index_html, template_values)
 
-    def get_providers_by_version(self, request, rid, state_slug, archive):
+    def get_archive_queryset(self, request, rid, state_slug, archive):
         repo = get_object_or_404(Repository.reader_queryset(request), id=rid, archive_type=self.archive_type)
         base_query = Element.objects.filter(repository=repo, archive=archive)
         if state_slug:
             state = get_object_or_404(ArchiveState, repository=repo, name=state_slug)
             base_query = base_query.filter(states=state)
+        return base_query
+
+    def get_providers_by_version(self, request, rid, state_slug, archive, base_query=None):
+        if base_query is None:
+            base_query = self.get_archive_queryset(request, rid, state_slug, archive)
         versions = {}
         for element in base_query:
             metadata = json.loads(element.extra_data)
@@ -1,4 +1,8 @@
 import json
+import os
+import re
+import shutil
+import sqlite3
 import tempfile
 import time
 
@@ -10,14 +14,258 @@ from django.template.loader import render_to_string
 # noinspection PyPackageRequirements
 from django.utils.translation import gettext as _
 
-from moneta.repositories.aptitude import Aptitude
+from moneta.repositories.aptitude import Aptitude, compression_pattern
 from moneta.repositories import rpm
+from moneta.repositories.scheduler import index_scheduler
 from moneta.repository.models import Repository, storage, Element, ArchiveState
 from moneta.repository.signing import GPGSigner
+from moneta.utils import mkdtemp
 from moneta.views import sendpath
 
 __author__ = 'flanker'
 
+# compression codecs understood by yum and dnf clients
+YUM_CODECS = ('gz', 'bz2', 'xz', 'zst')
+
+
+def repomd_codecs(codecs: list) -> list:
+    """ Return the index compression codecs of a yum repository, the first one (referenced by repomd.xml) being
+    supported by yum clients. gz is added when no such codec is configured.
+
+    :param codecs: list of (codec, extension, level), as returned by `Repository.get_index_codecs`
+    """
+    supported = [x for x in codecs if x[0] in YUM_CODECS]
+    if not supported:
+        return [('gz', '.gz', 9)] + list(codecs)
+    return [supported[0]] + [x for x in codecs if x != supported[0]]
+
+
+# characters that are forbidden in XML 1.0 documents, even when escaped
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]')
+
+
+def i18n_string(value):
+    """ return the first translation of i18n strings (stored as lists of strings) """
+    if isinstance(value, list):
+        return value[0] if value else ''
+    return value
+
+
+def xml_escape(value) -> str:
+    """ escape a value for a XML text node or a double-quoted attribute (None being an empty string) """
+    if value is None:
+        return ''
+    value = INVALID_XML_CHARS.sub('', str(i18n_string(value)))
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+def rpm_entries(tag: str, entries: list) -> str:
+    result = '    <rpm:%s>\n' % tag
+    for info in entries:
+        attributes = 'name="%s"' % xml_escape(info['name'])
+        if info['str_flags']:
+            attributes += ' flags="%s"' % xml_escape(info['str_flags'])
+        if info['version'][1]:
+            attributes += ' epoch="%s" ver="%s" rel="%s"' % tuple(xml_escape(x) for x in info['version'])
+        result += '      <rpm:entry %s/>\n' % attributes
+    return result + '    </rpm:%s>\n' % tag
+
+
+def primary_xml(rpm_dict: dict) -> str:
+    """ return the <package> element of primary.xml for a RPM, as stored in `Element.extra_data` """
+    header, rpm_, signature = rpm_dict['header'], rpm_dict['rpm'], rpm_dict['signature']
+    values = {x: xml_escape(header[x]) for x in ('name', 'architecture', 'epoch', 'version', 'release', 'summary',
+                                                  'description', 'packager', 'url', 'build_time', 'size', 'license',
+                                                  'vendor', 'group', 'build_host', 'source_rpm')}
+    values.update({'checksum': xml_escape(rpm_['checksum']), 'filesize': xml_escape(rpm_['filesize']),
+                   'filename': xml_escape(rpm_['canonical_filename']),
+                   'payload_size': xml_escape(signature['payload_size']),
+                   'header_start': xml_escape(rpm_['header_range'][0]),
+                   'header_end': xml_escape(rpm_['header_range'][1]), })
+    return ('<package type="rpm">\n'
+            '  <name>%(name)s</name>\n'
+            '  <arch>%(architecture)s</arch>\n'
+            '  <version epoch="%(epoch)s" ver="%(version)s" rel="%(release)s"/>\n'
+            '  <checksum type="sha256" pkgid="YES">%(checksum)s</checksum>\n'
+            '  <summary>%(summary)s</summary>\n'
+            '  <description>%(description)s</description>\n'
+            '  <packager>%(packager)s</packager>\n'
+            '  <url>%(url)s</url>\n'
+            '  <time file="%(build_time)s" build="%(build_time)s"/>\n'
+            '  <size package="%(filesize)s" installed="%(size)s" archive="%(payload_size)s"/>\n'
+            '  <location href="Packages/%(filename)s"/>\n'
+            '  <format>\n'
+            '    <rpm:license>%(license)s</rpm:license>\n'
+            '    <rpm:vendor>%(vendor)s</rpm:vendor>\n'
+            '    <rpm:group>%(group)s</rpm:group>\n'
+            '    <rpm:buildhost>%(build_host)s</rpm:buildhost>\n'
+            '    <rpm:sourcerpm>%(source_rpm)s</rpm:sourcerpm>\n'
+            '    <rpm:header-range start="%(header_start)s" end="%(header_end)s"/>\n' % values) + \
+        ''.join(rpm_entries(x, rpm_[x]) for x in ('provides', 'requires', 'conflicts', 'obsoletes')) + \
+        '  </format>\n</package>\n'
+
+
+def package_tag(rpm_dict: dict) -> str:
+    """ return the opening <package> tag and the <version> element shared by filelists.xml and other.xml """
+    header = rpm_dict['header']
+    return '<package pkgid="%s" name="%s" arch="%s">\n  <version epoch="%s" ver="%s" rel="%s"/>\n' % \
+        tuple(xml_escape(x) for x in (rpm_dict['rpm']['checksum'], header['name'], header['architecture'],
+                                      header['epoch'], header['version'], header['release']))
+
+
+def filelists_xml(rpm_dict: dict) -> str:
+    filelist = rpm_dict['rpm']['filelist']
+    # regular files first, then directories and ghost files
+    return package_tag(rpm_dict) + \
+        ''.join('  <file>%s</file>\n' % xml_escape(x['name']) for x in filelist if x['type'] == 'file') + \
+        ''.join('  <file type="%s">%s</file>\n' % (xml_escape(x['type']), xml_escape(x['name']))
+                for x in filelist if x['type'] != 'file') + \
+        '</package>\n'
+
+
+def other_xml(rpm_dict: dict) -> str:
+    return package_tag(rpm_dict) + \
+        ''.join('  <changelog author="%s" date="%s">%s</changelog>\n' %
+                (xml_escape(x['name']), xml_escape(x['time']), xml_escape(x['text']))
+                for x in rpm_dict['rpm']['changelog']) + \
+        '</package>\n'
+
+
+SQLITE_DB_VERSION = 10
+# createrepo schema of the primary, filelists and other databases
+SQLITE_SCHEMAS = {
+    'primary': [
+        'CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)',
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT, name TEXT, arch TEXT, version TEXT, '
+        'epoch TEXT, release TEXT, summary TEXT, description TEXT, url TEXT, time_file INTEGER, time_build INTEGER, '
+        'rpm_license TEXT, rpm_vendor TEXT, rpm_group TEXT, rpm_buildhost TEXT, rpm_sourcerpm TEXT, '
+        'rpm_header_start INTEGER, rpm_header_end INTEGER, rpm_packager TEXT, size_package INTEGER, '
+        'size_installed INTEGER, size_archive INTEGER, location_href TEXT, location_base TEXT, checksum_type TEXT)',
+        'CREATE TABLE files (name TEXT, type TEXT, pkgKey INTEGER)',
+        'CREATE TABLE requires (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER, '
+        'pre BOOLEAN DEFAULT FALSE)',
+        'CREATE TABLE provides (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)',
+        'CREATE TABLE conflicts (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)',
+        'CREATE TABLE obsoletes (name TEXT, flags TEXT, epoch TEXT, version TEXT, release TEXT, pkgKey INTEGER)',
+        'CREATE INDEX packagename ON packages (name)',
+        'CREATE INDEX packageId ON packages (pkgId)',
+        'CREATE INDEX filenames ON files (name)',
+        'CREATE INDEX pkgfiles ON files (pkgKey)',
+        'CREATE INDEX pkgrequires ON requires (pkgKey)',
+        'CREATE INDEX requiresname ON requires (name)',
+        'CREATE INDEX pkgprovides ON provides (pkgKey)',
+        'CREATE INDEX providesname ON provides (name)',
+        'CREATE INDEX pkgconflicts ON conflicts (pkgKey)',
+        'CREATE INDEX pkgobsoletes ON obsoletes (pkgKey)',
+        'CREATE TRIGGER removals AFTER DELETE ON packages BEGIN '
+        'DELETE FROM files WHERE pkgKey = old.pkgKey; DELETE FROM requires WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM provides WHERE pkgKey = old.pkgKey; DELETE FROM conflicts WHERE pkgKey = old.pkgKey; '
+        'DELETE FROM obsoletes WHERE pkgKey = old.pkgKey; END',
+    ],
+    'filelists': [
+        'CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)',
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)',
+        'CREATE TABLE filelist (pkgKey INTEGER, dirname TEXT, filenames TEXT, filetypes TEXT)',
+        'CREATE INDEX keyfile ON filelist (pkgKey)',
+        'CREATE INDEX pkgId ON packages (pkgId)',
+        'CREATE INDEX dirnames ON filelist (dirname)',
+        'CREATE TRIGGER remove_filelist AFTER DELETE ON packages BEGIN '
+        'DELETE FROM filelist WHERE pkgKey = old.pkgKey; END',
+    ],
+    'other': [
+        'CREATE TABLE db_info (dbversion INTEGER, checksum TEXT)',
+        'CREATE TABLE packages (pkgKey INTEGER PRIMARY KEY, pkgId TEXT)',
+        'CREATE TABLE changelog (pkgKey INTEGER, author TEXT, date INTEGER, changelog TEXT)',
+        'CREATE INDEX keychange ON changelog (pkgKey)',
+        'CREATE INDEX pkgId ON packages (pkgId)',
+        'CREATE TRIGGER remove_changelogs AFTER DELETE ON packages BEGIN '
+        'DELETE FROM changelog WHERE pkgKey = old.pkgKey; END',
+    ],
+}
+# files that are also listed in the primary metadata (as selected by createrepo)
+PRIMARY_FILES = re.compile(r'^(.*bin/.*|/etc/.*|/usr/lib/sendmail)$')
+
+
+class SqliteRepodata(object):
+    """ primary, filelists and other sqlite databases of a set of RPMs, created in a new temporary directory """
+
+    def __init__(self, root: str):
+        self.directory = tempfile.mkdtemp(dir=root)
+        self.paths = {x: os.path.join(self.directory, '%s.sqlite' % x) for x in SQLITE_SCHEMAS}
+        self.connections = {}
+        for name, statements in SQLITE_SCHEMAS.items():
+            connection = self.connections[name] = sqlite3.connect(self.paths[name])
+            for statement in statements:
+                connection.execute(statement)
+            connection.commit()
+
+    def add_package(self, rpm_dict: dict):
+        header, rpm_, signature = rpm_dict['header'], rpm_dict['rpm'], rpm_dict['signature']
+        primary = self.connections['primary']
+        cursor = primary.execute('INSERT INTO packages (pkgId, name, arch, version, epoch, release, summary, '
+                                 'description, url, time_file, time_build, rpm_license, rpm_vendor, rpm_group, '
+                                 'rpm_buildhost, rpm_sourcerpm, rpm_header_start, rpm_header_end, rpm_packager, '
+                                 'size_package, size_installed, size_archive, location_href, location_base, '
+                                 'checksum_type) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                                 '?, ?, ?, ?, ?)',
+                                 (rpm_['checksum'], header['name'], header['architecture'], header['version'],
+                                  str(header['epoch']), header['release'], i18n_string(header['summary']),
+                                  i18n_string(header['description']),
+                                  header['url'], header['build_time'], header['build_time'], header['license'],
+                                  header['vendor'], i18n_string(header['group']), header['build_host'],
+                                  header['source_rpm'], rpm_['header_range'][0], rpm_['header_range'][1],
+                                  header['packager'], rpm_['filesize'], header['size'], signature['payload_size'],
+                                  'Packages/%s' % rpm_['canonical_filename'], None, 'sha256'))
+        key = cursor.lastrowid
+        primary.executemany('INSERT INTO files (name, type, pkgKey) VALUES (?, ?, ?)',
+                            [(x['name'], x['type'], key) for x in rpm_['filelist'] if PRIMARY_FILES.match(x['name'])])
+        for table in ('requires', 'provides', 'conflicts', 'obsoletes'):
+            primary.executemany('INSERT INTO %s (name, flags, epoch, version, release, pkgKey) '
+                                'VALUES (?, ?, ?, ?, ?, ?)' % table,
+                                [(x['name'], x['str_flags']) + tuple(x['version']) + (key, ) for x in rpm_[table]])
+        # files are grouped by directory, with one character per file type
+        directories = {}
+        for info in rpm_['filelist']:
+            dirname, basename = info['name'].rsplit('/', 1) if '/' in info['name'] else ('', info['name'])
+            names, types = directories.setdefault(dirname or '/', ([], []))
+            names.append(basename)
+            types.append(info['type'][0])
+        for name in ('filelists', 'other'):
+            self.connections[name].execute('INSERT INTO packages (pkgKey, pkgId) VALUES (?, ?)',
+                                           (key, rpm_['checksum']))
+        self.connections['filelists'].executemany(
+            'INSERT INTO filelist (pkgKey, dirname, filenames, filetypes) VALUES (?, ?, ?, ?)',
+            [(key, x, '/'.join(y[0]), ''.join(y[1])) for (x, y) in directories.items()])
+        self.connections['other'].executemany(
+            'INSERT INTO changelog (pkgKey, author, date, changelog) VALUES (?, ?, ?, ?)',
+            [(key, x['name'], x['time'], x['text']) for x in rpm_['changelog']])
+
+    def merge(self, other: 'SqliteRepodata'):
+        """ add all packages of another set of databases, renumbering their keys """
+        for name, connection in self.connections.items():
+            connection.commit()
+            other.connections[name].commit()
+            offset = connection.execute('SELECT COALESCE(MAX(pkgKey), 0) FROM packages').fetchone()[0]
+            connection.execute('ATTACH DATABASE ? AS other', (other.paths[name], ))
+            tables = [x[0] for x in connection.execute("SELECT name FROM other.sqlite_master WHERE type = 'table' "
+                                                       "AND name != 'db_info'")]
+            for table in tables:
+                columns = [x[1] for x in connection.execute('PRAGMA other.table_info(%s)' % table)]
+                values = ['pkgKey + %d' % offset if x == 'pkgKey' else x for x in columns]
+                connection.execute('INSERT INTO %s (%s) SELECT %s FROM other.%s' %
+                                   (table, ', '.join(columns), ', '.join(values), table))
+            connection.commit()
+            connection.execute('DETACH DATABASE other')
+
+    def close(self, checksums: dict=None):
+        """ close all databases, after storing the checksum of the matching XML file (checksums[name]) """
+        for name, connection in self.connections.items():
+            if checksums is not None:
+                connection.execute('INSERT INTO db_info (dbversion, checksum) VALUES (?, ?)',
+                                   (SQLITE_DB_VERSION, checksums[name]))
+            connection.commit()
+            connection.close()
+
 
 class Yum(Aptitude):
     verbose_name = _('YUM repository for Linux .rpm packages')
@@ -29,43 +277,45 @@ class Yum(Aptitude):
         if not uploaded_file.name.endswith('.rpm'):
             return False
         try:
-            rpm.RPM(uploaded_file.file)
+            rpm.RPM(uploaded_file.file, headers_only=True).close()
         except rpm.RPMError:
             return False
         return True
 
     def update_element(self, element):
         fd = storage(settings.STORAGE_ARCHIVE).get_file(element.archive_key, sub_path='')
-        rpm_obj = rpm.RPM(fd)
-        element.filename = rpm_obj.canonical_filename
-        element.version = rpm_obj.header.version
-        element.archive = rpm_obj.header.name
-        header = {}
-        signature = {}
-        for (obj_dict, header_base) in ((header, rpm_obj.header), (signature, rpm_obj.signature)):
-            available = {}
-            for entry in header_base:
-                available[entry.tag] = entry.value
-            for attr_name, infos in header_base.TAGS.items():
-                attr_value = available.get(infos[0], infos[1])
-                if not isinstance(attr_value, bytes):
-                    obj_dict[attr_name] = attr_value
-        rpm_ = {'binary': rpm_obj.binary, 'canonical_filename': rpm_obj.canonical_filename,
-                'checksum': rpm_obj.checksum, 'filesize': rpm_obj.filesize, 'source': rpm_obj.source,
-                'filelist': [{'type': x.type, 'name': x.name, } for x in rpm_obj.filelist],
-                'provides': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
-                             for x in rpm_obj.provides],
-                'requires': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
-                             for x in rpm_obj.requires],
-                'changelog': [{'name': x.name, 'time': x.time, 'text': x.text, } for x in rpm_obj.changelog],
-                'obsoletes': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
-                              for x in rpm_obj.obsoletes],
-                'conflicts': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
-                              for x in rpm_obj.conflicts],
-                'header_range': list(rpm_obj.header.header_range),
-                }
-        rpm_dict = {'header': header, 'signature': signature, 'rpm': rpm_, }
-        element.extra_data = json.dumps(rpm_dict)
+        # reuse the SHA256 computed when this file has been stored, if any
+        digests = element.upload_digests
+        with fd, rpm.RPM(fd, checksum=digests.sha256 if digests is not None else None) as rpm_obj:
+            element.filename = rpm_obj.canonical_filename
+            element.version = rpm_obj.header.version
+            element.archive = rpm_obj.header.name
+            header = {}
+            signature = {}
+            for (obj_dict, header_base) in ((header, rpm_obj.header), (signature, rpm_obj.signature)):
+                available = {}
+                for entry in header_base:
+                    available[entry.tag] = entry.value
+                for attr_name, infos in header_base.TAGS.items():
+                    attr_value = available.get(infos[0], infos[1])
+                    if not isinstance(attr_value, bytes):
+                        obj_dict[attr_name] = attr_value
+            rpm_ = {'binary': rpm_obj.binary, 'canonical_filename': rpm_obj.canonical_filename,
+                    'checksum': rpm_obj.checksum, 'filesize': rpm_obj.filesize, 'source': rpm_obj.source,
+                    'filelist': [{'type': x.type, 'name': x.name, } for x in rpm_obj.filelist],
+                    'provides': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
+                                 for x in rpm_obj.provides],
+                    'requires': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
+                                 for x in rpm_obj.requires],
+                    'changelog': [{'name': x.name, 'time': x.time, 'text': x.text, } for x in rpm_obj.changelog],
+                    'obsoletes': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
+                                  for x in rpm_obj.obsoletes],
+                    'conflicts': [{'name': x.name, 'str_flags': x.str_flags, 'version': list(x.version)}
+                                  for x in rpm_obj.conflicts],
+                    'header_range': list(rpm_obj.header.header_range),
+                    }
+            rpm_dict = {'header': header, 'signature': signature, 'rpm': rpm_, }
+            element.extra_data = json.dumps(rpm_dict)
 
     def public_url_list(self):
         """
@@ -86,7 +336,7 @@ class Yum(Aptitude):
             url(r'^(?P<rid>\d+)/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/(?P<folder>[\w\-\._]+)/Packages/'
                 r'(?P<filename>[\w\-\.]+)$', self.wrap_view('get_file'), name='get_file'),
             url(r'^(?P<rid>\d+)/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/(?P<arch>[\w\-\._]+)/repodata/'
-                r'(?P<filename>\w+\.xml)(?P<compression>|.bz2|.gz)$', self.wrap_view('repodata_file'),
+                r'(?:(?P<generation>\d+)/)?(?P<filename>\w+\.(?:xml|sqlite))%s$' % compression_pattern(), self.wrap_view('repodata_file'),
                 name='repodata_file'),
             url(r'^(?P<rid>\d+)/(?P<repo_slug>[\w\-\._]+)/(?P<state_slug>[\w\-\._]+)/(?P<arch>[\w\-\._]+)$',
                 self.wrap_view('index'), name='repo_index'),
@@ -102,122 +352,171 @@ class Yum(Aptitude):
         repo_slug, slug = slug, repo_slug
         return HttpResponse(signature, content_type="text/plain")
 
-    def repodata_file(self, request, rid, repo_slug, state_slug, arch, filename, compression):
-        if filename not in ('comps.xml', 'primary.xml', 'other.xml', 'filelists.xml', 'repomd.xml', ):
+    def repodata_file(self, request, rid, repo_slug, state_slug, arch, filename, compression, generation=None):
+        if filename not in ('comps.xml', 'primary.xml', 'other.xml', 'filelists.xml', 'repomd.xml',
+                            'primary.sqlite', 'other.sqlite', 'filelists.sqlite', ):
             return HttpResponse(_('File not found'), status=404)
         if compression and filename == 'repomd.xml':
             return HttpResponse(_('File not found'), status=404)
         # noinspection PyUnusedLocal
         repo_slug = repo_slug
         filename = self.index_filename(state_slug, arch, filename + compression)
-        mimetype = 'text/xml'
+        mimetype = 'application/octet-stream' if '.sqlite' in filename else 'text/xml'
         repo = get_object_or_404(Repository.reader_queryset(request), id=rid, archive_type=self.archive_type)
         uid = self.storage_uid % repo.id
         key = storage(settings.STORAGE_CACHE).uid_to_key(uid)
-        return sendpath(settings.STORAGE_CACHE, key, filename, mimetype)
+        if generation is None:
+            index_scheduler.ensure_fresh(repo)
+            filename = self.generation_prefix(uid) + filename
+        elif generation in self.generations(uid):
+            # files referenced by a repomd.xml that has been replaced are still available for in-flight clients
+            filename = 'generations/%s/%s' % (generation, filename)
+        else:
+            return HttpResponse(_('File not found'), status=404)
+        return sendpath(settings.STORAGE_CACHE, key, filename, mimetype, request=request)
 
     def generate_indexes(self, repository, states=None, validity=365):
-        if states is None:
+        storage_uid = self.storage_uid % repository.id
+        # nothing to do if the repository has not been modified since the last generation
+        fingerprint = self.content_fingerprint(repository)
+        partial = states is not None
+        if not partial and self.is_index_up_to_date(storage_uid, fingerprint, validity=validity):
+            return
+        if not partial:
             states = list(ArchiveState.objects.filter(repository=repository).order_by('name'))
         revision = int(time.time())
-        architectures_by_state = {x.slug: set() for x in states}
-        # architectures_by_state[archive_state.slug] = {'x86_64', 'c7', }
-        # load all dict infos and count all architectures
-        rpm_objects = []
-        package_count_by_state_arch = {x.slug: {'noarch': 0} for x in states}
-        for element in Element.objects.filter(repository=repository).prefetch_related('states'):
-            rpm_dict = json.loads(element.extra_data)
-            rpm_objects.append(rpm_dict)
-            rpm_dict['states'] = [s.slug for s in element.states.all()]
-            package_architecture = rpm_dict['header']['architecture'] or 'noarch'
-            if package_architecture != 'noarch':
-                for state_slug in rpm_dict['states']:
-                    architectures_by_state[state_slug].add(package_architecture)
-            for state_slug in rpm_dict['states']:
-                package_count_by_state_arch[state_slug].setdefault(package_architecture, 0)
-                package_count_by_state_arch[state_slug][package_architecture] += 1
-
-        # add the count of 'noarch' packages to other architectures
-        for state_slug, package_count_by_arch in package_count_by_state_arch.items():
-            if len(package_count_by_arch) == 1:  # only 'noarch' architecture
-                package_count_by_arch['x86_64'] = 0
-                architectures_by_state[state_slug] = {'x86_64', }
-            noarch_count = package_count_by_arch['noarch']
-            del package_count_by_arch['noarch']
-            for architecture in package_count_by_arch:
-                package_count_by_arch[architecture] += noarch_count
-
-        # prepare all files
-        open_files = {}
-        for state_slug, architectures in architectures_by_state.items():
-            for architecture in architectures:
-                def write(name_, data):
-                    filename_ = self.index_filename(state_slug, architecture, name_)
-                    open_files[filename_].write(data.encode('utf-8'))
-                for name in ('other.xml', 'filelists.xml', 'comps.xml', 'primary.xml', ):
-
-                    filename = self.index_filename(state_slug, architecture, name)
-                    open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-                    write(name, '<?xml version="1.0" encoding="UTF-8"?>\n')
-                package_count = package_count_by_state_arch[state_slug][architecture]
-                write('other.xml', '<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%d">\n' %
-                      package_count)
-                write('filelists.xml', '<filelists xmlns="http://linux.duke.edu/metadata/filelists" packages="%d">\n' %
-                      package_count)
-                write('comps.xml', '<!DOCTYPE comps PUBLIC "-//CentOS//DTD Comps info//EN" "comps.dtd">\n')
-                write('comps.xml', '<comps>\n')
-                write('primary.xml', '<metadata xmlns="http://linux.duke.edu/metadata/common" '
-                                     'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%d">\n' % package_count)
-        # fill all files with RPMs
-        for rpm_dict in rpm_objects:
-            filelists = render_to_string('repositories/yum/filelists.xml', rpm_dict)
-            primary = render_to_string('repositories/yum/primary.xml', rpm_dict)
-            other = render_to_string('repositories/yum/other.xml', rpm_dict)
-            for state_slug in rpm_dict['states']:
-                architectures = {rpm_dict['header']['architecture'], }
-                if architectures == {'noarch', }:
-                    architectures = architectures_by_state[state_slug]
+        slug_by_state_id = {x.id: x.slug for x in states}
+        states_by_element = {}  # states_by_element[element.id] = ['qualif', 'prod', ]
+        for element_id, state_id in Element.states.through.objects \
+                .filter(element__repository=repository, archivestate_id__in=slug_by_state_id) \
+                .values_list('element_id', 'archivestate_id'):
+            states_by_element.setdefault(element_id, []).append(slug_by_state_id[state_id])
+        # XML metadata are written while elements are read from the database, one at a time:
+        # <package> elements are first written to bodies[(state slug, architecture)][filename] temporary files,
+        # 'noarch' packages being written once per state (and later copied into each architecture)
+        # sqlite databases are also filled at the same time (databases[(state slug, architecture)])
+        bodies = {}
+        package_counts = {}
+        databases = {}
+        sqlite_root = mkdtemp()
+        try:
+            elements = Element.objects.filter(repository=repository).order_by('id').values_list('id', 'extra_data')
+            for element_id, extra_data in elements.iterator():
+                if element_id not in states_by_element:
+                    continue
+                rpm_dict = json.loads(extra_data)
+                package_architecture = rpm_dict['header']['architecture'] or 'noarch'
+                packages = {'primary.xml': primary_xml(rpm_dict).encode('utf-8'),
+                            'filelists.xml': filelists_xml(rpm_dict).encode('utf-8'),
+                            'other.xml': other_xml(rpm_dict).encode('utf-8'), }
+                for state_slug in states_by_element[element_id]:
+                    body = bodies.get((state_slug, package_architecture))
+                    if body is None:
+                        body = bodies[(state_slug, package_architecture)] = \
+                            {x: tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR) for x in packages}
+                        package_counts[(state_slug, package_architecture)] = 0
+                        databases[(state_slug, package_architecture)] = SqliteRepodata(sqlite_root)
+                    for name, data in packages.items():
+                        body[name].write(data)
+                    databases[(state_slug, package_architecture)].add_package(rpm_dict)
+                    package_counts[(state_slug, package_architecture)] += 1
+            architectures_by_state = {x.slug: {y[1] for y in bodies if y[0] == x.slug and y[1] != 'noarch'} or
+                                      {'x86_64'} for x in states}
+            # architectures_by_state[archive_state.slug] = {'x86_64', 'c7', }
+
+            # write all files
+            open_files = {}
+            for state_slug, architectures in architectures_by_state.items():
                 for architecture in architectures:
-                    open_files[self.index_filename(state_slug, architecture, 'filelists.xml')]\
-                        .write(filelists.encode('utf-8'))
-                    open_files[self.index_filename(state_slug, architecture, 'primary.xml')]\
-                        .write(primary.encode('utf-8'))
-                    open_files[self.index_filename(state_slug, architecture, 'other.xml')].write(other.encode('utf-8'))
-        # finish all files
-        for state_slug, architectures in architectures_by_state.items():
-            for architecture in architectures:
-                open_files[self.index_filename(state_slug, architecture, 'other.xml')].write(b'</otherdata>')
-                open_files[self.index_filename(state_slug, architecture, 'filelists.xml')].write(b'</filelists>')
-                open_files[self.index_filename(state_slug, architecture, 'comps.xml')].write(b'</comps>')
-                open_files[self.index_filename(state_slug, architecture, 'primary.xml')].write(b'</metadata>')
+                    package_count = package_counts.get((state_slug, architecture), 0) + \
+                        package_counts.get((state_slug, 'noarch'), 0)
+                    headers = {'other.xml': '<otherdata xmlns="http://linux.duke.edu/metadata/other" packages="%d">\n',
+                               'filelists.xml': '<filelists xmlns="http://linux.duke.edu/metadata/filelists" '
+                                                'packages="%d">\n',
+                               'comps.xml': '<!DOCTYPE comps PUBLIC "-//CentOS//DTD Comps info//EN" "comps.dtd">\n'
+                                            '<comps>\n',
+                               'primary.xml': '<metadata xmlns="http://linux.duke.edu/metadata/common" '
+                                              'xmlns:rpm="http://linux.duke.edu/metadata/rpm" packages="%d">\n', }
+                    footers = {'other.xml': b'</otherdata>', 'filelists.xml': b'</filelists>', 'comps.xml': b'</comps>',
+                               'primary.xml': b'</metadata>', }
+                    for name, header in headers.items():
+                        filename = self.index_filename(state_slug, architecture, name)
+                        open_file = open_files[filename] = tempfile.TemporaryFile(mode='w+b',
+                                                                                  dir=settings.FILE_UPLOAD_TEMP_DIR)
+                        if '%d' in header:
+                            header %= package_count
+                        open_file.write(('<?xml version="1.0" encoding="UTF-8"?>\n' + header).encode('utf-8'))
+                        for body_architecture in (architecture, 'noarch'):
+                            body = bodies.get((state_slug, body_architecture), {}).get(name)
+                            if body is not None:
+                                body.seek(0)
+                                shutil.copyfileobj(body, open_file)
+                        open_file.write(footers[name])
+            for body in bodies.values():
+                for body_file in body.values():
+                    body_file.close()
 
-        storage_uid = self.storage_uid % repository.id
-        # generate a compressed version of each file
-        list_of_hashes = self.compress_files(open_files, '', storage_uid)
-        dict_of_hashes = {x[0]: x for x in list_of_hashes}
-        for state_slug, architectures in architectures_by_state.items():
-            for architecture in architectures:
-                filename = self.index_filename(state_slug, architecture, 'repomd.xml')
-                open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-                other = self.index_filename(state_slug, architecture, 'other.xml')
-                filelists = self.index_filename(state_slug, architecture, 'filelists.xml')
-                comps = self.index_filename(state_slug, architecture, 'comps.xml')
-                primary = self.index_filename(state_slug, architecture, 'primary.xml')
-                template_values = {'revision': revision,
-                                   'other': dict_of_hashes[other],
-                                   'filelists': dict_of_hashes[filelists],
-                                   'comps': dict_of_hashes[comps],
-                                   'primary': dict_of_hashes[primary],
-                                   'other_gz': dict_of_hashes[other + '.gz'],
-                                   'filelists_gz': dict_of_hashes[filelists + '.gz'],
-                                   'comps_gz': dict_of_hashes[comps + '.gz'],
-                                   'primary_gz': dict_of_hashes[primary + '.gz'], }
-                repomd = render_to_string('repositories/yum/repomd.xml', template_values)
-                repomd_file = open_files[filename]
-                repomd_file.write(repomd.encode('utf-8'))
-                repomd_file.flush()
-                repomd_file.seek(0)
-                storage(settings.STORAGE_CACHE).store_descriptor(storage_uid, filename, repomd_file)
+            # all files are written in a new generation, published at the end
+            generation = self.new_generation()
+            prefix = 'generations/%s/' % generation
+            # generate a compressed version of each file
+            codecs = repomd_codecs(repository.get_index_codecs())
+            list_of_hashes = self.compress_files({prefix + x: y for (x, y) in open_files.items()}, prefix, storage_uid,
+                                                 codecs=codecs)
+            dict_of_hashes = {x[0]: x for x in list_of_hashes}
+            # repomd.xml only references one compressed version of each file
+            codec, extension = codecs[0][0], codecs[0][1]
+            # finish the sqlite databases (adding 'noarch' packages to each architecture), always compressed with bz2
+            sqlite_files = {}
+            for state_slug, architectures in architectures_by_state.items():
+                for architecture in architectures:
+                    database = databases.pop((state_slug, architecture), None) or SqliteRepodata(sqlite_root)
+                    if (state_slug, 'noarch') in databases:
+                        database.merge(databases[(state_slug, 'noarch')])
+                    database.close(checksums={x: dict_of_hashes[self.index_filename(state_slug, architecture,
+                                                                                    '%s.xml%s' % (x, extension))][3]
+                                              for x in SQLITE_SCHEMAS})
+                    for name, path in database.paths.items():
+                        sqlite_files[prefix + self.index_filename(state_slug, architecture, '%s.sqlite' % name)] = \
+                            open(path, 'rb')
+            for database in databases.values():
+                database.close()
+            list_of_hashes = self.compress_files(sqlite_files, prefix, storage_uid, codecs=[('bz2', '.bz2', 9)])
+            dict_of_hashes.update({x[0]: x for x in list_of_hashes})
+            for state_slug, architectures in architectures_by_state.items():
+                for architecture in architectures:
+                    filename = self.index_filename(state_slug, architecture, 'repomd.xml')
+                    open_files[filename] = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
+                    other = self.index_filename(state_slug, architecture, 'other.xml')
+                    filelists = self.index_filename(state_slug, architecture, 'filelists.xml')
+                    comps = self.index_filename(state_slug, architecture, 'comps.xml')
+                    primary = self.index_filename(state_slug, architecture, 'primary.xml')
+                    template_values = {'revision': revision, 'codec': codec, 'extension': extension,
+                                       'generation': generation,
+                                       'other': dict_of_hashes[other],
+                                       'filelists': dict_of_hashes[filelists],
+                                       'comps': dict_of_hashes[comps],
+                                       'primary': dict_of_hashes[primary],
+                                       'other_comp': dict_of_hashes[other + extension],
+                                       'filelists_comp': dict_of_hashes[filelists + extension],
+                                       'comps_comp': dict_of_hashes[comps + extension],
+                                       'primary_comp': dict_of_hashes[primary + extension], }
+                    for name in SQLITE_SCHEMAS:
+                        database = self.index_filename(state_slug, architecture, '%s.sqlite' % name)
+                        template_values['%s_db' % name] = dict_of_hashes[database]
+                        template_values['%s_db_comp' % name] = dict_of_hashes[database + '.bz2']
+                    repomd = render_to_string('repositories/yum/repomd.xml', template_values)
+                    repomd_file = open_files[filename]
+                    repomd_file.write(repomd.encode('utf-8'))
+                    repomd_file.flush()
+                    repomd_file.seek(0)
+                    storage(settings.STORAGE_CACHE).store_descriptor(storage_uid, prefix + filename, repomd_file)
+            if partial:
+                fingerprint['repository'] = None
+            self.write_index_state(storage_uid, prefix, fingerprint)
+            self.publish_generation(storage_uid, generation)
+        finally:
+            shutil.rmtree(sqlite_root)
 
     @staticmethod
     def index_filename(state: str, architecture: str, name: str):
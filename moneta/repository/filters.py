@@ -1,14 +1,13 @@
 # noinspection PyCompatibility
 import bz2
 import gzip
-import hashlib
 import mimetypes
 import os
 import tarfile
 import zipfile
 
 from moneta.archives import ArFile
-from moneta.utils import mkdtemp
+from moneta.utils import mkdtemp, FileDigests
 
 
 __author__ = 'flanker'
@@ -18,21 +17,13 @@ mimetypes.init()
 
 # noinspection PyUnusedLocal
 def informations(element, open_file, filename, temp_files, uncompressed_path=None):
-    size = 0
-    md5 = hashlib.md5()
-    sha1 = hashlib.sha1()
-    sha256 = hashlib.sha256()
-    data = open_file.read(1024)
-    while data:
-        md5.update(data)
-        sha1.update(data)
-        sha256.update(data)
-        size += len(data)
-        data = open_file.read(1024)
-    element.sha1 = sha1.hexdigest()
-    element.sha256 = sha256.hexdigest()
-    element.md5 = md5.hexdigest()
-    element.filesize = size
+    digests = getattr(open_file, 'digests', None)
+    if digests is None:  # checksums have not been computed while the file was uploaded or stored
+        digests = FileDigests.from_file(open_file)
+    element.sha1 = digests.sha1
+    element.sha256 = digests.sha256
+    element.md5 = digests.md5
+    element.filesize = digests.size
     element.extension = os.path.splitext(filename)[1]
     element.mimetype = mimetypes.guess_type(filename, strict=False)[0]
     if element.mimetype is None:
@@ -6,6 +6,7 @@ from django.utils.text import slugify
 from django.utils.translation import gettext as _
 import functools
 from moneta.repository.models import Repository, ElementSignature
+from moneta.utils import parse_codecs, available_codecs
 
 __author__ = 'flanker'
 
@@ -15,6 +16,21 @@ def repo_name_validator(value):
         raise ValidationError(_('This repository already exists.'))
 
 
+def index_compression_validator(value):
+    try:
+        parse_codecs(value)
+    except ValueError as e:
+        raise ValidationError(str(e))
+
+
+def index_compression_field():
+    return forms.CharField(max_length=100, label=_('Compression of index files'), required=False,
+                           validators=[index_compression_validator],
+                           help_text=_('Space-separated codecs with an optional level, like "gz:9 xz:6". '
+                                       'Available codecs: %(codecs)s. Leave empty for the default codecs.') %
+                           {'codecs': ', '.join(available_codecs())})
+
+
 @functools.lru_cache()
 def get_repository_form():
     from moneta.repositories.base import RepositoryModelsClasses
@@ -32,6 +48,7 @@ def get_repository_form():
         reader_group = forms.ModelMultipleChoiceField(Group.objects.all(), widget=forms.HiddenInput(),
                                                       label=_('Groups allowed to download packages'),
                                                       help_text=_('Only if downloads require authentication'), required=False)
+        index_compression = index_compression_field()
 
     return RepositoryForm
 
@@ -58,6 +75,7 @@ class RepositoryUpdateForm(forms.Form):
                              validators=[RegexValidator('\w+(\s\w)*')])
     admin_group = forms.ModelMultipleChoiceField(Group.objects.all(), label=_('Groups allowed to upload'),
                                                  required=False)
+    index_compression = index_compression_field()
     # reader_group = forms.ModelMultipleChoiceField(Group.objects.all(), widget=forms.HiddenInput(),
     #                                               help_text=_('Only if downloads are authenticated'),
     #                                               label=_('Groups allowed to download packages'), required=False)
@@ -0,0 +1,21 @@
+from argparse import ArgumentParser
+
+from django.core.management import BaseCommand
+
+from moneta.repositories.scheduler import index_scheduler
+
+__author__ = 'flanker'
+
+
+class Command(BaseCommand):
+    help = """Rebuild the indexes of all modified repositories whose rebuild delay has expired.
+    Should be periodically called when worker processes are recycled or cannot run background threads."""
+
+    def add_arguments(self, parser):
+        assert isinstance(parser, ArgumentParser)
+        parser.add_argument('--all', action='store_true', default=False,
+                            help='Rebuild all modified repositories, even if their delay has not expired.')
+
+    def handle(self, *args, **options):
+        for repository_id in index_scheduler.run_pending(force=options['all']):
+            self.stdout.write('indexes of repository %s rebuilt' % repository_id)
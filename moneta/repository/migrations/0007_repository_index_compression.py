@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repository', '0006_auto_20171104_1444'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='index_compression',
+            field=models.CharField(blank=True, default='', help_text='Space-separated codecs with an optional level, like "gz:9 xz:6". Leave empty for the default codecs.', max_length=100, verbose_name='Compression of index files'),
+        ),
+    ]
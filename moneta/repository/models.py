@@ -15,7 +15,7 @@ from django.utils.translation import gettext_lazy as _, gettext
 
 from moneta.exceptions import InvalidRepositoryException
 from moneta.repository.storages import BaseStorage
-from moneta.utils import normalize_str, remove, import_path
+from moneta.utils import normalize_str, remove, import_path, DigestReader, parse_codecs
 
 __author__ = 'flanker'
 
@@ -23,6 +23,7 @@ logger = logging.getLogger('moneta.files')
 
 ARCHIVE_FILTER_CALLABLES = None
 STORAGES = {}
+ARCHIVE_VARIANTS_UID = 'a5c41fe0-0000-0000-0000-000000000000'  # archives generated by get_file, in the cache storage
 
 
 @functools.lru_cache()
@@ -73,6 +74,9 @@ class Repository(BaseModel):
                                          related_name='repository_admin')
     reader_group = models.ManyToManyField(Group, verbose_name=_('Readers groups'), db_index=True, blank=True,
                                           related_name='repository_reader')
+    index_compression = models.CharField(_('Compression of index files'), max_length=100, blank=True, default='',
+                                         help_text=_('Space-separated codecs with an optional level, like '
+                                                     '"gz:9 xz:6". Leave empty for the default codecs.'))
 
     class Meta:
         verbose_name = 'repository'
@@ -85,6 +89,15 @@ class Repository(BaseModel):
     def get_absolute_url(self):
         return reverse('repository:%s:index' % self.archive_type, kwargs={'rid': self.id})
 
+    def get_index_codecs(self):
+        """ Return the compression codecs of the index files, as a list of (codec name, file extension, level)
+        """
+        try:
+            return parse_codecs(self.index_compression or settings.INDEX_COMPRESSION)
+        except ValueError:  # a codec has been uninstalled
+            logger.warning(gettext('Invalid index compression for repository %(repo)s') % {'repo': self.name})
+            return parse_codecs(settings.INDEX_COMPRESSION)
+
     @staticmethod
     def index_queryset(request):
         user = request.user
@@ -171,6 +184,8 @@ class Element(BaseModel):
     archive_key = models.CharField(_('Original file'), blank=True, max_length=255, db_index=True, default='')
     uncompressed_key = models.CharField(_('Stored path'), blank=True, max_length=255, db_index=True, default='')
     extra_data = models.TextField(_('Extra repo data'), blank=True, default='')
+    # FileDigests of the file stored by the last successful call to `set_file` (None if they are unknown)
+    upload_digests = None
 
     class Meta:
         verbose_name = _('file')
@@ -187,6 +202,10 @@ class Element(BaseModel):
         if self.uncompressed_key:
             storage(settings.STORAGE_UNCOMPRESSED).delete(self.uncompressed_key)
             self.uncompressed_key = None
+        if self.sha256 and not Element.objects.filter(sha256=self.sha256).exclude(pk=self.pk).exists():
+            # cached archives are shared by all elements with the same content
+            cache_storage = storage(settings.STORAGE_CACHE)
+            cache_storage.delete(os.path.join(cache_storage.uid_to_key(ARCHIVE_VARIANTS_UID), self.sha256))
 
     def save(self, *args, **kwargs):
         """
@@ -224,10 +243,21 @@ class Element(BaseModel):
 
     def set_file(self, obj_file, filename):
         temp_files = set()
+        self.upload_digests = None
         # noinspection PyBroadException
         try:
             self.remove_file()
-            self.archive_key = storage(settings.STORAGE_ARCHIVE).store_descriptor(self.uuid, filename, obj_file)
+            archive_storage = storage(settings.STORAGE_ARCHIVE)
+            if getattr(obj_file, 'digests', None) is None:
+                # checksums are computed while the file is copied to the storage
+                obj_file = DigestReader(obj_file)
+                self.archive_key = archive_storage.store_descriptor(self.uuid, filename, obj_file)
+            elif hasattr(obj_file, 'temporary_file_path'):
+                # checksums have been computed during the upload and the file is already on the disk
+                self.archive_key = archive_storage.store_filename(self.uuid, filename, obj_file.temporary_file_path(),
+                                                                  sha256=obj_file.digests.sha256)
+            else:
+                self.archive_key = archive_storage.store_descriptor(self.uuid, filename, obj_file)
             uncompressed_path = None
             for mw in archive_filters():
                 obj_file.seek(0)
@@ -236,6 +266,7 @@ class Element(BaseModel):
                     uncompressed_path = u_path
             if uncompressed_path is not None:  # there are extracted data to store
                 self.uncompressed_key = storage(settings.STORAGE_UNCOMPRESSED).store(self.uuid, uncompressed_path)
+            self.upload_digests = getattr(obj_file, 'digests', None)
         except Exception as e:
             logging.error(gettext('Unable to add the archive file'), exc_info=True)
             raise e
@@ -1,13 +1,40 @@
+import hashlib
 import mimetypes
 import os
 import shutil
-from moneta.utils import makedir, remove
+import stat
+import tempfile
+import time
+
+from django.core.exceptions import ImproperlyConfigured
+
+from moneta.utils import makedir, remove, read_file_in_chunks, import_path, LimitedReader
+
+try:
+    # noinspection PyPackageRequirements
+    import boto3
+    # noinspection PyPackageRequirements
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = None
 
 __author__ = 'flanker'
 
 mimetypes.init()
 
 
+def file_range(fd, offset=0, length=None):
+    """ seek the file object to `offset` and restrict it to the next `length` bytes (if `length` is not None) """
+    if fd is None:
+        return None
+    if offset:
+        fd.seek(offset)
+    if length is not None:
+        return LimitedReader(fd, length)
+    return fd
+
+
 class BaseStorage(object):
     # noinspection PyPep8Naming
     def __init__(self, ENGINE=''):
@@ -58,11 +85,27 @@ class BaseStorage(object):
         """
         raise NotImplementedError
 
-    def get_file(self, key, sub_path='', mode='rb'):
+    def store_filename(self, uid, filename, path, sha256=None):
+        """
+        Store the content of a local file, that is left untouched.
+        Storages should avoid copying data when possible.
+        :param uid: UUID of the Element
+        :param filename: name of the stored file
+        :param path: absolute path of the local file
+        :param sha256: sha256 checksum of the file, if already known
+        :return: a key unique to this storage
+        :raise:
+        """
+        with open(path, 'rb') as fd:
+            return self.store_descriptor(uid, filename, fd)
+
+    def get_file(self, key, sub_path='', mode='rb', offset=0, length=None):
         """
         Return a file descriptor in read mode of the given path
         :param key: UUID of the Element
         :param sub_path: relative path to read
+        :param offset: first byte to read
+        :param length: number of bytes that can be read (the whole file if None)
         :return: A file-like object
         :raise:
         """
@@ -88,6 +131,19 @@ class BaseStorage(object):
         """
         raise NotImplementedError
 
+    # noinspection PyMethodMayBeStatic,PyUnusedLocal
+    def get_url(self, key, sub_path, content_type=None, content_disposition=None):
+        """ return an URL that clients can directly use to download the file, or None if there is no such URL
+        (the file is then sent by Moneta itself).
+
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :param content_type: Content-Type header that should be sent with the file
+        :param content_disposition: Content-Disposition header that should be sent with the file
+        :return: `str`
+        """
+        return None
+
     def delete(self, key):
         """
         Delete the element from its internal storage
@@ -114,6 +170,43 @@ class BaseStorage(object):
         """
         raise NotImplementedError
 
+    def get_mtime(self, key, sub_path):
+        """
+        Return the modification time of the file, as a timestamp
+        :param key: UUID of the Element
+        :param sub_path: relative path of the file
+        :raise:
+        """
+        raise NotImplementedError
+
+    def get_stat(self, key, sub_path):
+        """
+        Return both the size and the modification time of the file, with a single request when possible
+        :param key: UUID of the Element
+        :param sub_path: relative path of the file
+        :return: (size, modification timestamp)
+        :raise:
+        """
+        return self.get_size(key, sub_path), self.get_mtime(key, sub_path)
+
+    def touch(self, key, sub_path):
+        """
+        Mark the file as recently used (when supported), without modifying it
+        :param key: UUID of the Element
+        :param sub_path: relative path of the file
+        """
+        pass
+
+    def get_last_use(self, key, sub_path):
+        """
+        Return the last time the file has been used (see :meth:`touch`), as a timestamp.
+        The modification time when last uses are not tracked.
+        :param key: UUID of the Element
+        :param sub_path: relative path of the file
+        :raise:
+        """
+        return self.get_mtime(key, sub_path)
+
     def uid_to_key(self, uid):
         raise NotImplementedError
 
@@ -183,11 +276,13 @@ class FlatStorage(BaseStorage):
     def simple_generator(self, lis):
         yield lis
 
-    def get_file(self, key, sub_path='', mode='rb'):
+    def get_file(self, key, sub_path='', mode='rb', offset=0, length=None):
         """
         Return a file descriptor in read mode of the given path
         :param key: UUID of the Element
         :param sub_path: relative path to read
+        :param offset: first byte to read
+        :param length: number of bytes that can be read (the whole file if None)
         :return: A file-like object
         :raise:
         """
@@ -200,7 +295,7 @@ class FlatStorage(BaseStorage):
             fd = open(abs_path, mode)
         except IOError:
             fd = None
-        return fd
+        return file_range(fd, offset, length)
 
     def import_filename(self, filename, key, sub_path=''):
         components = [self.root, key]
@@ -208,7 +303,10 @@ class FlatStorage(BaseStorage):
             components.append(sub_path)
         abs_path = os.path.join(*components)
         makedir(os.path.dirname(abs_path))
-        return os.rename(filename, abs_path)
+        try:
+            return os.replace(filename, abs_path)
+        except OSError:  # not the same file system
+            shutil.move(filename, abs_path)
 
     def get_path(self, key, sub_path):
         """ return an absolute path of the file, or None if does not exist (e.g., database storage).
@@ -239,6 +337,34 @@ class FlatStorage(BaseStorage):
             components.append(sub_path)
         return os.path.getsize(os.path.join(*components))
 
+    def get_mtime(self, key, sub_path):
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        return os.path.getmtime(os.path.join(*components))
+
+    def get_stat(self, key, sub_path):
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        file_stat = os.stat(os.path.join(*components))
+        return file_stat.st_size, file_stat.st_mtime
+
+    def touch(self, key, sub_path):
+        # the access time tracks the last use, the modification time is kept for validators
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        path = os.path.join(*components)
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+
+    def get_last_use(self, key, sub_path):
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        file_stat = os.stat(os.path.join(*components))
+        return max(file_stat.st_atime, file_stat.st_mtime)
+
     def delete(self, key):
         """
         Delete the element from its internal storage
@@ -282,6 +408,29 @@ class FlatStorage(BaseStorage):
                 data = fd.read(10240)
         return os.path.join(*(components[1:]))
 
+    def store_filename(self, uid, filename, path, sha256=None):
+        """
+        Store the content of a local file, that is left untouched.
+        A hard link is created when the file is on the same file system, avoiding any copy.
+        :param uid: UUID of the Element
+        :param filename: name of the stored file
+        :param path: absolute path of the local file
+        :param sha256: not used by this storage
+        :return: a key unique to this storage
+        :raise:
+        """
+        components = [self.root] + self.split_uid(uid) + [uid, filename]
+        abs_path = os.path.join(*components)
+        makedir(os.path.dirname(abs_path))
+        remove(abs_path)
+        try:
+            os.link(path, abs_path)
+        except OSError:  # not the same file system, or hard links are not supported
+            shutil.copyfile(path, abs_path)
+        # temporary files are only readable by their owner
+        os.chmod(abs_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+        return os.path.join(*(components[1:]))
+
     def split_uid(self, uid):
         return [x for x in uid[0:self.path_len]]
 
@@ -290,6 +439,666 @@ class FlatStorage(BaseStorage):
         return mimetypes.guess_type(path)[0] or 'application/octet-stream'
 
 
+class ContentAddressedStorage(FlatStorage):
+    """ Flat storage that keeps a single copy of identical files.
+
+    Each content is stored once, in a blob named by its sha256 (in the `.blobs` directory of the root).
+    Stored files are hard links to these blobs, so the number of links of a blob is its reference count and
+    deleting (or overwriting) a file only drops a reference. The blob is removed with its last reference, i.e. when
+    it is left with a single link once the file is removed.
+    Links held outside the storage (like the local file given to `store_filename`, linked to a new blob instead of
+    being copied) also keep the blob; a blob whose last reference is removed while such a link exists is only
+    removed with its next reference.
+    Since stored files are still regular files at the usual places, `get_path` and `walk` keep working.
+    """
+    BLOB_DIR = '.blobs'
+    SHA256_XATTR = 'user.moneta.sha256'
+
+    def blob_path(self, sha256):
+        return os.path.join(self.root, self.BLOB_DIR, sha256[0:2], sha256)
+
+    def store(self, uid, path):
+        """
+        Store the directory in its internal storage (can be a zip file, or flat files)
+        :param uid: UUID of the Element
+        :param path: absolute path to store
+        :return: a key unique to this storage
+        :raise:
+        """
+        key = self.uid_to_key(uid)
+        basename = os.path.basename(path)
+        for root, dirs, files in os.walk(path):
+            rel_root = os.path.normpath(os.path.join(basename, os.path.relpath(root, path)))
+            for name in dirs:
+                makedir(os.path.join(self.root, key, rel_root, name))
+            for name in files:
+                self._link_file(os.path.join(root, name), os.path.join(self.root, key, rel_root, name))
+        return key
+
+    def store_descriptor(self, uid, filename, fd):
+        """
+        Store a file content given by a file descriptor
+        :param uid: UUID of the Element
+        :param fd: file descriptor
+        :return: a key unique to this storage
+        :raise:
+        """
+        components = [self.root] + self.split_uid(uid) + [uid, filename]
+        tmp_file = self._blob_temp_file()
+        sha256 = hashlib.sha256()
+        with tmp_file:
+            for data in read_file_in_chunks(fd, chunk_size=65536):
+                tmp_file.write(data)
+                sha256.update(data)
+        try:
+            self._link_blob(tmp_file.name, sha256.hexdigest(), os.path.join(*components))
+        finally:
+            remove(tmp_file.name)
+        return os.path.join(*(components[1:]))
+
+    def store_filename(self, uid, filename, path, sha256=None):
+        """
+        Store the content of a local file, that is left untouched.
+        Identical contents are only stored once.
+        :param uid: UUID of the Element
+        :param filename: name of the stored file
+        :param path: absolute path of the local file
+        :param sha256: sha256 checksum of the file, avoiding to read it again
+        :return: a key unique to this storage
+        :raise:
+        """
+        components = [self.root] + self.split_uid(uid) + [uid, filename]
+        self._link_file(path, os.path.join(*components), sha256=sha256)
+        return os.path.join(*(components[1:]))
+
+    def import_filename(self, filename, key, sub_path=''):
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        self._link_file(filename, os.path.join(*components))
+        remove(filename)
+
+    def get_file(self, key, sub_path='', mode='rb', offset=0, length=None):
+        """
+        Return a file descriptor of the given path.
+        Files opened in write mode are detached from their blob first, so other references are not modified.
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :param offset: first byte to read
+        :param length: number of bytes that can be read (the whole file if None)
+        :return: A file-like object
+        :raise:
+        """
+        if mode[0] != 'r' or '+' in mode:
+            self.delete(key if not sub_path else os.path.join(key, sub_path))
+        return super().get_file(key, sub_path=sub_path, mode=mode, offset=offset, length=length)
+
+    def delete(self, key):
+        """
+        Delete the element from its internal storage, removing blobs that are not referenced anymore
+        :param key: UUID of the Element to delete
+        :raise:
+        """
+        abs_path = os.path.join(self.root, key)
+        referenced_blobs = []
+        if os.path.isfile(abs_path):
+            referenced_blobs.append(self._referenced_blob(abs_path))
+        else:
+            for root, dirs, files in os.walk(abs_path):
+                referenced_blobs += [self._referenced_blob(os.path.join(root, name)) for name in files]
+        result = super().delete(key)
+        self._release_blobs(referenced_blobs)
+        return result
+
+    def _referenced_blob(self, path):
+        """ Return (blob path, inode) of the blob that the given file may reference, (None, None) if it is not a
+        hard link. Call :meth:`_release_blobs` once the file is removed.
+        """
+        path_stat = os.lstat(path)
+        if path_stat.st_nlink < 2:  # not stored in a blob
+            return None, None
+        try:
+            sha256 = os.getxattr(path, self.SHA256_XATTR).decode()
+        except (AttributeError, OSError):  # extended attributes are not supported
+            with open(path, 'rb') as fd:
+                sha256 = hashlib.sha256()
+                for data in read_file_in_chunks(fd, chunk_size=65536):
+                    sha256.update(data)
+                sha256 = sha256.hexdigest()
+        return self.blob_path(sha256), path_stat.st_ino
+
+    @staticmethod
+    def _release_blobs(referenced_blobs):
+        """ remove the blobs (given by :meth:`_referenced_blob`) that have no other link than themselves """
+        for blob_path, inode in referenced_blobs:
+            if blob_path is None:
+                continue
+            try:
+                blob_stat = os.stat(blob_path)
+                if blob_stat.st_ino == inode and blob_stat.st_nlink == 1:
+                    os.remove(blob_path)
+            except OSError:
+                continue
+
+    def _blob_temp_file(self):
+        blob_root = os.path.join(self.root, self.BLOB_DIR)
+        makedir(blob_root)
+        return tempfile.NamedTemporaryFile(mode='wb', dir=blob_root, prefix='tmp', delete=False)
+
+    def _link_file(self, path, abs_path, sha256=None):
+        if sha256 is None:
+            with open(path, 'rb') as fd:
+                sha256 = hashlib.sha256()
+                for data in read_file_in_chunks(fd, chunk_size=65536):
+                    sha256.update(data)
+                sha256 = sha256.hexdigest()
+        if os.path.isfile(self.blob_path(sha256)):
+            self._link_blob(path, sha256, abs_path)
+            return
+        tmp_file = self._blob_temp_file()
+        tmp_file.close()
+        try:
+            remove(tmp_file.name)
+            try:
+                os.link(path, tmp_file.name)
+            except OSError:  # not the same file system
+                shutil.copyfile(path, tmp_file.name)
+            self._link_blob(tmp_file.name, sha256, abs_path)
+        finally:
+            remove(tmp_file.name)
+
+    def _link_blob(self, tmp_path, sha256, abs_path):
+        """ create the `abs_path` file, as a hard link to the blob of `sha256`.
+        `tmp_path` is a file (in the same file system) with the expected content, used when the blob does not exist.
+        """
+        blob_path = self.blob_path(sha256)
+        makedir(os.path.dirname(blob_path))
+        makedir(os.path.dirname(abs_path))
+        referenced_blobs = [self._referenced_blob(abs_path)] if os.path.isfile(abs_path) else []
+        remove(abs_path)
+        while True:
+            try:
+                os.link(blob_path, abs_path)
+                self._release_blobs(referenced_blobs)  # the previous content of abs_path
+                return
+            except FileNotFoundError:  # no blob yet (or removed in the meantime)
+                pass
+            os.chmod(tmp_path, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            try:
+                os.setxattr(tmp_path, self.SHA256_XATTR, sha256.encode())
+            except (AttributeError, OSError):  # extended attributes are not supported
+                pass
+            try:
+                os.link(tmp_path, blob_path)
+            except FileExistsError:  # created by a concurrent process
+                pass
+
+
+class S3Storage(BaseStorage):
+    """ Storage in a S3-compatible object store (Amazon S3, MinIO, Ceph…), allowing several Moneta servers to share
+    the same files. Requires `boto3`.
+
+    Files are uploaded with multipart uploads and are directly downloaded by clients through presigned URLs.
+    Since objects are not seekable, `get_file` returns a local temporary copy of the object.
+    Last uses are not tracked (`touch` does nothing): put a :class:`CachedStorage` in front of it, or rely on the
+    lifecycle rules of the bucket to expire unused objects.
+    """
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    # noinspection PyPep8Naming
+    def __init__(self, ENGINE='', BUCKET=None, PREFIX='', PATH_LEN=1, ENDPOINT_URL=None, REGION_NAME=None,
+                 ACCESS_KEY_ID=None, SECRET_ACCESS_KEY=None, PART_SIZE=8 * 1024 * 1024, URL_EXPIRATION=300,
+                 REDIRECT=True):
+        """
+        :param BUCKET: name of the bucket (must already exist)
+        :param PREFIX: common prefix of all object names
+        :param ENDPOINT_URL: URL of the S3 service, required for non-Amazon services
+        :param PART_SIZE: size of each uploaded part (at least 5 MB)
+        :param URL_EXPIRATION: validity of the presigned URLs (in seconds)
+        :param REDIRECT: redirect clients to presigned URLs instead of sending files through Moneta
+        """
+        if boto3 is None:
+            raise ImproperlyConfigured('boto3 is required by %s' % ENGINE)
+        if not BUCKET:
+            raise ImproperlyConfigured('a bucket is required by %s' % ENGINE)
+        self.bucket = BUCKET
+        self.prefix = PREFIX.strip('/')
+        self.path_len = PATH_LEN
+        self.part_size = max(PART_SIZE, self.MIN_PART_SIZE)
+        self.url_expiration = URL_EXPIRATION
+        self.redirect = REDIRECT
+        self.client = boto3.client('s3', endpoint_url=ENDPOINT_URL, region_name=REGION_NAME,
+                                   aws_access_key_id=ACCESS_KEY_ID, aws_secret_access_key=SECRET_ACCESS_KEY)
+        super().__init__(ENGINE=ENGINE)
+
+    def uid_to_key(self, uid):
+        return '/'.join(self.split_uid(uid) + [uid])
+
+    def split_uid(self, uid):
+        return [x for x in uid[0:self.path_len]]
+
+    def object_name(self, key, sub_path=''):
+        components = [self.prefix, key, sub_path.strip('/')]
+        return '/'.join(x for x in components if x)
+
+    def store(self, uid, path):
+        """
+        Store the directory in its internal storage (can be a zip file, or flat files)
+        :param uid: UUID of the Element
+        :param path: absolute path to store
+        :return: a key unique to this storage
+        :raise:
+        """
+        key = self.uid_to_key(uid)
+        basename = os.path.basename(path)
+        for root, dirs, files in os.walk(path):
+            rel_root = os.path.relpath(root, path)
+            for name in files:
+                sub_path = os.path.normpath(os.path.join(basename, rel_root, name)).replace(os.path.sep, '/')
+                self.client.upload_file(os.path.join(root, name), self.bucket, self.object_name(key, sub_path))
+        return key
+
+    def walk(self, key, sub_path):
+        """
+        List elements (directories and files) in a given directory
+        :param key: UUID of the Element
+        :param sub_path: relative path of the directory to list
+        :return: Same behaviour as os.walk
+        :raise:
+        """
+        root_name = self.object_name(key)
+        name = self.object_name(key, sub_path)
+        if self._head(name) is not None:
+            rel_dir, __, filename = name[len(root_name) + 1:].rpartition('/')
+            yield rel_dir or '.', [], [filename]
+            return
+        directories = {}  # directories[path relative to the key] = (subdirectories, files)
+        start = name[len(root_name) + 1:]
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=name + '/'):
+            for obj in page.get('Contents', []):
+                rel_dir, __, filename = obj['Key'][len(root_name) + 1:].rpartition('/')
+                directories.setdefault(rel_dir, ([], []))[1].append(filename)
+                while rel_dir != start:
+                    parent, __, dirname = rel_dir.rpartition('/')
+                    subdirectories = directories.setdefault(parent, ([], []))[0]
+                    if dirname in subdirectories:
+                        break
+                    subdirectories.append(dirname)
+                    rel_dir = parent
+        to_visit = [start] if start in directories else []
+        while to_visit:
+            rel_dir = to_visit.pop(0)
+            dirs, files = directories[rel_dir]
+            yield rel_dir or '.', dirs, files
+            to_visit += ['%s/%s' % (rel_dir, x) if rel_dir else x for x in dirs]
+
+    def store_descriptor(self, uid, filename, fd):
+        """
+        Store a file content given by a file descriptor, using a multipart upload for large files.
+        :param uid: UUID of the Element
+        :param fd: file descriptor
+        :return: a key unique to this storage
+        :raise:
+        """
+        key = '/'.join(self.split_uid(uid) + [uid, filename])
+        name = self.object_name(key)
+        data = fd.read(self.part_size)
+        next_data = fd.read(self.part_size) if data else b''
+        if not next_data:  # a single part
+            self.client.put_object(Bucket=self.bucket, Key=name, Body=data)
+            return key
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=name)['UploadId']
+        parts = []
+        try:
+            while data:
+                part = self.client.upload_part(Bucket=self.bucket, Key=name, UploadId=upload_id,
+                                               PartNumber=len(parts) + 1, Body=data)
+                parts.append({'PartNumber': len(parts) + 1, 'ETag': part['ETag']})
+                data, next_data = next_data, fd.read(self.part_size) if next_data else b''
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id,
+                                                  MultipartUpload={'Parts': parts})
+        except Exception as e:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=name, UploadId=upload_id)
+            raise e
+        return key
+
+    def get_file(self, key, sub_path='', mode='rb', offset=0, length=None):
+        """
+        Return a file descriptor in read mode of the given path, as a local temporary copy of the object.
+        Only the requested range is downloaded.
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :param offset: first byte to read
+        :param length: number of bytes that can be read (the whole file if None)
+        :return: A file-like object
+        :raise:
+        """
+        if mode not in ('r', 'rb'):
+            raise ValueError('%s only supports read modes' % self.__class__.__name__)
+        fd = tempfile.SpooledTemporaryFile(max_size=self.part_size)
+        name = self.object_name(key, sub_path)
+        try:
+            if offset or length is not None:
+                if length == 0:
+                    return fd
+                byte_range = 'bytes=%d-%s' % (offset, '' if length is None else offset + length - 1)
+                body = self.client.get_object(Bucket=self.bucket, Key=name, Range=byte_range)['Body']
+                shutil.copyfileobj(body, fd)
+            else:
+                self.client.download_fileobj(self.bucket, name, fd)
+        except ClientError:
+            fd.close()
+            return None
+        fd.seek(0)
+        return fd
+
+    def get_path(self, key, sub_path):
+        return None
+
+    def get_relative_path(self, key, sub_path):
+        return None
+
+    def get_url(self, key, sub_path, content_type=None, content_disposition=None):
+        """ return a presigned URL of the object, valid for `URL_EXPIRATION` seconds.
+
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :param content_type: Content-Type header that should be sent with the file
+        :param content_disposition: Content-Disposition header that should be sent with the file
+        :return: `str`
+        """
+        if not self.redirect:
+            return None
+        params = {'Bucket': self.bucket, 'Key': self.object_name(key, sub_path)}
+        if content_type:
+            params['ResponseContentType'] = content_type
+        if content_disposition:
+            params['ResponseContentDisposition'] = content_disposition
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expiration)
+
+    def delete(self, key):
+        """
+        Delete the element (a single object, or all objects under this key) from its internal storage
+        :param key: UUID of the Element to delete
+        :raise:
+        """
+        name = self.object_name(key)
+        names = [name] if self._head(name) is not None else []
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=name + '/'):
+            names += [obj['Key'] for obj in page.get('Contents', [])]
+        for index in range(0, len(names), 1000):
+            self.client.delete_objects(Bucket=self.bucket,
+                                       Delete={'Objects': [{'Key': x} for x in names[index:index + 1000]],
+                                               'Quiet': True})
+        return True
+
+    def import_filename(self, filename, key, sub_path=''):
+        self.client.upload_file(filename, self.bucket, self.object_name(key, sub_path))
+        remove(filename)
+
+    def get_size(self, key, sub_path):
+        head = self._head(self.object_name(key, sub_path))
+        if head is None:
+            raise FileNotFoundError(self.object_name(key, sub_path))
+        return head['ContentLength']
+
+    def get_mtime(self, key, sub_path):
+        head = self._head(self.object_name(key, sub_path))
+        if head is None:
+            raise FileNotFoundError(self.object_name(key, sub_path))
+        return head['LastModified'].timestamp()
+
+    def get_stat(self, key, sub_path):
+        head = self._head(self.object_name(key, sub_path))
+        if head is None:
+            raise FileNotFoundError(self.object_name(key, sub_path))
+        return head['ContentLength'], head['LastModified'].timestamp()
+
+    def mimetype(self, key, sub_path):
+        return mimetypes.guess_type(self.object_name(key, sub_path))[0] or 'application/octet-stream'
+
+    def _head(self, name):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=name)
+        except ClientError:
+            return None
+
+
+class CachedStorage(BaseStorage):
+    """ Local disk cache in front of a slower storage (NFS, S3…).
+
+    Writes go through to the backend storage, while files are read from a local copy that is created on the first
+    read. `get_path` returns this local copy, so files can still be sent by the web server (X-Accel-Redirect or
+    X-SENDFILE). The total size of the cache is bounded by `MAX_SIZE`: least recently used files are evicted first.
+
+    Local copies keep the modification time of the backend file, so they have the same validators (size and mtime),
+    while their access time tracks their last use. Since other servers can modify the backend files (index files,
+    markers…), local copies are checked against the backend at most every `MAX_AGE` seconds.
+    """
+
+    # noinspection PyPep8Naming
+    def __init__(self, ENGINE='', BACKEND=None, CACHE_ROOT=None, MAX_SIZE=10 * 1024 * 1024 * 1024, MAX_AGE=10):
+        """
+        :param BACKEND: settings of the backend storage, like any value of `settings.STORAGES`
+        :param CACHE_ROOT: local directory of cached files
+        :param MAX_SIZE: maximum size of the cache (in bytes)
+        :param MAX_AGE: delay (in seconds) during which a local copy is used without being checked against the backend
+        """
+        if not BACKEND or not CACHE_ROOT:
+            raise ImproperlyConfigured('BACKEND and CACHE_ROOT are required by %s' % ENGINE)
+        self.backend = import_path(BACKEND['ENGINE'])(**BACKEND)
+        self.root = os.path.abspath(CACHE_ROOT)
+        self.max_size = MAX_SIZE
+        self.max_age = MAX_AGE
+        self.check_dates = {}  # {local path: last time it matched the backend file}
+        self.cache_size = None  # estimation of the cache size, computed on the first eviction check
+        super().__init__(ENGINE=ENGINE)
+
+    def uid_to_key(self, uid):
+        return self.backend.uid_to_key(uid)
+
+    def store(self, uid, path):
+        key = self.backend.store(uid, path)
+        self.invalidate(key)
+        return key
+
+    def walk(self, key, sub_path):
+        return self.backend.walk(key, sub_path)
+
+    def store_descriptor(self, uid, filename, fd):
+        key = self.backend.store_descriptor(uid, filename, fd)
+        self.invalidate(key)
+        return key
+
+    def store_filename(self, uid, filename, path, sha256=None):
+        key = self.backend.store_filename(uid, filename, path, sha256=sha256)
+        self.invalidate(key)
+        return key
+
+    def get_file(self, key, sub_path='', mode='rb', offset=0, length=None):
+        """
+        Return a file descriptor of the given path. Files are read from the local cache and written to the backend.
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :param offset: first byte to read
+        :param length: number of bytes that can be read (the whole file if None)
+        :return: A file-like object
+        :raise:
+        """
+        if mode[0] != 'r' or '+' in mode:
+            self.invalidate(key, sub_path)
+            return self.backend.get_file(key, sub_path=sub_path, mode=mode, offset=offset, length=length)
+        path = self.get_path(key, sub_path)
+        if path is None:
+            return None
+        try:
+            return file_range(open(path, mode), offset, length)
+        except IOError:  # evicted in the meantime
+            return self.backend.get_file(key, sub_path=sub_path, mode=mode, offset=offset, length=length)
+
+    def get_path(self, key, sub_path):
+        """ return the absolute path of the local copy of the file, copying it from the backend if required.
+
+        :param key: UUID of the Element
+        :param sub_path: relative path to read
+        :return: `str`, or None if the file does not exist
+        """
+        path = self.cache_path(key, sub_path)
+        if self.is_fresh(key, sub_path):
+            try:
+                os.utime(path, (time.time(), os.path.getmtime(path)))  # mark it as recently used
+                return path
+            except OSError:  # evicted in the meantime
+                pass
+        try:
+            mtime = self.backend.get_mtime(key, sub_path)
+        except OSError:
+            return None
+        check_date = time.time()
+        makedir(os.path.dirname(path))
+        tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=os.path.dirname(path), prefix='.tmp', delete=False)
+        try:
+            with tmp_file:
+                backend_path = self.backend.get_path(key, sub_path)
+                if backend_path is not None:
+                    try:
+                        with open(backend_path, 'rb') as fd:
+                            shutil.copyfileobj(fd, tmp_file)
+                    except IOError:
+                        return None
+                else:
+                    fd = self.backend.get_file(key, sub_path)
+                    if fd is None:
+                        return None
+                    with fd:
+                        shutil.copyfileobj(fd, tmp_file)
+            os.chmod(tmp_file.name, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.utime(tmp_file.name, (time.time(), mtime))
+            os.replace(tmp_file.name, path)
+        finally:
+            remove(tmp_file.name)
+        self.check_dates[path] = check_date
+        self.evict(os.path.getsize(path))
+        return path
+
+    def is_fresh(self, key, sub_path):
+        """ return True if the local copy of the file exists and still matches the backend file.
+        The backend is only requested if the copy has not been checked during the last `MAX_AGE` seconds;
+        the local copy is removed if the backend file has been deleted.
+        """
+        path = self.cache_path(key, sub_path)
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return False
+        if not stat.S_ISREG(file_stat.st_mode):  # never a directory of cached files
+            return False
+        now = time.time()
+        if now - self.check_dates.get(path, 0) <= self.max_age:
+            return True
+        try:
+            size, mtime = self.backend.get_stat(key, sub_path)
+        except OSError:
+            self.invalidate(key, sub_path)
+            return False
+        if size != file_stat.st_size or int(mtime) != int(file_stat.st_mtime):
+            return False
+        self.check_dates[path] = now
+        return True
+
+    def get_relative_path(self, key, sub_path):
+        path = self.get_path(key, sub_path)
+        return None if path is None else os.path.relpath(path, self.root)
+
+    def delete(self, key):
+        result = self.backend.delete(key)
+        self.invalidate(key)
+        return result
+
+    def import_filename(self, filename, key, sub_path=''):
+        self.invalidate(key, sub_path)
+        return self.backend.import_filename(filename, key, sub_path=sub_path)
+
+    def get_size(self, key, sub_path):
+        return self.get_stat(key, sub_path)[0]
+
+    def get_mtime(self, key, sub_path):
+        return self.get_stat(key, sub_path)[1]
+
+    def get_stat(self, key, sub_path):
+        path = self.cache_path(key, sub_path)
+        if self.is_fresh(key, sub_path):
+            try:
+                file_stat = os.stat(path)
+                return file_stat.st_size, file_stat.st_mtime
+            except OSError:  # evicted in the meantime
+                pass
+        return self.backend.get_stat(key, sub_path)
+
+    def touch(self, key, sub_path):
+        # only the local copy is marked: S3 objects cannot be marked without being rewritten
+        path = self.cache_path(key, sub_path)
+        if os.path.isfile(path):
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+
+    def get_last_use(self, key, sub_path):
+        path = self.cache_path(key, sub_path)
+        if os.path.isfile(path):
+            try:
+                file_stat = os.stat(path)
+                return max(file_stat.st_atime, file_stat.st_mtime)
+            except OSError:  # evicted in the meantime
+                pass
+        return self.backend.get_last_use(key, sub_path)
+
+    def mimetype(self, key, sub_path):
+        return self.backend.mimetype(key, sub_path)
+
+    def cache_path(self, key, sub_path=''):
+        components = [self.root, key]
+        if sub_path:
+            components.append(sub_path)
+        return os.path.join(*components)
+
+    def invalidate(self, key, sub_path=''):
+        """ remove the local copy of the given file (or directory) """
+        remove(self.cache_path(key, sub_path))
+
+    def evict(self, added_size=0):
+        """ remove the least recently used files until the cache fits in `MAX_SIZE`
+
+        :param added_size: size of the file that has just been added to the cache
+        """
+        if self.cache_size is not None:
+            self.cache_size += added_size
+            if self.cache_size <= self.max_size:
+                return
+        # the estimation may be wrong, since other processes share the same cache
+        cached_files = []
+        now = time.time()
+        for root, dirs, files in os.walk(self.root):
+            for name in files:
+                try:
+                    file_stat = os.stat(os.path.join(root, name))
+                except OSError:  # removed in the meantime
+                    continue
+                if name.startswith('.tmp') and file_stat.st_mtime > now - 3600:
+                    continue  # being copied from the backend by another thread or process
+                cached_files.append((file_stat.st_atime, file_stat.st_size, os.path.join(root, name)))
+        self.cache_size = sum(x[1] for x in cached_files)
+        cached_files.sort()
+        # evict a bit more than required, to avoid a scan of the cache at each new file
+        max_size = self.max_size * 9 // 10 if self.cache_size > self.max_size else self.max_size
+        for atime, size, path in cached_files:
+            if self.cache_size <= max_size:
+                break
+            remove(path)
+            self.check_dates.pop(path, None)
+            self.cache_size -= size
+
+
 if __name__ == '__main__':
     import doctest
 
@@ -2,8 +2,12 @@
 Utility module providing nice (colorized) logger.
 
 """
+import bz2
+import difflib
 from bz2 import BZ2Decompressor
 import gzip
+import hashlib
+import heapq
 import logging
 import logging.handlers
 import os
@@ -19,6 +23,30 @@ from django.http import QueryDict
 from djangofloor.utils import import_module
 from django.utils.translation import gettext_lazy as _
 
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    # noinspection PyPackageRequirements
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    # noinspection PyPackageRequirements
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+# compression codecs of index files: {name: (file extension, default level, min level, max level)}
+INDEX_CODECS = {
+    'gz': ('.gz', 9, 1, 9),
+    'bz2': ('.bz2', 9, 1, 9),
+    'xz': ('.xz', 6, 0, 9),
+    'zst': ('.zst', 19, 1, 22),
+    'lz4': ('.lz4', 9, 0, 16),
+}
+
 
 def import_path(middleware_path):
     try:
@@ -86,7 +114,7 @@ def makedir(path):
     # noinspection PyBroadException
     try:
         if not os.path.isdir(path):
-            os.makedirs(path)
+            os.makedirs(path, exist_ok=True)  # may be concurrently created by another thread
     except Exception:
         result = False
         logging.warning(_('Unable to create directory %(path)s.') % {'path': path, }, exc_info=True)
@@ -111,6 +139,61 @@ def mkdtemp():
     return tempfile.mkdtemp(dir=settings.FILE_UPLOAD_TEMP_DIR, prefix='moneta')
 
 
+def available_codecs():
+    """ names of the compression codecs of :data:`INDEX_CODECS` whose Python module is installed """
+    modules = {'gz': gzip, 'bz2': bz2, 'xz': lzma, 'zst': zstandard, 'lz4': lz4_frame}
+    return [name for name in sorted(INDEX_CODECS) if modules[name] is not None]
+
+
+def parse_codecs(value):
+    """
+    Parse a list of compression codecs, like "gz:9 bz2 xz:6" (the level of each codec is optional).
+    :param value: space-separated list of codecs with their levels
+    :return: list of (codec name, file extension, level)
+    :raise: ValueError if a codec is unknown, unavailable or if a level is invalid
+
+    >>> parse_codecs('gz:6 bz2')
+    [('gz', '.gz', 6), ('bz2', '.bz2', 9)]
+    """
+    result = []
+    for codec in value.split():
+        name, sep, level = codec.partition(':')
+        if name not in INDEX_CODECS:
+            raise ValueError(_('Unknown compression codec: %(codec)s.') % {'codec': name})
+        elif name not in available_codecs():
+            raise ValueError(_('Compression codec %(codec)s is not available on this server.') % {'codec': name})
+        extension, default_level, min_level, max_level = INDEX_CODECS[name]
+        if not sep:
+            level = default_level
+        elif not level.isdigit() or not min_level <= int(level) <= max_level:
+            raise ValueError(_('Level of %(codec)s must be between %(min)d and %(max)d.') %
+                             {'codec': name, 'min': min_level, 'max': max_level})
+        if name not in [x[0] for x in result]:
+            result.append((name, extension, int(level)))
+    return result
+
+
+def compressed_writer(fileobj, codec, level):
+    """ Return a writable file object that compresses written data to `fileobj`.
+    Closing the returned object does not close `fileobj`.
+
+    :param fileobj: writable file object
+    :param codec: name of a compression codec (a key of :data:`INDEX_CODECS`)
+    :param level: compression level
+    """
+    if codec == 'gz':
+        return gzip.GzipFile(filename='', mode='wb', compresslevel=level, fileobj=fileobj)
+    elif codec == 'bz2':
+        return bz2.BZ2File(fileobj, mode='wb', compresslevel=level)
+    elif codec == 'xz':
+        return lzma.LZMAFile(fileobj, mode='wb', preset=level)
+    elif codec == 'zst':
+        return zstandard.ZstdCompressor(level=level).stream_writer(fileobj, closefd=False)
+    elif codec == 'lz4':
+        return lz4_frame.LZ4FrameFile(fileobj, mode='wb', compression_level=level)
+    raise ValueError(codec)
+
+
 def read_file_in_chunks(fileobj, chunk_size=4096):
     while True:
         data = fileobj.read(chunk_size)
@@ -119,6 +202,242 @@ def read_file_in_chunks(fileobj, chunk_size=4096):
         yield data
 
 
+def merge_sorted(iterables, fanout=64):
+    """ Merge sorted iterables of lines (`bytes` ending with a newline) into a single sorted iterator.
+
+    At most `fanout` iterables are consumed at the same time: larger merges are first spilled to temporary files
+    (sorted runs). Runs stay closed until `fanout` runs of the same level are merged into a run of the next level, so
+    memory usage and open files do not depend on the number of iterables.
+
+    :param iterables: iterable of sorted iterables (possibly lazily opened)
+    :param fanout: maximum number of iterables merged at once
+    :return: iterator of lines
+    """
+    fanout = max(fanout, 2)
+    levels = []  # levels[i]: paths of runs made of `fanout ** (i + 1)` iterables at most
+    created = []
+
+    def spill(its):
+        fd, path = tempfile.mkstemp(dir=settings.FILE_UPLOAD_TEMP_DIR)
+        created.append(path)
+        with open(fd, 'wb') as run:
+            for line_ in heapq.merge(*its):
+                run.write(line_)
+        return path
+
+    def merge_runs(paths):
+        runs = []
+        try:
+            for path in paths:
+                runs.append(open(path, 'rb'))
+            return spill(runs)
+        finally:
+            for run in runs:
+                run.close()
+            for path in paths:
+                remove(path)
+
+    def add_run(path, level=0):
+        if len(levels) == level:
+            levels.append([])
+        levels[level].append(path)
+        if len(levels[level]) == fanout:
+            paths, levels[level] = levels[level], []
+            add_run(merge_runs(paths), level=level + 1)
+
+    batch = []
+    try:
+        for iterable in iterables:
+            batch.append(iterable)
+            if len(batch) == fanout:
+                add_run(spill(batch))
+                batch = []
+        if not levels:
+            yield from heapq.merge(*batch)
+            return
+        elif batch:
+            add_run(spill(batch))
+        # smallest runs first, merged until the remaining ones can be merged at once
+        paths = [path for level in levels for path in level]
+        while len(paths) > fanout:
+            count = min(fanout, len(paths) - fanout + 1)
+            paths = [merge_runs(paths[:count])] + paths[count:]
+        runs = []
+        try:
+            for path in paths:
+                runs.append(open(path, 'rb'))
+            yield from heapq.merge(*runs)
+        finally:
+            for run in runs:
+                run.close()
+    finally:
+        for path in created:
+            remove(path)
+
+
+def ed_diff(old_lines, new_lines):
+    """ Return an ed script (as used by Debian PDiff files) that transforms `old_lines` into `new_lines`.
+    Commands are sorted by decreasing line numbers, so they can be applied in a single pass.
+
+    :param old_lines: list of `bytes` (ending with a newline)
+    :param new_lines: list of `bytes` (ending with a newline)
+    :return: `bytes`
+    """
+    commands = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines)
+    for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+        lines = '%d,%d' % (i1 + 1, i2) if i2 - i1 > 1 else '%d' % i2
+        if tag == 'equal':
+            continue
+        elif tag == 'delete':
+            commands.append(('%sd\n' % lines).encode())
+            continue
+        elif tag == 'insert':
+            commands.append(('%da\n' % i1).encode())
+        else:
+            commands.append(('%sc\n' % lines).encode())
+        commands += new_lines[j1:j2]
+        commands.append(b'.\n')
+    return b''.join(commands)
+
+
+class FileDigests(object):
+    """ md5, sha1 and sha256 checksums and size of some data, computed chunk by chunk """
+
+    def __init__(self):
+        self._md5 = hashlib.md5()
+        self._sha1 = hashlib.sha1()
+        self._sha256 = hashlib.sha256()
+        self.size = 0
+
+    @classmethod
+    def from_file(cls, fileobj, chunk_size=65536):
+        digests = cls()
+        for data in read_file_in_chunks(fileobj, chunk_size=chunk_size):
+            digests.update(data)
+        return digests
+
+    def update(self, data):
+        self._md5.update(data)
+        self._sha1.update(data)
+        self._sha256.update(data)
+        self.size += len(data)
+
+    @property
+    def md5(self):
+        return self._md5.hexdigest()
+
+    @property
+    def sha1(self):
+        return self._sha1.hexdigest()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest()
+
+
+class DigestReader(object):
+    """ Wrap a readable file object and compute the checksums of its content while it is read.
+
+    Checksums are only available once the whole file has been sequentially read from its beginning,
+    whatever the other `seek` and `read` operations made in the meantime.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self._digests = FileDigests()
+        self._is_complete = False
+
+    @property
+    def digests(self):
+        """ :class:`FileDigests` of the complete file, or None if the file has not been entirely read """
+        return self._digests if self._is_complete else None
+
+    def read(self, size=-1):
+        offset = self.fileobj.tell()
+        data = self.fileobj.read(size)
+        if offset == self._digests.size and not self._is_complete:
+            if data:
+                self._digests.update(data)
+            else:
+                self._is_complete = True
+        return data
+
+    def __getattr__(self, item):
+        return getattr(self.fileobj, item)
+
+    def __iter__(self):
+        return read_file_in_chunks(self)
+
+
+class DigestWriter(object):
+    """ Wrap a writable file object and compute the checksums of all written data """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digests = FileDigests()
+
+    def write(self, data):
+        self.digests.update(data)
+        return self.fileobj.write(data)
+
+    def __getattr__(self, item):
+        return getattr(self.fileobj, item)
+
+
+class LimitedReader(object):
+    """ Wrap a readable file object and only give access to its next `length` bytes """
+
+    def __init__(self, fileobj, length):
+        self.fileobj = fileobj
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size) if size > 0 else b''
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def parse_byte_ranges(header, size):
+    """
+    Parse the value of a HTTP Range header (like `bytes=0-499,-500`)
+    :param header: value of the HTTP header
+    :param size: total size of the file
+    :return: None if the header is invalid (and must be ignored), otherwise the list of satisfiable ranges as
+     (first byte, last byte) tuples (an empty list if no range can be satisfied)
+    """
+    unit, __, ranges = header.partition('=')
+    if unit.strip() != 'bytes' or not ranges.strip():
+        return None
+    result = []
+    for byte_range in ranges.split(','):
+        first, sep, last = byte_range.strip().partition('-')
+        first, last = first.strip(), last.strip()
+        if not sep or not (first or last) or (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:  # suffix range: the last bytes of the file
+            if int(last) > 0 and size > 0:
+                result.append((max(size - int(last), 0), size - 1))
+            continue
+        if last and int(last) < int(first):
+            return None
+        first, last = int(first), min(int(last) if last else size - 1, size - 1)
+        if first < size:
+            result.append((first, last))
+    return result
+
+
 class ZlibFile(object):
     def __init__(self, fileobj):
         self.__fileobj = fileobj
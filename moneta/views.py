@@ -1,35 +1,38 @@
 import base64
-import hashlib
 import mimetypes
 import os
-import tarfile
 import tempfile
 import time
-import zipfile
+import uuid
 from distutils.version import LooseVersion
 
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ValidationError
-from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.core.paginator import Paginator, PageNotAnInteger, EmptyPage
 from django.urls import reverse
 from django.core.validators import RegexValidator
-from django.db.models import Count
+from django.db.models import Count, Max, Sum
 from django.http import HttpResponseRedirect, Http404, StreamingHttpResponse, HttpResponse, HttpRequest
 from django.shortcuts import get_object_or_404
 from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import csrf_exempt
 
 from djangofloor.views import send_file
+from moneta.archives import stream_archive
 from moneta.exceptions import InvalidRepositoryException
+from moneta.repositories.scheduler import index_scheduler
 from moneta.repository.forms import get_repository_form, RepositoryUpdateForm
-from moneta.repository.models import Repository, ArchiveState, Element, storage, ElementSignature
+from moneta.repository.models import Repository, ArchiveState, Element, storage, ElementSignature, \
+    ARCHIVE_VARIANTS_UID
 from moneta.repository.signing import get_gpg
-from moneta.utils import read_file_in_chunks
+from moneta.utils import read_file_in_chunks, FileDigests, parse_byte_ranges, makedir, remove
 
 __author__ = 'flanker'
 GPG = get_gpg()
@@ -48,7 +51,8 @@ def index(request: HttpRequest):
             author = None if user.is_anonymous else user
             repo = Repository(author=author, name=form.cleaned_data['name'], on_index=form.cleaned_data['on_index'],
                               archive_type=form.cleaned_data['archive_type'],
-                              is_private=form.cleaned_data['is_private'])
+                              is_private=form.cleaned_data['is_private'],
+                              index_compression=' '.join(form.cleaned_data['index_compression'].split()))
             repo.save()
             for group in form.cleaned_data['admin_group']:
                 repo.admin_group.add(group)
@@ -144,6 +148,7 @@ def modify_repository(request: HttpRequest, rid):
                 ArchiveState(name=name, repository=repo, author=author).save()
             repo.on_index = form.cleaned_data['on_index']
             repo.is_private = form.cleaned_data['is_private']
+            repo.index_compression = ' '.join(form.cleaned_data['index_compression'].split())
             repo.save()
             repo.admin_group.clear()
             for group in form.cleaned_data['admin_group']:
@@ -155,10 +160,12 @@ def modify_repository(request: HttpRequest, rid):
             # noinspection PyUnresolvedReferences
             Element.states.through.objects.filter(archivestate__in=removed_states).delete()
             removed_states.delete()
+            index_scheduler.mark_dirty(repo)
             messages.info(request, _('The repository %(repo)s has been modified.') % {'repo': repo.name})
             return HttpResponseRedirect(reverse('moneta:modify_repository', kwargs={'rid': rid, }))
     else:
         form = RepositoryUpdateForm(initial={'on_index': repo.on_index, 'is_private': repo.is_private,
+                                             'index_compression': repo.index_compression,
                                              'reader_group': list(repo.reader_group.all()),
                                              'states': ' '.join([x.name for x in repo.archivestate_set.all()]),
                                              'admin_group': list(repo.admin_group.all())})
@@ -218,6 +225,7 @@ def delete_element(request: HttpRequest, rid, eid):
         form = DeleteRepositoryForm(request.POST)
         if form.is_valid():
             element.delete()
+            index_scheduler.mark_dirty(repo)
             messages.warning(request, _('The package %(repo)s has been deleted.') % {'repo': element.full_name})
             return HttpResponseRedirect(reverse('moneta:index'))
     else:
@@ -237,13 +245,6 @@ def generic_add_element(request: HttpRequest, repo, uploaded_file, state_names,
     :param state_names: iterable of ArchiveState.name
     :return: successfully added Element
     """
-    sha256 = hashlib.sha256()
-    data = uploaded_file.file.read(4096)
-    while data:
-        sha256.update(data)
-        data = uploaded_file.file.read(4096)
-    sha256_sum = sha256.hexdigest()
-    uploaded_file.file.seek(0)
     if uploaded_file.name:
         filename = os.path.basename(uploaded_file.name)
         elements = list(Element.objects.filter(repository=repo, filename=filename)[0:1])
@@ -251,7 +252,10 @@ def generic_add_element(request: HttpRequest, repo, uploaded_file, state_names,
         name = os.path.basename(name)
         elements = list(Element.objects.filter(repository=repo, name=name)[0:1])
     else:
-        elements = list(Element.objects.filter(repository=repo, sha256=sha256_sum)[0:1])
+        if getattr(uploaded_file, 'digests', None) is None:
+            uploaded_file.digests = FileDigests.from_file(uploaded_file.file)
+            uploaded_file.file.seek(0)
+        elements = list(Element.objects.filter(repository=repo, sha256=uploaded_file.digests.sha256)[0:1])
     if elements:
         element = elements[0]
     else:
@@ -345,18 +349,22 @@ def add_element_post(request: HttpRequest, rid):
     if not form.is_valid():
         return TemplateResponse(request, 'moneta/not_allowed.html', {}, status=405)
 
-    tmp_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-    c = False
+    # the request body is read only once: checksums are computed while it is written to the disk
+    # this temporary file is then directly used by the archive storage
+    uploaded_file = TemporaryUploadedFile(form.cleaned_data['filename'], 'application/octet-stream', 0, None)
+    digests = FileDigests()
     chunk = request.read(32768)
     while chunk:
-        tmp_file.write(chunk)
-        c = True
+        uploaded_file.write(chunk)
+        digests.update(chunk)
         chunk = request.read(32768)
-    tmp_file.flush()
-    tmp_file.seek(0)
-    if not c:
+    uploaded_file.flush()
+    uploaded_file.seek(0)
+    if not digests.size:
+        uploaded_file.close()
         return HttpResponse(_('Empty file. You must POST a valid file.\n'), status=400)
-    uploaded_file = UploadedFile(name=form.cleaned_data['filename'], file=tmp_file)
+    uploaded_file.size = digests.size
+    uploaded_file.digests = digests
     try:
         element = generic_add_element(request, repo, uploaded_file, form.cleaned_data['states'],
                                       name=form.cleaned_data.get('name'), archive=form.cleaned_data.get('archive'),
@@ -364,7 +372,7 @@ def add_element_post(request: HttpRequest, rid):
     except InvalidRepositoryException as e:
         return HttpResponse(str(e), status=400)
     finally:
-        tmp_file.close()
+        uploaded_file.close()
     template_values = {'repo': repo, 'element': element}
     return HttpResponse(_('Package %(element)s successfully added to repository %(repo)s.\n') % template_values)
 
@@ -428,7 +436,7 @@ def get_file(request: HttpRequest, eid: int, compression: str=None, path: str=''
     name = name
     if element is None:
         element = get_object_or_404(Element.reader_queryset(request).select_related(), id=eid)
-    arc_storage, arc_key, arc_path = None, None, None
+    arc_storage, arc_key, arc_path, arc_filename = None, None, None, None
     mimetype = 'application/octet-stream'
     if element.uncompressed_key and path:  # case 1
         path = os.path.normpath(path)
@@ -439,70 +447,259 @@ def get_file(request: HttpRequest, eid: int, compression: str=None, path: str=''
     elif element.archive_key:  # case 2 or 3
         if compression is not None:  # case 2
             arc_storage, arc_key, arc_path = storage(settings.STORAGE_ARCHIVE), element.archive_key, ''
+            arc_filename = os.path.basename(element.filename)
     else:
         raise Http404
     if arc_storage is not None:
-        temp_file = tempfile.TemporaryFile(mode='w+b', dir=settings.FILE_UPLOAD_TEMP_DIR)
-        comp_file = None
-        ext = ''
+        etag = '%s-%s' % (element.sha256 or element.uuid, compression)
+        last_modified = int(element.modification.timestamp())
+        response = conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
         if compression == 'zip':
             mimetype = 'application/zip'
             ext = '.zip'
-            comp_file = zipfile.ZipFile(temp_file, 'w', zipfile.ZIP_DEFLATED)
-        elif compression == 'tgz':
+        elif compression in ('tgz', 'tbz'):
             mimetype = 'application/x-tar'
-            ext = '.tgz'
-            comp_file = tarfile.open(None, 'w:gz', fileobj=temp_file)
-            comp_file.write = comp_file.addfile
-        elif compression == 'tbz':
-            mimetype = 'application/x-tar'
-            ext = '.tbz'
-            comp_file = tarfile.open(None, 'w:bz2', fileobj=temp_file)
-            comp_file.write = comp_file.addfile
-        reldir = None
-        for root, dirs, files in arc_storage.walk(arc_key, arc_path):
-            if reldir is None:
-                reldir = root
-            for name in files:
-                fullname = os.path.join(root, name)
-                fileobj = arc_storage.get_file(arc_key, fullname)
-                arcname = os.path.relpath(fullname, reldir)
-                tarinfo = tarfile.TarInfo(arcname)
-                tarinfo.size = arc_storage.get_size(arc_key, fullname)
-                comp_file.write(tarinfo, fileobj)
-        comp_file.close()
-        temp_file.seek(0)
-        fileobj = temp_file
+            ext = '.' + compression
+        else:
+            raise Http404
         filename = os.path.basename(element.filename) + ext
+        content = stream_archive(storage_members(arc_storage, arc_key, arc_path, arc_filename), compression)
+        if element.sha256:  # generated archives are cached, shared by all elements with the same content
+            cache_storage = storage(settings.STORAGE_CACHE)
+            cache_key = cache_storage.uid_to_key(ARCHIVE_VARIANTS_UID)
+            cache_path = os.path.join(element.sha256, filename)
+            try:
+                cache_storage.get_size(cache_key, cache_path)
+            except OSError:
+                content = cache_archive(content, cache_storage, cache_key, cache_path)
+            else:
+                content.close()
+                try:
+                    cache_storage.touch(cache_key, cache_path)  # archives are evicted by their last use
+                except OSError:  # evicted in the meantime
+                    pass
+                return sendpath(settings.STORAGE_CACHE, cache_key, cache_path, mimetype, request=request, etag=etag)
     elif path:
         mimetype = mimetypes.guess_type(path)[0]
         if mimetype is None:
             mimetype = 'application/octet-stream'
-        return sendpath(settings.STORAGE_UNCOMPRESSED, element.uncompressed_key, path, mimetype)
+        return sendpath(settings.STORAGE_UNCOMPRESSED, element.uncompressed_key, path, mimetype, request=request)
     else:
-        return sendpath(settings.STORAGE_ARCHIVE, element.archive_key, '', element.mimetype)
-    response = StreamingHttpResponse(read_file_in_chunks(fileobj), content_type=mimetype)
+        return sendpath(settings.STORAGE_ARCHIVE, element.archive_key, '', element.mimetype, request=request,
+                        etag=element.sha256 or None)
+    response = StreamingHttpResponse(content, content_type=mimetype)
     if mimetype[0:4] != 'text' and mimetype[0:5] != 'image':
         response['Content-Disposition'] = 'attachment; filename={0}'.format(filename)
-    return response
+    return set_validators(response, etag=etag, last_modified=last_modified)
+
+
+def cache_archive(content, cache_storage, key, sub_path):
+    """ yield the content of a generated archive while it is copied to the cache storage.
+    The archive is stored only if it is completely generated. """
+    makedir(settings.FILE_UPLOAD_TEMP_DIR)
+    tmp_file = tempfile.NamedTemporaryFile(mode='wb', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False)
+    try:
+        with tmp_file:
+            for data in content:
+                tmp_file.write(data)
+                yield data
+        size = os.path.getsize(tmp_file.name)
+        cache_storage.import_filename(tmp_file.name, key, sub_path)
+        evict_archives(cache_storage, key, added_size=size)
+    finally:
+        remove(tmp_file.name)
 
 
-def sendpath(storage_type, key, path, mimetype):
+# estimation of the size of the cached archives (other processes also add archives), computed on the first eviction
+archive_cache_size = None
+
+
+def evict_archives(cache_storage, key, added_size=0):
+    """ remove the least recently used archives until their total size is below
+    `settings.ARCHIVE_VARIANTS_MAX_SIZE`. The cache is only scanned when the estimation of its size is too large.
+
+    :param added_size: size of the archive that has just been added to the cache
+    """
+    global archive_cache_size
+    if archive_cache_size is not None:
+        archive_cache_size += added_size
+        if archive_cache_size <= settings.ARCHIVE_VARIANTS_MAX_SIZE:
+            return
+    archives = []
+    for root, dirs, files in cache_storage.walk(key, ''):
+        for name in files:
+            sub_path = os.path.normpath(os.path.join(root, name))
+            try:  # archives are marked each time they are sent
+                archives.append((cache_storage.get_last_use(key, sub_path), cache_storage.get_size(key, sub_path),
+                                 sub_path))
+            except OSError:  # removed in the meantime
+                continue
+    archive_cache_size = sum(x[1] for x in archives)
+    archives.sort()
+    # evict a bit more than required, to avoid a scan of the cache at each new archive
+    max_size = settings.ARCHIVE_VARIANTS_MAX_SIZE
+    if archive_cache_size > max_size:
+        max_size = max_size * 9 // 10
+    for mtime, size, sub_path in archives:
+        if archive_cache_size <= max_size:
+            break
+        cache_storage.delete(os.path.join(key, sub_path))
+        archive_cache_size -= size
+
+
+def storage_members(arc_storage, arc_key, arc_path, filename=None):
+    """ generate the files to add to an archive, as expected by :func:`moneta.archives.stream_archive`.
+    Files are only opened when required.
+    If `filename` is given, `arc_key` is a single file, added with this name. """
+    if filename is not None:
+        yield (filename, arc_storage.get_size(arc_key, arc_path), arc_storage.get_mtime(arc_key, arc_path),
+               arc_storage.get_file(arc_key, arc_path))
+        return
+    reldir = None
+    for root, dirs, files in arc_storage.walk(arc_key, arc_path):
+        if reldir is None:
+            reldir = root
+        for name in files:
+            fullname = os.path.join(root, name)
+            yield (os.path.relpath(fullname, reldir), arc_storage.get_size(arc_key, fullname),
+                   arc_storage.get_mtime(arc_key, fullname), arc_storage.get_file(arc_key, fullname))
+
+
+def sendpath(storage_type, key, path, mimetype, request=None, etag=None):
+    """
+    Send a stored file to the client.
+    Partial requests (`Range` and `If-Range` headers) are handled when `request` is given, unless the file is sent by
+    the web server (X-SENDFILE or X-Accel-Redirect) or the client is redirected to another server.
+
+    :param storage_type: name of the storage
+    :param key: key of the stored element
+    :param path: relative path of the file
+    :param mimetype: MIME type of the file
+    :param request: the current request
+    :param etag: strong validator of the file content (like a checksum), checked against `If-None-Match` and
+        `If-Range` headers. Built from the size and the modification time of the file if not given.
+    :return:
+    """
     storage_obj = storage(storage_type)
-    filesize = storage_obj.get_size(key, path)
-    full_path = storage_obj.get_path(key, path)
-    if full_path:
-        return send_file(full_path)
-    fileobj = storage_obj.get_file(key, path)
-    if fileobj is None:
+    try:
+        filesize, last_modified = storage_obj.get_stat(key, path)
+        last_modified = int(last_modified)
+    except OSError:
         raise Http404
-    response = StreamingHttpResponse(read_file_in_chunks(fileobj), content_type=mimetype)
+    if not etag:
+        etag = '%x-%x' % (last_modified, filesize)
+    if request is not None:
+        response = conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+    full_path = storage_obj.get_path(key, path)
+    if full_path and (request is None or is_sent_by_web_server(full_path)):
+        return set_validators(send_file(full_path), etag=etag, last_modified=last_modified)
+    content_disposition = None
     if mimetype[0:4] != 'text' and mimetype[0:5] != 'image':
-        response['Content-Disposition'] = 'attachment; filename={0}'.format(os.path.basename(path))
-    response['Content-Length'] = filesize
+        content_disposition = 'attachment; filename={0}'.format(os.path.basename(path))
+    url = storage_obj.get_url(key, path, content_type=mimetype, content_disposition=content_disposition)
+    if url:
+        return HttpResponseRedirect(url)
+    ranges = None
+    if request is not None and request.META.get('HTTP_RANGE') and \
+            request.META.get('HTTP_IF_RANGE', '"%s"' % etag) == '"%s"' % etag:
+        ranges = parse_byte_ranges(request.META['HTTP_RANGE'], filesize)
+        if ranges is not None and len(ranges) > settings.MAX_BYTE_RANGES:
+            ranges = None
+    if ranges == []:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % filesize
+        return response
+    elif ranges is None:
+        fileobj = storage_obj.get_file(key, path)
+        if fileobj is None:
+            raise Http404
+        response = StreamingHttpResponse(read_file_in_chunks(fileobj), content_type=mimetype)
+        response['Content-Length'] = filesize
+    elif len(ranges) == 1:
+        first, last = ranges[0]
+        fileobj = storage_obj.get_file(key, path, offset=first, length=last - first + 1)
+        if fileobj is None:
+            raise Http404
+        response = StreamingHttpResponse(read_file_in_chunks(fileobj), content_type=mimetype, status=206)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, filesize)
+        response['Content-Length'] = last - first + 1
+    else:
+        boundary = uuid.uuid4().hex
+        parts = [(('--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' %
+                   (boundary, mimetype, first, last, filesize)).encode(), first, last) for (first, last) in ranges]
+        end = ('--%s--\r\n' % boundary).encode()
+        response = StreamingHttpResponse(read_byte_ranges(storage_obj, key, path, parts, end), status=206,
+                                         content_type='multipart/byteranges; boundary=%s' % boundary)
+        response['Content-Length'] = sum(len(x[0]) + x[2] - x[1] + 3 for x in parts) + len(end)
+    if content_disposition:
+        response['Content-Disposition'] = content_disposition
+    response['Accept-Ranges'] = 'bytes'
+    return set_validators(response, etag=etag, last_modified=last_modified)
+
+
+def conditional_response(request, etag=None, last_modified=None):
+    """ return a 304 (or 412) response when the client already has the current version of the resource
+    (according to the `If-None-Match`, `If-Modified-Since`, `If-Match` and `If-Unmodified-Since` headers),
+    or None when the full response must be sent.
+
+    :param request: the current request
+    :param etag: validator of the resource (unquoted)
+    :param last_modified: modification timestamp of the resource
+    """
+    response = get_conditional_response(request, etag=quote_etag(etag) if etag else None,
+                                        last_modified=last_modified)
+    if response is not None:
+        set_validators(response, etag=etag, last_modified=last_modified)
+    return response
+
+
+def set_validators(response, etag=None, last_modified=None):
+    """ add the `ETag` and `Last-Modified` headers to the response """
+    if etag:
+        response['ETag'] = quote_etag(etag)
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
     return response
 
 
+def queryset_validators(queryset):
+    """ return an ETag and a modification timestamp that change as soon as an element is added to, removed from
+    or modified in the given queryset of :class:`moneta.repository.models.Element`, with a single SQL query.
+    """
+    values = queryset.aggregate(count=Count('id'), ids=Sum('id'), last=Max('modification'))
+    last_modified = int(values['last'].timestamp()) if values['last'] else None
+    etag = '%x-%x-%x' % (values['count'], values['ids'] or 0, last_modified or 0)
+    return etag, last_modified
+
+
+def read_byte_ranges(storage_obj, key, path, parts, end):
+    """ generate the body of a multipart/byteranges response
+
+    :param parts: list of (part header, first byte, last byte)
+    :param end: final boundary
+    """
+    for header, first, last in parts:
+        yield header
+        fileobj = storage_obj.get_file(key, path, offset=first, length=last - first + 1)
+        for data in read_file_in_chunks(fileobj):
+            yield data
+        fileobj.close()
+        yield b'\r\n'
+    yield end
+
+
+def is_sent_by_web_server(filepath):
+    """ return True if :func:`djangofloor.views.send_file` lets the web server send this file """
+    if settings.USE_X_SEND_FILE:
+        return True
+    filepath = os.path.abspath(filepath)
+    return any(filepath.startswith(os.path.abspath(dirpath)) for (dirpath, alias_url) in settings.X_ACCEL_REDIRECT)
+
+
 def compare_states(request: HttpRequest, rid):
     repo = get_object_or_404(Repository.reader_queryset(request), id=rid)
     states = ArchiveState.objects.filter(repository=repo)
@@ -31,6 +31,7 @@ setup(
     include_package_data=True,
     zip_safe=False,
     install_requires=['setuptools>=1.0', 'djangofloor>=1.0.25', 'gnupg>=2.3', 'rubymarshal', 'pyyaml'],
+    extras_require={'s3': ['boto3'], 'zstd': ['zstandard'], 'lz4': ['lz4']},
     setup_requires=[],
     classifiers=['Development Status :: 5 - Production/Stable',
                  'Framework :: Django :: 1.11',